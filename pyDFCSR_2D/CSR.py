@@ -1,4 +1,6 @@
+import copy
 import os
+import pickle
 import time
 from bmadx import  Drift, SBend, Quadrupole, Sextupole
 from .tools import dict2hdf5
@@ -9,19 +11,67 @@ from mpi4py import MPI
 from .beams import Beam
 # from .deposit import histogram_cic_1d, histogram_cic_2d
 from .deposit import DF_tracker
-from .interp1D import interpolate1D
-from .interp3D import interpolate3D
+from .distributed import block_partition, weighted_partition
+from .interfaces import write_particles
+from .interp1D import interpolate1D_fields
+from .interp3D import interpolate_fields
 from .lattice import Lattice  # , get_referece_traj
 from .params import Integration_params, CSR_params
+from .pool import WakePool
 # from .physical_constants import c, e, qe, me, MC2
-from .r_gen6 import r_gen6
+from .r_gen6 import r_gen6, r_edge
 #from line_profiler_pycharm import profile
 # from .tools import (find_nearest_ind, full_path, isotime, plot_2D_contour,
 #                     plot_surface)
 from .tools import full_path, isotime
 from .twiss_R import twiss_R
+from .wake_writer import WakeWriter
+from .writer import BackgroundWriter
 from .yaml_parser import parse_yaml
 
+# keys of the lattice elements understood by the linear tracking backend, see CSR2D.build_linear_map
+LINEAR_KEYS = {'drift': {'type', 'L', 'nsep', 'step_size'},
+               'dipole': {'type', 'L', 'nsep', 'step_size', 'angle', 'E1', 'E2', 'HGAP', 'HGAPX', 'FINT', 'FINTX',
+                          'FRINGE_AT', 'FRINGE_TYPE', 'TILT'},
+               'quad': {'type', 'L', 'nsep', 'step_size', 'K1', 'NUM_STEPS', 'X_OFFSET', 'Y_OFFSET', 'TILT'},
+               'sextupole': {'type', 'L', 'nsep', 'step_size', 'K2', 'NUM_STEPS', 'X_OFFSET', 'Y_OFFSET', 'TILT'}}
+
+
+def _rank_file(filename, rank):
+    """
+    checkpoint file of the rank, filename itself without MPI (rank None)
+    """
+    if rank is None:
+        return filename
+    base, ext = os.path.splitext(filename)
+    return f'{base}-{rank}{ext}'
+
+
+class _CheckpointPickler(pickle.Pickler):
+    """
+    pickler of the state of a CSR2D. The objects of CSR2D._external_objects are saved by name only
+    """
+    def __init__(self, file, external):
+        """
+        :param external: dictionary id(object): name
+        """
+        super().__init__(file, protocol = pickle.HIGHEST_PROTOCOL)
+        self.external = external
+
+    def persistent_id(self, obj):
+        return self.external.get(id(obj))
+
+
+class _CheckpointUnpickler(pickle.Unpickler):
+    def __init__(self, file, external):
+        """
+        :param external: dictionary name: object replacing the saved objects of this name
+        """
+        super().__init__(file)
+        self.external = external
+
+    def persistent_load(self, pid):
+        return self.external[pid]
 
 
 class CSR2D:
@@ -29,27 +79,49 @@ class CSR2D:
     The main class to calculate 2D CSR
     """
 
-    def __init__(self, input_file=None, parallel = False):
+    def __init__(self, input_file=None, parallel = False, comm = None):
+        """
+        :param parallel: run with MPI
+        :param comm: MPI communicator of the run, MPI.COMM_WORLD if None. E.g. a sub-communicator in a parameter scan
+        """
 
         self.timestamp = isotime()
+        self.parallel = parallel
+        self.comm = comm if comm is not None else MPI.COMM_WORLD
         if input_file:
             self.parse_input(input_file)
             self.input_file = input_file
         self.formation_length = None
-        self.initialization()  # process the initial beam
-
-        self.prefix = f'{self.CSR_params.write_name}-{self.timestamp}'
+        self._element_cache = {}   # bmadx elements keyed by (element name, DL, entrance, exit)
+        self._pending_wakes = []   # wakes queued by write_wakes, not yet in the file
+        self.wake_writer = None    # wake file, open from the first write to the end of run()
+        self.node_comm = None      # ranks sharing the DF history, for history_mode 'node_shared'
+        self._plan_index = 0       # next entry of lattice.step_plan to run
+        self._checkpoint_step = 0  # step of the last checkpoint
 
         if parallel:
             self.init_MPI()
         else:
             self.parallel = False
 
+        # process pool for the wakes in runs without MPI
+        self.pool = None
+        if (not self.parallel) and self.CSR_params.workers > 0:
+            self.pool = WakePool(self.CSR_params.workers)
+
+        # particle dumps and wakes are written in a background thread
+        self.output = BackgroundWriter(self.CSR_params.output_queue)
+
+        self.initialization()  # process the initial beam
+
+        self.prefix = f'{self.CSR_params.write_name}-{self.timestamp}'
+
     def parse_input(self, input_file):
         input = parse_yaml(input_file)
         self.check_input_consistency(input)
         self.input = input
-        self.beam = Beam(input['input_beam'])
+        # with MPI, rank 0 prepares the initial beam and broadcasts it
+        self.beam = Beam(input['input_beam'], comm = self.comm if self.parallel else None)
         self.lattice = Lattice(input['input_lattice'])
 
         if 'particle_deposition' in input:
@@ -67,18 +139,41 @@ class CSR2D:
         else:
             self.CSR_params = CSR_params()
 
+        if self.CSR_params.integrator == 'split':
+            # the kick of one CSR evaluation covers nsep steps, it is centred on the step only if nsep = 1
+            assert all(n == 1 for n in self.lattice.nsep), 'ERROR: the split integrator requires nsep = 1 for all elements'
+
     def initialization(self):
         """
         deposit the initial beam
         :return:
         """
-        self.DF_tracker.get_DF(x=self.beam.x, z=self.beam.z, px=self.beam.px, t=self.beam.position)
-        self.DF_tracker.append_DF()
-        self.DF_tracker.append_interpolant(formation_length=float('inf'),
-                                           n_formation_length=self.integration_params.n_formation_length)
+        self.deposit_beam(formation_length=float('inf'), build_interpolant=False)
         #Todo: add more flexible unit conversion, for both charge and energy
         self.CSR_scaling = 8.98755e3 * self.beam.charge # charge in C (8.98755e-6 MeV/m for 1nC/m^2)
         self.init_statistics()
+
+    def deposit_beam(self, formation_length, build_interpolant = True):
+        """
+        deposit the beam at the current position and add the density functions to the DF history.
+        With history_mode 'node_shared', only the node leader keeps the history and builds the interpolant,
+        which is then shared with the other ranks of the node
+        :param formation_length: formation length for the range of the interpolant history
+        :param build_interpolant: if False, only update the history
+        """
+        history_owner = self.node_comm is None or self.node_comm.Get_rank() == 0
+        # the deposition of a distributed beam is collective over all ranks
+        self.DF_tracker.get_DF(x=self.beam.x, z=self.beam.z, px=self.beam.px, t=self.beam.position,
+                               moments=self.beam.moments)
+        if history_owner:
+            self.DF_tracker.append_DF()
+            # append 3D matrix for interpolation with the new DFs by interpolation
+            self.DF_tracker.append_interpolant(formation_length=formation_length,
+                                               n_formation_length=self.integration_params.n_formation_length)
+        if build_interpolant:
+            # with a node_comm, collective over the ranks of the node
+            self.DF_tracker.build_interpolant(node_comm=self.node_comm)
+
     def init_statistics(self):
         Nstep = self.lattice.total_steps
         self.statistics = {}
@@ -115,14 +210,24 @@ class CSR2D:
 
     def init_MPI(self):
         self.parallel = True
-        comm = MPI.COMM_WORLD
+        comm = self.comm
         self.rank = comm.Get_rank()
         mpi_size = comm.Get_size()
         work_size = self.CSR_params.xbins * self.CSR_params.zbins
-        ave, res = divmod(work_size, mpi_size)
-        self.count = [ave + 1 if p < res else ave for p in range(mpi_size)]
-        displ = [sum(self.count[:p]) for p in range(mpi_size)]
-        self.displ = np.array(displ)
+        self.count, self.displ = block_partition(work_size, mpi_size)
+
+        if self.CSR_params.distribute_beam:
+            # each rank owns, tracks and deposits only its share of the particles
+            self.beam.distribute(comm)
+            self.DF_tracker.comm = comm
+
+        if self.CSR_params.history_mode == 'node_shared':
+            # one DF history per node, kept by rank 0 of the node. All ranks join the deposition of their share of
+            # the beam, a replicated beam would be deposited by the leader only while the others track it for nothing
+            assert self.CSR_params.distribute_beam, 'ERROR: history_mode node_shared requires distribute_beam'
+            self.node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+        elif self.CSR_params.history_mode == 'time_sliced':
+            self.DF_tracker.time_slicing = (self.rank, mpi_size, self.CSR_params.time_slice_chunk)
 
     def check_input_consistency(self, input):
         # Todo: need modification if dipole_config.yaml format changed
@@ -143,9 +248,87 @@ class CSR2D:
         else:
             self.formation_length = (3*R**2*phi**4)/(4*(-6*sigma_z + R*phi**3))
 
-    def get_bmadx_element(self, ele,  DL, entrance = False, exit = False):
+    def get_element(self, ele,  DL, entrance = False, exit = False, num_steps = 1):
+        """
+        element to track a step of length DL in the lattice element ele: a bmadx element, or a 7*7 affine transfer
+        map if the linear tracking backend is selected for this element type. Each distinct element is
+        built once per run and reused
+        :param num_steps: number of plan steps merged into this track, see run_fused_steps
+        """
+        key = (ele, DL, entrance, exit, num_steps)
+        if key not in self._element_cache:
+            type = self.lattice.lattice_config[ele]['type']
+            if self.tracking_backend(type) == 'linear':
+                self._element_cache[key] = self.build_linear_map(ele, DL, entrance=entrance, exit=exit)
+            else:
+                self._element_cache[key] = self.build_bmadx_element(ele, DL, entrance=entrance, exit=exit,
+                                                                    num_steps=num_steps)
+        return self._element_cache[key]
+
+    def tracking_backend(self, type):
+        """
+        :param type: element type, e.g. 'dipole', 'drift'
+        :return: 'bmadx' or 'linear'
+        """
+        tracking = self.CSR_params.tracking
+        if isinstance(tracking, dict):
+            backend = tracking.get(type, 'bmadx')
+        else:
+            backend = tracking
+        assert backend in ('bmadx', 'linear'), f'Unknown tracking backend {backend} for {type}'
+        return backend
+
+    def build_linear_map(self, ele, DL, entrance = False, exit = False):
+        """
+        7*7 affine transfer map of a step of length DL in the lattice element ele, in homogeneous coordinates:
+        the 6*6 r_gen6 matrix, with the constant term of the element offsets in the last column.
+        Sextupoles are linear drifts. The element keys the linear map can not represent raise an error.
+        """
+        config = self.lattice.lattice_config[ele]
+        type = config['type']
+        unsupported = set(config) - LINEAR_KEYS.get(type, set())
+        assert not unsupported, f'{ele}: {sorted(unsupported)} not supported by the linear tracking backend'
+        if type == 'dipole':
+            h = config['angle'] / config['L']
+            R = r_gen6(L=DL, angle=h * DL)
+            fringe_at = config.get('FRINGE_AT', 'both_ends')
+            if config.get('FRINGE_TYPE') == 'none':
+                fringe_at = 'no_end'
+            if entrance and fringe_at in ('both_ends', 'entrance_end'):
+                R = np.matmul(R, r_edge(h, config.get('E1', 0), hgap = config.get('HGAP', 0),
+                                        fint = config.get('FINT', 0.5)))
+            if exit and fringe_at in ('both_ends', 'exit_end'):
+                R = np.matmul(r_edge(h, config.get('E2', 0), hgap = config.get('HGAPX', config.get('HGAP', 0)),
+                                     fint = config.get('FINTX', config.get('FINT', 0.5))), R)
+
+        elif type == 'quad':
+            R = r_gen6(L=DL, k1=config['K1'])
+
+        else:
+            # the feed-down of an offset sextupole is not linear in the sextupole strength
+            assert type != 'sextupole' or not (config.get('X_OFFSET', 0) or config.get('Y_OFFSET', 0)), \
+                f'{ele}: offset sextupoles are not supported by the linear tracking backend'
+            R = r_gen6(L=DL)
+
+        if config.get('TILT', 0):
+            O = r_gen6(L=0, roll=config['TILT'])
+            R = np.matmul(O, np.matmul(R, O.T))
+
+        # the element is offset by d: x_out = R (x_in - d) + d
+        d = np.array([config.get('X_OFFSET', 0), 0, config.get('Y_OFFSET', 0), 0, 0, 0])
+        M = np.eye(7, 7)
+        M[:6, :6] = R
+        M[:6, 6] = d - np.matmul(R, d)
+        return M
+
+    def build_bmadx_element(self, ele,  DL, entrance = False, exit = False, num_steps = 1):
+        """
+        :param num_steps: number of plan steps merged into this element. The number of integration steps of
+                          quads and sextupoles is multiplied by it to keep the same accuracy
+        """
         input_dic = self.lattice.lattice_config[ele].copy()
         input_dic.pop('nsep')
+        input_dic.pop('step_size', None)
         L = input_dic.pop('L')
         type = input_dic.pop('type')
 
@@ -183,172 +366,386 @@ class CSR2D:
 
         elif type == 'quad':
             K1 = input_dic.pop('K1')
+            if num_steps > 1:
+                input_dic['NUM_STEPS'] = input_dic.get('NUM_STEPS', 1) * num_steps
             element = Quadrupole(L=DL, K1=K1, **input_dic)
 
         elif type == 'sextupole':
             K2 = input_dic.pop('K2')
+            if num_steps > 1:
+                input_dic['NUM_STEPS'] = input_dic.get('NUM_STEPS', 1) * num_steps
             element = Sextupole(L=DL, K2=K2, **input_dic)
-        print(element)
         return element
 
-#    @profile
-    def run(self, stop_time = None, debug = False):
-
-        if (not self.parallel) or (self.rank == 0):
-            print('Starting the DFCSR run')
-
-        step_count = 1
-
-        DL = self.lattice.step_size
-        ele_count = 0
-        skip_ele = False
-        self.inbend = False
-        self.afterbend = False
-        self.formation_length = 0.0
+    def build_elements(self):
+        """
+        build all the elements in the step plan before tracking starts
+        """
+        for plan_step in self.lattice.step_plan:
+            if plan_step.kind != 'element':
+                self.get_element(ele=plan_step.element, DL=plan_step.DL,
+                                 entrance=plan_step.entrance, exit=plan_step.exit)
 
-        for ele in list(self.lattice.lattice_config.keys())[1:]:
+#    @profile
+    def run(self, stop_time = None, debug = False, stop_element = None):
+        """
+        track the beam through the step plan, from the start or from where the previous call stopped
+        :param stop_time: stop after the step passing this position
+        :param stop_element: stop before entering the element of this name, e.g. to fork the run with snapshot()
+        """
+        if self._plan_index == 0:
+            if (not self.parallel) or (self.rank == 0):
+                print('Starting the DFCSR run')
+            self.inbend = False
+            self.afterbend = False
+            self.formation_length = 0.0
+        elif (not self.parallel) or (self.rank == 0):
+            print('Resuming the DFCSR run at s = {}'.format(self.beam.position))
+
+        self.build_elements()
+
+        plan = self.lattice.step_plan
+        i = self._plan_index
+        while i < len(plan):
+            plan_step = plan[i]
+
+            if plan_step.kind == 'element':
+                if plan_step.element == stop_element and i > self._plan_index:
+                    self._plan_index = i
+                    self.pause()
+                    return
+                self.enter_element(plan_step.element)
+                i += 1
 
-            self.lattice.update(ele)
-            # Todo: add sextupole, maybe Bmad Tracking?
-            # -----------------------load current lattice params-----------------#
-            # Pre-process the lattice params
-            L = self.lattice.lattice_config[ele]['L']
-            type = self.lattice.lattice_config[ele]['type']
-            steps = self.lattice.steps_per_element[ele_count]
-            R = float('inf')
-
-            ####### A step over the boundary of the elements, deal with the part of the step in the previous element
-            if (not skip_ele) and ele_count > 0:
-                DL_1 = self.lattice.distance[ele_count - 1] - self.beam.position   # The remaining distance in last element
-                #Todo: Bmadx seems to have some problems when DL is very
-                if DL_1 > 1.0e-6:
-                # calculate the part in the previous element
-                    element = self.get_bmadx_element(ele=ele_prev, DL=DL_1, exit=True)
-                    self.beam.track(element, DL_1, update_step=False)
+            elif plan_step.kind == 'step':
+                n = self.fusable_steps(plan, i, debug=debug)
+                if n > 1:
+                    self.run_fused_steps(plan[i:i + n])
                 else:
-                    DL_1 = 0.0
-            # If no steps inside an element
-            if steps == 0:    #If one step over the whole element
-                skip_ele = True
-                element = self.get_bmadx_element(ele=ele,  DL=L, exit=True, entrance = True)
-                self.beam.track(element, L, update_step=False)
-
+                    self.run_step(plan_step, debug=debug)
+                i += n
 
+                interval = self.CSR_params.checkpoint_interval
+                if interval and self.beam.step - self._checkpoint_step >= interval:
+                    self._plan_index = i
+                    self.checkpoint()
 
+                if stop_time and self.beam.position > stop_time:
+                    self._plan_index = i
+                    self.pause()
+                    return
 
-            if type == 'dipole':
-                angle = self.lattice.lattice_config[ele]['angle']
-                R = L / angle
+            else:
+                # part of a step over the boundary of the elements or a track over the whole element, no CSR
+                element = self.get_element(ele=plan_step.element, DL=plan_step.DL,
+                                           entrance=plan_step.entrance, exit=plan_step.exit)
+                self.beam.track(element, plan_step.DL, update_step=False)
+                i += 1
 
-                self.inbend = True
+        self._plan_index = i
+        self.dump_beam(label='end')
+        self.write_statistics()
+        self.pause()
 
-                self.afterbend = True
-                self.R_rec = R
-                self.phi_rec = angle
+    def pause(self):
+        """
+        write the queued output, close the wake file and release the worker processes, when run() returns
+        """
+        self.flush_wakes()
+        if self.wake_writer is not None:
+            self.output.submit(self.wake_writer.close)
+            self.wake_writer = None
+        self.output.close()
+        if self.pool is not None:
+            self.pool.close()
+
+    def snapshot(self, write_name = None):
+        """
+        Copy of the complete state of the run: beam, DF history, statistics and position in the step plan.
+        The copy continues independently with run(), e.g. with another downstream lattice (see replace_lattice).
+        The MPI communicators are shared with the copy
+        :param write_name: write_name of the output files of the copy
+        :return: CSR2D
+        """
+        self.flush_wakes()
+        self.output.wait()
+        memo = {}
+        for name, obj in self._external_objects().items():
+            if obj is not None:
+                # the communicators are shared, the resources of the original are replaced
+                memo[id(obj)] = obj if name in ('comm', 'node_comm') else None
+        fork = copy.deepcopy(self, memo)
+        fork._new_resources()
+        if write_name is not None:
+            fork.CSR_params.write_name = write_name
+            fork.prefix = f'{write_name}-{fork.timestamp}'
+        return fork
+
+    def _external_objects(self):
+        """
+        objects of the run not copied with its state: the MPI communicators, and the resources of the process
+        (worker pool, writer thread, open wake file, shared memory window)
+        :return: dictionary name: object or None
+        """
+        return {'comm': self.comm, 'node_comm': self.node_comm, 'pool': self.pool,
+                'shared_win': self.DF_tracker._shared_win, 'wake_writer': self.wake_writer, 'output': self.output}
 
-                self.get_formation_length(R=R, sigma_z=5*self.beam.sigma_z, inbend = True)
+    def _new_resources(self):
+        """
+        resources of a copy of the run, from snapshot() or restart()
+        """
+        self.DF_tracker._shared_win = None
+        self.DF_tracker._shared_nbytes = 0
+        self.wake_writer = None
+        self.pool = None
+        if (not self.parallel) and self.CSR_params.workers > 0:
+            self.pool = WakePool(self.CSR_params.workers)
+        self.output = BackgroundWriter(self.CSR_params.output_queue)
+
+    def checkpoint(self):
+        """
+        Save the complete state of the run to the workdir, to continue it with CSR2D.restart after a stop of the
+        job. With MPI each rank saves its own file. The queued output is written first
+        :return: path of the checkpoint, to pass to restart
+        """
+        self.flush_wakes()
+        self.output.wait()
+        self._checkpoint_step = self.beam.step
 
+        path = full_path(self.CSR_params.workdir)
+        filename = os.path.join(path, f'{self.CSR_params.write_name}-checkpoint.pkl')
+        rank_file = _rank_file(filename, self.rank if self.parallel else None)
+        external = {id(obj): name for name, obj in self._external_objects().items() if obj is not None}
+        with open(rank_file + '.tmp', 'wb') as f:
+            _CheckpointPickler(f, external).dump(self)
+        if self.parallel:
+            # keep the previous checkpoint until all the ranks have written the new one
+            self.comm.Barrier()
+        os.replace(rank_file + '.tmp', rank_file)
+
+        if (not self.parallel) or self.rank == 0:
+            print('Checkpoint at step {}, s = {} written to {}'.format(self.beam.step, self.beam.position, filename))
+        return filename
+
+    @classmethod
+    def restart(cls, checkpoint_file, parallel = False, comm = None):
+        """
+        The run saved by checkpoint(), to continue with run(). The output files of the run are continued
+        :param checkpoint_file: path returned by checkpoint()
+        :param parallel: run with MPI, as the saved run. The number of ranks must be the same
+        :param comm: MPI communicator of the run, MPI.COMM_WORLD if None
+        :return: CSR2D
+        """
+        comm = comm if comm is not None else MPI.COMM_WORLD
+        rank_file = _rank_file(checkpoint_file, comm.Get_rank() if parallel else None)
+        external = {'comm': comm, 'node_comm': None, 'pool': None, 'shared_win': None, 'wake_writer': None,
+                    'output': None}
+        with open(rank_file, 'rb') as f:
+            csr = _CheckpointUnpickler(f, external).load()
+
+        assert csr.parallel == parallel, 'The checkpoint was written by a run with parallel = {}'.format(csr.parallel)
+        if parallel:
+            assert len(csr.count) == comm.Get_size(), \
+                f'The checkpoint was written by {len(csr.count)} ranks, restart on the same number of ranks'
+            if csr.CSR_params.history_mode == 'node_shared':
+                csr.node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+        csr._new_resources()
+        return csr
+
+    def replace_lattice(self, input_lattice):
+        """
+        Continue the run with another lattice, e.g. in a copy from snapshot(). The elements already entered must
+        be the same, only the elements downstream of the current position may differ.
+        :param input_lattice: dictionary with lattice_input_file, as input_lattice of the config
+        """
+        lattice = Lattice(input_lattice)
+        i = self._plan_index
+        entered = [plan_step.element for plan_step in self.lattice.step_plan[:i] if plan_step.kind == 'element']
+        for ele in entered:
+            assert lattice.lattice_config.get(ele) == self.lattice.lattice_config[ele], \
+                f'Element {ele} upstream of the current position differs in the new lattice'
+        assert lattice.step_plan[:i] == self.lattice.step_plan[:i], \
+            'The step plan upstream of the current position differs in the new lattice'
+        lattice.update(self.lattice.current_element)
+
+        # statistics recorded so far, in arrays of the new number of steps
+        Nstep = lattice.total_steps
+        def resize(stats):
+            for key, value in stats.items():
+                if isinstance(value, dict):
+                    resize(value)
+                else:
+                    new = np.zeros((Nstep,) + value.shape[1:])
+                    n = min(Nstep, len(value))
+                    new[:n] = value[:n]
+                    stats[key] = new
+        resize(self.statistics)
+
+        self.lattice = lattice
+        self.input['input_lattice'] = input_lattice
+        # the elements are cached by name
+        self._element_cache = {}
+        if self.pool is not None:
+            self.pool.close()
+
+    def fusable_steps(self, plan, i, debug = False):
+        """
+        number of consecutive steps from plan[i] in the same element that need neither deposition nor CSR kick,
+        and can be tracked as one longer step. 1 if step fusion is off.
+        With compute_CSR on, every step deposits the beam in the DF history, which is sampled on the uniform step
+        grid, so only the tracking-only runs (compute_CSR = 0) are fused
+        """
+        if (not self.CSR_params.fuse_steps) or debug or self.CSR_params.compute_CSR:
+            return 1
+        n = 1
+        while (i + n < len(plan) and plan[i + n].kind == 'step' and
+               plan[i + n].ele_index == plan[i].ele_index):
+            n += 1
+        return n
+
+    def run_fused_steps(self, plan_steps):
+        """
+        track several steps of the same element as one element, and record the statistics at the
+        intermediate steps by transporting the beam moments with the linear maps of the steps
+        """
+        time0 = time.time()
+        first = plan_steps[0]
+        ele = first.element
+        DL = 0.0
+        for plan_step in plan_steps:
+            DL += plan_step.DL
+
+        moments0 = self.beam.moments
+        element = self.get_element(ele=ele, DL=DL, entrance=first.entrance, exit=plan_steps[-1].exit,
+                                   num_steps=len(plan_steps))
+        self.beam.track(element, DL, n_steps=len(plan_steps))
+
+        M = np.eye(7)
+        for plan_step in plan_steps[:-1]:
+            M = np.matmul(self.build_linear_map(ele, plan_step.DL, entrance=plan_step.entrance, exit=plan_step.exit), M)
+            self.update_statistics(step=plan_step.step_count, moments=moments0.transport(M))
+        self.update_statistics(step=plan_steps[-1].step_count)
+
+        if not self.parallel or self.rank == 0:
+            print("Finish steps {} to {}, s = {},  in {} seconds".format(first.step_count, plan_steps[-1].step_count,
+                                                                         self.beam.position, time.time() - time0))
+
+    def enter_element(self, ele):
+        """
+        bookkeeping of bends and formation length when the beam enters the element ele
+        """
+        self.lattice.update(ele)
+        # Todo: add sextupole, maybe Bmad Tracking?
+        # -----------------------load current lattice params-----------------#
+        # Pre-process the lattice params
+        L = self.lattice.lattice_config[ele]['L']
+        type = self.lattice.lattice_config[ele]['type']
 
-            else:  # If not in a bend
-                self.inbend = False
+        if type == 'dipole':
+            angle = self.lattice.lattice_config[ele]['angle']
+            R = L / angle
 
-                if self.afterbend:
-                    #Todo: Verify the formation length in the drift
-                    #self.get_formation_length(R=self.R_rec, sigma_z=5*self.beam.sigma_z, phi = self.phi_rec, inbend=False)
-                    self.get_formation_length(R=self.R_rec, sigma_z=5 * self.beam.sigma_z, inbend=True)
+            self.inbend = True
 
+            self.afterbend = True
+            self.R_rec = R
+            self.phi_rec = angle
 
-                else:  # if it is the first drift in the lattice
-                    self.formation_length += L
+            self.get_formation_length(R=R, sigma_z=5*self.beam.sigma_z, inbend = True)
 
 
+        else:  # If not in a bend
+            self.inbend = False
 
-            distance_in_current_ele = 0.0
-            # -----------------------tracking---------------------------------
-            for step in range(steps):
-                time0  = time.time()
+            if self.afterbend:
+                #Todo: Verify the formation length in the drift
+                #self.get_formation_length(R=self.R_rec, sigma_z=5*self.beam.sigma_z, phi = self.phi_rec, inbend=False)
+                self.get_formation_length(R=self.R_rec, sigma_z=5 * self.beam.sigma_z, inbend=True)
 
-                # Deal with boundary condition. A step over the boundary of two adjacent elements
-                if (step == 0) and (ele_count > 0):
-                    # If enter a new element, split the step
 
-                    DL_2 = self.lattice._positions_record[step_count] - self.lattice.distance[ele_count - 1]
+            else:  # if it is the first drift in the lattice
+                self.formation_length += L
 
-                    # calculate the part in the new element
-                    element = self.get_bmadx_element(ele = ele,  DL = DL_2, entrance = True)
-                    self.beam.track(element, DL_2)
-                    distance_in_current_ele += DL_2
-                    skip_ele = False    # Reset the flag
+    def run_step(self, plan_step, debug = False):
+        """
+        track one step of the plan, deposit the beam and compute and apply CSR.
+        With the 'kick' integrator the CSR kick is applied after tracking the full step, with the 'split'
+        integrator it is applied at the middle of the step (drift-kick-drift)
+        """
+        time0  = time.time()
+        ele = plan_step.element
+        step_count = plan_step.step_count
+
+        # -----------------------tracking---------------------------------
+        # Propagate beam for one step. At a boundary of two adjacent elements, only the part in the new element
+        if self.CSR_params.integrator == 'split':
+            first_half = self.get_element(ele = ele, DL = plan_step.DL/2, entrance = plan_step.entrance)
+            second_half = self.get_element(ele = ele, DL = plan_step.DL/2, exit = plan_step.exit)
+            CSR_computed = self.beam.frog_leap(first_half, second_half, plan_step.DL,
+                                               kick = lambda: self.CSR_kick(plan_step, debug = debug))
+        else:
+            element = self.get_element(ele = ele,  DL = plan_step.DL, entrance = plan_step.entrance,
+                                       exit = plan_step.exit)
+            self.beam.track(element, plan_step.DL)
+            CSR_computed = self.CSR_kick(plan_step, debug = debug)
 
-                else:
-                    element = self.get_bmadx_element(ele = ele,  DL = DL)
-                    # Propagate beam for one step
-                    self.beam.track(element, DL)
-                    distance_in_current_ele += DL
-
-
-                if debug or self.CSR_params.compute_CSR:
-                    # get the density functions
-                    self.DF_tracker.get_DF(x=self.beam.x, z=self.beam.z, px=self.beam.px, t=self.beam.position)
-                    # append the density functions to the log
-                    self.DF_tracker.append_DF()
-                    # append 3D matrix for interpolation with the new DFs by interpolation
-                    #self.get_formation_length(R=R, sigma_z=self.beam.sigma_z)
-                    self.DF_tracker.append_interpolant(formation_length=self.formation_length,
-                                                       n_formation_length=self.integration_params.n_formation_length)
-                    # build interpolant based on the 3D matrix
-                    self.DF_tracker.build_interpolant()
-
-                # If beam is in an after-bend drift and away from the previous bend for more than n*formation_length, stop calculating wakes
-                #Todo: formation length not correct here
-                #if  self.afterbend and (not self.inbend) and distance_in_current_ele > 3*self.formation_length:
-                #    CSR_blocker = True
-                #    if (not self.parallel) or (self.rank == 0):
-                #        print("Far away from a bending magnet, stopping calculating CSR")
-
-                #else:
-                #    CSR_blocker = False
-                CSR_blocker = False
-                
-                
-                if self.CSR_params.compute_CSR and (not CSR_blocker):
-                    if step % self.lattice.nsep[ele_count] == 0:
-                        # calculate CSR mesh given beam shape
-                        self.get_CSR_mesh()
-                        # Calculate CSR on the mesh
-                        if self.parallel:
-                            self.calculate_2D_CSR_parallel()
-                        else:
-                            self.calculate_2D_CSR()
-                        # Apply CSR kick to the beam
-                        if self.CSR_params.apply_CSR:
-                            self.beam.apply_wakes(self.dE_dct, self.x_kick,
-                                              self.CSR_xrange_transformed, self.CSR_zrange, DL*self.lattice.nsep[ele_count],
-                                                  self.CSR_params.transverse_on)
-                        if (self.CSR_params.write_beam == 'all' or
-                                (isinstance(self.CSR_params.write_beam, list) and (step_count in self.CSR_params.write_beam))):
-                            self.dump_beam(label = step_count)
-                        if self.CSR_params.write_wakes:
-                            self.write_wakes()
-
-                # recording statistics at each step
-                self.update_statistics(step = step_count)
-
-                if not self.parallel or self.rank == 0:
-                    print("Finish step {}, s = {},  in {} seconds".format(step_count, self.beam.position, time.time() - time0))
-
-                step_count += 1
+        if CSR_computed:
+            if (self.CSR_params.write_beam == 'all' or
+                    (isinstance(self.CSR_params.write_beam, list) and (step_count in self.CSR_params.write_beam))):
+                self.dump_beam(label = step_count)
+            if self.CSR_params.write_wakes:
+                self.write_wakes()
 
-                if stop_time and self.beam.position > stop_time:
-                    return
+        # recording statistics at each step
+        self.update_statistics(step = step_count)
 
-            ele_prev = ele
-            type_prev = type
+        if not self.parallel or self.rank == 0:
+            print("Finish step {}, s = {},  in {} seconds".format(step_count, self.beam.position, time.time() - time0))
 
-            ele_count += 1
+    def CSR_kick(self, plan_step, debug = False):
+        """
+        deposit the beam at the current position, then compute and apply the CSR wakes every nsep steps.
+        The kick length is the nominal length of the nsep steps, plan_step.kick_length
+        :return: True if the wakes are computed in this step
+        """
+        ele_count = plan_step.ele_index
+        step = plan_step.step
+
+        if debug or self.CSR_params.compute_CSR:
+            #self.get_formation_length(R=R, sigma_z=self.beam.sigma_z)
+            self.deposit_beam(formation_length=self.formation_length)
+
+        # If beam is in an after-bend drift and away from the previous bend for more than n*formation_length, stop calculating wakes
+        #Todo: formation length not correct here
+        #if  self.afterbend and (not self.inbend) and distance_in_current_ele > 3*self.formation_length:
+        #    CSR_blocker = True
+        #    if (not self.parallel) or (self.rank == 0):
+        #        print("Far away from a bending magnet, stopping calculating CSR")
+
+        #else:
+        #    CSR_blocker = False
+        CSR_blocker = False
+
+
+        if self.CSR_params.compute_CSR and (not CSR_blocker):
+            if step % self.lattice.nsep[ele_count] == 0:
+                # calculate CSR mesh given beam shape
+                self.get_CSR_mesh()
+                # Calculate CSR on the mesh
+                if self.parallel:
+                    self.calculate_2D_CSR_parallel()
+                elif self.pool is not None:
+                    self.calculate_2D_CSR_pool()
+                else:
+                    self.calculate_2D_CSR()
+                # Apply CSR kick to the beam
+                if self.CSR_params.apply_CSR:
+                    self.beam.apply_wakes(self.dE_dct, self.x_kick,
+                                      self.CSR_xrange_transformed, self.CSR_zrange, plan_step.kick_length,
+                                          self.CSR_params.transverse_on)
+                return True
 
-        self.dump_beam(label='end')
-        self.write_statistics()
+        return False
 
 
     def get_CSR_mesh(self):
@@ -358,11 +755,10 @@ class CSR2D:
         :return:
         """
 
-        x_transform = self.beam.x_transform
         p = self.beam.slope
 
-        sig_x = np.std(x_transform)
-        mean_x = np.mean(x_transform)
+        sig_x = self.beam.sigma_x_transform
+        mean_x = self.beam.mean_x_transform
         sig_z = self.beam.sigma_z
         mean_z = self.beam.mean_z
         xlim = self.CSR_params.xlim
@@ -410,21 +806,42 @@ class CSR2D:
         self.dE_dct = self.dE_dct.reshape((self.CSR_params.xbins, self.CSR_params.zbins))
         self.x_kick = self.x_kick.reshape((self.CSR_params.xbins, self.CSR_params.zbins))
 
+    def calculate_2D_CSR_pool(self):
+        """
+        compute the wakes on the CSR mesh with the worker processes of self.pool
+        """
+        dE_dct, x_kick = self.pool.calculate(self)
+        self.dE_dct = dE_dct.reshape((self.CSR_params.xbins, self.CSR_params.zbins))
+        self.x_kick = x_kick.reshape((self.CSR_params.xbins, self.CSR_params.zbins))
+
     def calculate_2D_CSR_parallel(self):
+        """
+        compute the wakes on the CSR mesh with MPI. The results of all ranks are gathered with one non-blocking
+        collective, the pending wakes of the previous evaluation are written while it is in flight
+        """
         work_size= self.CSR_params.xbins * self.CSR_params.zbins
-        comm = MPI.COMM_WORLD
-        rank = comm.Get_rank()
+        comm = self.comm
+        if self.CSR_params.history_mode == 'time_sliced':
+            # each rank integrates over its own part of the history, the integrands vanish elsewhere
+            self.calculate_2D_CSR()
+            wakes = np.stack((self.dE_dct, self.x_kick))
+            request = comm.Iallreduce(MPI.IN_PLACE, wakes, op=MPI.SUM)
+            self.flush_wakes()
+            request.Wait()
+            self.dE_dct, self.x_kick = wakes[0], wakes[1]
+            return
+
+        rank = self.rank
         start = int(self.displ[rank])
         local_size = int(self.count[rank])
 
-        self.dE_dct = np.zeros((work_size,))
-        self.x_kick = np.zeros((work_size,))
-
-        dE_dct_local = np.zeros((local_size,))
-        x_kick_local = np.zeros(local_size, )
+        # dE_dct, x_kick and the cost of each mesh point, packed in one buffer for a single collective
+        ncol = 3 if self.CSR_params.load_balance else 2
+        local = np.zeros((local_size, ncol))
 
         start_time = time.time()
         for i in range(local_size):
+            time0 = time.perf_counter()
             k  = start + i
             # if i == 210:
             #    print(i)
@@ -435,13 +852,23 @@ class CSR2D:
             s = self.beam.position + self.CSR_zmesh[k]
             x = self.CSR_xmesh[k]
 
-            dE_dct_local[i], x_kick_local[i] = self.get_CSR_wake(s,x)
+            local[i, 0], local[i, 1] = self.get_CSR_wake(s,x)
+            if ncol == 3:
+                local[i, 2] = time.perf_counter() - time0
 
-        comm.Allgatherv(dE_dct_local, [self.dE_dct, self.count, self.displ, MPI.DOUBLE])
-        comm.Allgatherv(x_kick_local, [self.x_kick, self.count, self.displ, MPI.DOUBLE])
+        gathered = np.zeros((work_size, ncol))
+        request = comm.Iallgatherv(local, [gathered, np.array(self.count) * ncol, np.array(self.displ) * ncol, MPI.DOUBLE])
+        # independent of the new wakes
+        self.flush_wakes()
+        request.Wait()
 
-        self.dE_dct = self.dE_dct.reshape((self.CSR_params.xbins, self.CSR_params.zbins))
-        self.x_kick = self.x_kick.reshape((self.CSR_params.xbins, self.CSR_params.zbins))
+        if self.CSR_params.load_balance:
+            # the cost of each mesh point changes slowly between the steps, partition the next step with the
+            # timings of this one
+            self.count, self.displ = weighted_partition(gathered[:, 2], comm.Get_size())
+
+        self.dE_dct = np.ascontiguousarray(gathered[:, 0]).reshape((self.CSR_params.xbins, self.CSR_params.zbins))
+        self.x_kick = np.ascontiguousarray(gathered[:, 1]).reshape((self.CSR_params.xbins, self.CSR_params.zbins))
 
 #    @profile
     def get_CSR_wake(self, s, x, debug = False):
@@ -597,42 +1024,27 @@ class CSR2D:
           
     def get_CSR_integrand(self,s ,x, t, sp, xp, ignore_vx = False):
 
+        DF = self.DF_tracker
         #vx = self.DF_tracker.F_vx([t, x, s - t])
-        vx = interpolate3D(xval=np.array([t]), yval=np.array([x]), zval=np.array([s-t]),
-                             data=self.DF_tracker.data_vx_interp,
-                             min_x=self.DF_tracker.min_x, min_y=self.DF_tracker.min_y,
-                             min_z=self.DF_tracker.min_z,
-                             delta_x=self.DF_tracker.delta_x, delta_y=self.DF_tracker.delta_y,
-                             delta_z=self.DF_tracker.delta_z)[0]
+        vx = interpolate_fields(tval=np.array([t]), yval=np.array([x]), zval=np.array([s-t]),
+                                data=DF.current_fields, times=DF.current_time, time_table=DF.current_table,
+                                time_step=DF.current_step, min_y=DF.min_y, min_z=DF.min_z,
+                                delta_y=DF.delta_y, delta_z=DF.delta_z,
+                                shear_a=DF.shear_a, shear_b=DF.shear_b)[0, 3]
 
         sp_flat = sp.ravel()
         xp_flat = xp.ravel()
 
 
-        X0_s = interpolate1D(xval = np.array([s]), data = self.lattice.coords[:, 0], min_x = self.lattice.min_x,
-                             delta_x = self.lattice.delta_x)[0]
-        X0_sp = interpolate1D(xval = sp_flat, data = self.lattice.coords[:, 0], min_x = self.lattice.min_x,
-                              delta_x = self.lattice.delta_x)
-        Y0_s = interpolate1D(xval = np.array([s]), data = self.lattice.coords[:, 1], min_x = self.lattice.min_x,
-                             delta_x = self.lattice.delta_x)[0]
-        Y0_sp = interpolate1D(xval = sp_flat, data = self.lattice.coords[:, 1], min_x = self.lattice.min_x,
-                              delta_x = self.lattice.delta_x)
-        n_vec_s_x = interpolate1D(xval = np.array([s]), data = self.lattice.n_vec[:, 0], min_x = self.lattice.min_x,
-                                  delta_x = self.lattice.delta_x)[0]
-        n_vec_sp_x =interpolate1D(xval = sp_flat, data = self.lattice.n_vec[:, 0], min_x = self.lattice.min_x,
-                                  delta_x = self.lattice.delta_x)
-        n_vec_s_y = interpolate1D(xval=np.array([s]), data=self.lattice.n_vec[:, 1], min_x=self.lattice.min_x,
-                                  delta_x=self.lattice.delta_x)[0]
-        n_vec_sp_y = interpolate1D(xval=sp_flat, data=self.lattice.n_vec[:, 1], min_x=self.lattice.min_x,
-                                   delta_x=self.lattice.delta_x)
-        tau_vec_s_x = interpolate1D(xval=np.array([s]), data=self.lattice.tau_vec[:, 0], min_x=self.lattice.min_x,
-                                  delta_x=self.lattice.delta_x)[0]
-        tau_vec_sp_x = interpolate1D(xval=sp_flat, data=self.lattice.tau_vec[:, 0], min_x=self.lattice.min_x,
-                                   delta_x=self.lattice.delta_x)
-        tau_vec_s_y = interpolate1D(xval=np.array([s]), data=self.lattice.tau_vec[:, 1], min_x=self.lattice.min_x,
-                                  delta_x=self.lattice.delta_x)[0]
-        tau_vec_sp_y = interpolate1D(xval=sp_flat, data=self.lattice.tau_vec[:, 1], min_x=self.lattice.min_x,
-                                   delta_x=self.lattice.delta_x)
+        lattice = self.lattice
+        traj_s = interpolate1D_fields(xval = np.array([s]), data = lattice.traj_data, grid = lattice.s,
+                                      table = lattice.traj_table, table_step = lattice.traj_table_step)[0]
+        traj_sp = interpolate1D_fields(xval = sp_flat, data = lattice.traj_data, grid = lattice.s,
+                                       table = lattice.traj_table, table_step = lattice.traj_table_step)
+        X0_s, Y0_s, n_vec_s_x, n_vec_s_y, tau_vec_s_x, tau_vec_s_y = traj_s
+        X0_sp, Y0_sp = traj_sp[:, 0], traj_sp[:, 1]
+        n_vec_sp_x, n_vec_sp_y = traj_sp[:, 2], traj_sp[:, 3]
+        tau_vec_sp_x, tau_vec_sp_y = traj_sp[:, 4], traj_sp[:, 5]
 
 
         r_minus_rp_x = X0_s - X0_sp + x * n_vec_s_x - xp_flat * n_vec_sp_x
@@ -641,12 +1053,7 @@ class CSR2D:
 
 
         #rho_sp = self.lattice.F_rho(sp_flat)
-        rho_sp = np.zeros(sp_flat.shape)
-        for count in range(self.lattice.Nelement):
-            if count == 0:
-                rho_sp[sp_flat < self.lattice.distance[count]] = self.lattice.rho[count]
-            else:
-                rho_sp[(sp_flat < self.lattice.distance[count]) & (sp_flat >= self.lattice.distance[count - 1])] = self.lattice.rho[count]
+        rho_sp = self.lattice.get_rho(sp_flat)
 
         t_ret = t - r_minus_rp
 
@@ -656,37 +1063,17 @@ class CSR2D:
         #vx_ret = self.DF_tracker.F_vx(np.array([t_ret, xp_flat, sp_flat- t_ret]).T)
         #vx_x_ret = self.DF_tracker.F_vx_x(np.array([t_ret, xp_flat, sp_flat- t_ret]).T)
 
-        density_ret = interpolate3D(xval = t_ret, yval = xp_flat, zval = sp_flat - t_ret,
-                                  data = self.DF_tracker.data_density_interp,
-                                  min_x = self.DF_tracker.min_x, min_y = self.DF_tracker.min_y,  min_z = self.DF_tracker.min_z,
-                                  delta_x = self.DF_tracker.delta_x, delta_y = self.DF_tracker.delta_y, delta_z = self.DF_tracker.delta_z)
-
-        density_x_ret = interpolate3D(xval=t_ret, yval=xp_flat, zval=sp_flat - t_ret,
-                                  data=self.DF_tracker.data_density_x_interp,
-                                  min_x=self.DF_tracker.min_x, min_y=self.DF_tracker.min_y, min_z=self.DF_tracker.min_z,
-                                  delta_x=self.DF_tracker.delta_x, delta_y=self.DF_tracker.delta_y,
-                                  delta_z=self.DF_tracker.delta_z)
-
-        density_z_ret = interpolate3D(xval=t_ret, yval=xp_flat, zval=sp_flat - t_ret,
-                                    data=self.DF_tracker.data_density_z_interp,
-                                    min_x=self.DF_tracker.min_x, min_y=self.DF_tracker.min_y,
-                                    min_z=self.DF_tracker.min_z,
-                                    delta_x=self.DF_tracker.delta_x, delta_y=self.DF_tracker.delta_y,
-                                    delta_z=self.DF_tracker.delta_z)
-
-        vx_ret = interpolate3D(xval=t_ret, yval=xp_flat, zval=sp_flat - t_ret,
-                                    data=self.DF_tracker.data_vx_interp,
-                                    min_x=self.DF_tracker.min_x, min_y=self.DF_tracker.min_y,
-                                    min_z=self.DF_tracker.min_z,
-                                    delta_x=self.DF_tracker.delta_x, delta_y=self.DF_tracker.delta_y,
-                                    delta_z=self.DF_tracker.delta_z)
-
-        vx_x_ret = interpolate3D(xval=t_ret, yval=xp_flat, zval=sp_flat - t_ret,
-                             data=self.DF_tracker.data_vx_x_interp,
-                             min_x=self.DF_tracker.min_x, min_y=self.DF_tracker.min_y,
-                             min_z=self.DF_tracker.min_z,
-                             delta_x=self.DF_tracker.delta_x, delta_y=self.DF_tracker.delta_y,
-                             delta_z=self.DF_tracker.delta_z)
+        # density, density_x, density_z, vx, vx_x at the retarded time, in one pass
+        fields_ret = interpolate_fields(tval=t_ret, yval=xp_flat, zval=sp_flat - t_ret,
+                                        data=DF.data_fields_interp, times=DF.time_grid, time_table=DF.time_table,
+                                        time_step=DF.time_step, min_y=DF.min_y, min_z=DF.min_z,
+                                        delta_y=DF.delta_y, delta_z=DF.delta_z,
+                                        shear_a=DF.shear_a, shear_b=DF.shear_b, rows=DF.time_rows, owned=DF.time_owned)
+        density_ret = fields_ret[:, 0]
+        density_x_ret = fields_ret[:, 1]
+        density_z_ret = fields_ret[:, 2]
+        vx_ret = fields_ret[:, 3]
+        vx_x_ret = fields_ret[:, 4]
 
         ## Todo: More accurate vx, maybe add vs
         vs = 1
@@ -775,7 +1162,18 @@ class CSR2D:
         return CSR_integrand_z, CSR_integrand_x
 
     def dump_beam(self, label):
-        if self.parallel and self.rank != 0:
+        """
+        write the particles to the workdir in the background writer, from a copy of the coordinates
+        """
+        if self.beam.comm is not None:
+            # collective, the particles are distributed over the ranks. The gathered arrays are new
+            particle_group = self.beam.gather_particle_group()
+            if self.rank != 0:
+                return
+            job = (particle_group.write,)
+        elif (not self.parallel) or self.rank == 0:
+            job = (write_particles, self.beam.copy_particle(), self.beam.charge)
+        else:
             return
 
         path = full_path(self.CSR_params.workdir)
@@ -787,48 +1185,55 @@ class CSR2D:
 
         print("Beam at position {} is written to {}".format(self.beam.position, filename))
 
-        self.beam.particle_group.write(filename)
+        self.output.submit(*job, filename)
 
     def write_wakes(self):
-
+        """
+        queue the wakes of the current step for writing. With MPI the file is written by flush_wakes while the
+        results of the next CSR evaluation are gathered, or at the end of the run. The arrays are not copied,
+        the CSR evaluations create new ones
+        """
         if self.parallel and self.rank != 0:
             return
 
-        path = full_path(self.CSR_params.workdir)
+        self._pending_wakes.append({'step': self.beam.step, 'position': self.beam.position,
+                                    'mean_gamma': self.beam.init_gamma, 'beam_energy': self.beam.init_energy,
+                                    'element': self.lattice.current_element, 'charge': self.beam.charge,
+                                    'x_grids': self.CSR_xmesh.reshape(self.dE_dct.shape),
+                                    'z_grids': self.CSR_zmesh.reshape(self.dE_dct.shape),
+                                    'dE_dct': self.dE_dct, 'xkicks': self.x_kick})
+        if not self.parallel:
+            self.flush_wakes()
+
+    def flush_wakes(self):
+        """
+        pass the queued wakes to the background writer
+        """
+        if not self._pending_wakes:
+            return
+
+        if self.wake_writer is None:
+            path = full_path(self.CSR_params.workdir)
+            filename = os.path.join(path, f'{self.prefix}-wakes.h5')
+            # a new file at the first step, appended to when the run is resumed
+            new = self._pending_wakes[0]['step'] == 1
+            self.wake_writer = WakeWriter(filename, new = new, compression = self.CSR_params.wake_compression,
+                                          first_step = self._pending_wakes[0]['step'])
+            if new:
+                print("Wakes written to ", filename)
+
+        self.output.submit(self.wake_writer.write_all, self._pending_wakes)
+        self._pending_wakes = []
 
-        filename = os.path.join(path, f'{self.prefix}-wakes.h5')
-
-
-        if self.beam.step == 1:
-            if os.path.isfile(filename):
-                os.remove(filename)
-                print("Existing file " + filename + " deleted.")
-            print("Wakes written to ", filename)
-
-
-        with h5py.File(filename, 'a') as hf:
-            step = self.beam.step
-            groupname = 'step_' + str(step)
-            g = hf.create_group(groupname)
-            g.attrs['step'] = step
-            g.attrs['position']  = self.beam.position
-            g.attrs['mean_gamma'] = self.beam.init_gamma
-            g.attrs['beam_energy'] = self.beam.init_energy
-            g.attrs['element'] = self.lattice.current_element
-            g.attrs['charge'] = self.beam.charge
-            g1 = g.create_group('longitudinal')
-            g1.attrs['unit'] = 'MeV/m'
-            g1.create_dataset('x_grids', data = self.CSR_xmesh.reshape(self.dE_dct.shape))
-            g1.create_dataset('z_grids', data = self.CSR_zmesh.reshape(self.dE_dct.shape))
-            g1.create_dataset('dE_dct', data = self.dE_dct)
-            g2  = g.create_group('transverse')
-            g2.attrs['unit'] = 'MeV/m'
-            g2.create_dataset('x_grids', data = self.CSR_xmesh.reshape(self.dE_dct.shape))
-            g2.create_dataset('z_grids', data = self.CSR_zmesh.reshape(self.dE_dct.shape))
-            g2.create_dataset('xkicks', data = self.x_kick)
 #    @profile
-    def update_statistics(self, step):
-        twiss = self.beam.twiss
+    def update_statistics(self, step, moments = None):
+        """
+        record the beam statistics at step
+        :param moments: BeamMoments to record, the current beam moments if None
+        """
+        if moments is None:
+            moments = self.beam.moments
+        twiss = moments.twiss
         self.statistics['twiss']['alpha_x'][step] = twiss['alpha_x']
         self.statistics['twiss']['beta_x'][step] = twiss['beta_x']
         self.statistics['twiss']['gamma_x'][step] = twiss['gamma_x']
@@ -843,13 +1248,13 @@ class CSR2D:
         self.statistics['twiss']['eta_y'][step] = twiss['eta_y']
         self.statistics['twiss']['etap_y'][step] = twiss['etap_y']
         self.statistics['twiss']['norm_emit_y'][step] = twiss['norm_emit_y']
-        self.statistics['slope'][step, :] = self.beam._slope
-        self.statistics['sigma_x'][step] = self.beam._sigma_x
-        self.statistics['sigma_z'][step] = self.beam._sigma_z
-        self.statistics['sigma_energy'][step] = self.beam.sigma_energy
-        self.statistics['mean_x'][step] = self.beam._mean_x
-        self.statistics['mean_z'][step] = self.beam._mean_z
-        self.statistics['mean_energy'][step] = self.beam.mean_energy
+        self.statistics['slope'][step, :] = moments.slope
+        self.statistics['sigma_x'][step] = moments.sigma_x
+        self.statistics['sigma_z'][step] = moments.sigma_z
+        self.statistics['sigma_energy'][step] = moments.sigma_energy
+        self.statistics['mean_x'][step] = moments.mean_x
+        self.statistics['mean_z'][step] = moments.mean_z
+        self.statistics['mean_energy'][step] = moments.mean_energy
     def write_statistics(self):
 
         if self.parallel and self.rank != 0:
@@ -866,6 +1271,7 @@ class CSR2D:
 
         with h5py.File(filename, 'w') as hf:
             hf.create_dataset(name = 'step_positions', data = self.lattice.steps_record, shape = self.lattice.steps_record.shape)
+            hf.create_dataset(name='traj_s', data=self.lattice.s)
             hf.create_dataset(name='coords', data=self.lattice.coords)
             hf.create_dataset(name='n_vec', data=self.lattice.n_vec)
             hf.create_dataset(name='tau_vec', data=self.lattice.tau_vec)
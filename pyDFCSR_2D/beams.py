@@ -1,19 +1,27 @@
 import numpy as np
+import distgen
 from distgen import Generator
 from .physical_constants import MC2
-from scipy.interpolate import RegularGridInterpolator
 from bmadx import Particle, M_ELECTRON
 #from bmadx.pmd_utils import openpmd_to_bmadx_particles, bmadx_particles_to_openpmd
-from .interfaces import  openpmd_to_bmadx_particles, bmadx_particles_to_openpmd
+from .interfaces import  openpmd_to_bmadx_coords, bmadx_particles_to_openpmd
+from .interfaces import beamfile_format, read_binary_coords, read_openpmd_bmadx_coords
 from bmadx import track_element
 from pmd_beamphysics import ParticleGroup
 #from line_profiler_pycharm import profile
-from .twiss import  twiss_from_bmadx_particles
+from .distributed import block_partition
+from .moments import compute_moments
+from .interp2D import apply_wake_kicks
+from .tools import yaml_hash, load_cache, save_cache
 class Beam():
     """
     Beam class to initialize, track and apply wakes
     """
-    def __init__(self, input_beam):
+    def __init__(self, input_beam, comm = None):
+        """
+        :param comm: MPI communicator. If given, rank 0 generates (or loads from the cache) the distgen beam
+                     and broadcasts it to the other ranks
+        """
 
         self.check_inputs(input_beam)
         self.input_beam_config = input_beam
@@ -21,30 +29,45 @@ class Beam():
 
         if self.style == 'from_file':
             filename = input_beam['beamfile']
-
-            ## Read bmadx coords
-            coords = np.loadtxt(filename)
-            assert coords.shape[1] == 6, f'Error: input beam must have 6 dimension, but get {coords.shape[1]} instead'
-
-            self._charge = input_beam['charge']
-            self._init_energy = input_beam['energy']
-
-            # Keep track of both BmadX particle format (for tracking) and Particle Group format (for calculating twiss).
-            self.particle = Particle(*coords.T, 0, self._init_energy, MC2)   #BmadX Particle
+            format = input_beam.get('beamfile_format', beamfile_format(filename))
+
+            # The beam owns a contiguous 6*N buffer of bmadx coords, BmadX Particle are views of it
+            if format == 'openpmd':
+                coords, energy, charge = read_openpmd_bmadx_coords(filename, p0c=input_beam.get('energy'))
+                self._set_coords(coords)
+                self._charge = input_beam.get('charge', charge)
+                self._init_energy = energy
+
+            else:
+                self._charge = input_beam['charge']
+                self._init_energy = input_beam['energy']
+
+                if format == 'text':
+                    ## Read bmadx coords
+                    coords = np.loadtxt(filename)
+                    assert coords.shape[1] == 6, f'Error: input beam must have 6 dimension, but get {coords.shape[1]} instead'
+                    self._set_coords(np.ascontiguousarray(coords.T, dtype=np.float64))
+                else:
+                    self._set_coords(read_binary_coords(filename, format, dtype=input_beam.get('beamfile_dtype', 'float64')))
             #self.particleGroup = bmadx_particles_to_openpmd(self.particle)  # Particle Group
 
 
 
         elif  self.style == 'distgen':
             filename = input_beam['distgen_input_file']
-            gen = Generator(filename)
-            gen.run()
-            pg = gen.particles
-            self._charge = pg['charge']
-            self._init_energy = np.mean(pg['energy'])
-
-            self.particle = openpmd_to_bmadx_particles(pg, self._init_energy, 0.0, MC2)   #Bmad X particle
-            #self.particleGroup = pg              # Particle Group
+            cache = input_beam.get('distgen_cache', False)
+            if comm is None:
+                self.generate_distgen(filename, cache = cache)
+            else:
+                if comm.Get_rank() == 0:
+                    self.generate_distgen(filename, cache = cache)
+                    info = (self._charge, self._init_energy, self._coords.shape[1])
+                else:
+                    info = None
+                self._charge, self._init_energy, n_particle = comm.bcast(info, root = 0)
+                if comm.Get_rank() != 0:
+                    self._set_coords(np.empty((6, n_particle)))
+                comm.Bcast(self._coords, root = 0)
 
         else:
             ParticleGroup_h5 = input_beam['ParticleGroup_h5']
@@ -53,7 +76,7 @@ class Beam():
             self._charge = pg['charge']
             self._init_energy = np.mean(pg['energy'])
 
-            self.particle = openpmd_to_bmadx_particles(pg, self._init_energy, 0.0, MC2)  # Bmad X particle
+            self._set_coords(self.coords_from_openpmd(pg))  # Bmad X coords
             #self.particleGroup = pg  # Particle Group
 
             # unchanged, initial energy and gamma
@@ -63,21 +86,84 @@ class Beam():
         self.position = 0
         self.step = 0
 
+        self._s = 0.0
+        self._moments = None
+        self._coords_swap = None   # second buffer for the linear tracking, allocated on first use
+        # MPI communicator if the particles are distributed over ranks, see distribute()
+        self.comm = None
+        self._n_particle = len(self._rows[0])
+        self._moment_shift = np.zeros(6)
+
         self.update_status()
 
 
+    def _set_coords(self, coords):
+        """
+        :param coords: (6, N) contiguous buffer of bmadx coords, owned by the beam from now on
+        """
+        self._coords = coords
+        self._rows = tuple(coords)
+
+    def generate_distgen(self, filename, cache = False):
+        """
+        run distgen and set the charge, energy and coords of the beam.
+        :param cache: if set, the beam is stored in the local cache (tools.cache_dir()), keyed by the hash of the
+                      distgen input file content (including the seed) and the distgen version, and loaded from
+                      it if it is already there. Files referenced by the distgen input are not part of the key
+        """
+        if cache:
+            key = 'distgen-' + yaml_hash(filename, extra = distgen.__version__)
+            cached = load_cache(key)
+            if cached is not None:
+                arrays, metadata = cached
+                self._charge = metadata['charge']
+                self._init_energy = metadata['energy']
+                # writable copy of the read-only memory mapped coordinates, the beam is tracked and kicked in place
+                self._set_coords(np.array(arrays['coords'], dtype=np.float64))
+                return
+
+        gen = Generator(filename)
+        gen.run()
+        pg = gen.particles
+        self._charge = pg['charge']
+        self._init_energy = np.mean(pg['energy'])
+
+        self._set_coords(self.coords_from_openpmd(pg))   #Bmad X coords
+        #self.particleGroup = pg              # Particle Group
+
+        if cache:
+            save_cache(key, {'coords': self._coords}, {'charge': float(self._charge), 'energy': float(self._init_energy),
+                                                       'distgen_input_file': filename})
+
+    def coords_from_openpmd(self, pg):
+        """
+        :return: (6, N) contiguous buffer of bmadx coords (x, px, y, py, z, pz) of a ParticleGroup
+        """
+        coords = np.empty((6, len(pg)))
+        for row, c in zip(coords, openpmd_to_bmadx_coords(pg, self._init_energy)):
+            row[:] = c
+        return coords
+
     def check_inputs(self, input_beam):
         assert 'style' in input_beam, 'ERROR: input_beam must have keyword <style>'
+        optional_inputs = ['verbose']
         if input_beam['style'] == 'from_file':
             self.required_inputs = ['style', 'beamfile', 'charge','energy']
+            optional_inputs += ['beamfile_format', 'beamfile_dtype']
+            if 'beamfile' in input_beam and \
+                    input_beam.get('beamfile_format', beamfile_format(input_beam['beamfile'])) == 'openpmd':
+                # read from the file if not given
+                self.required_inputs = ['style', 'beamfile']
+                optional_inputs += ['charge', 'energy']
         elif input_beam['style'] == 'distgen':
             self.required_inputs = ['style', 'distgen_input_file']
+            optional_inputs += ['distgen_cache']
         elif input_beam['style'] == 'ParticleGroup':
             self.required_inputs = ['style', 'ParticleGroup_h5']
         else:
             raise Exception("input beam parsing Error: invalid input style")
 
-        allowed_params = self.required_inputs + ['verbose']
+        allowed_params = self.required_inputs + optional_inputs
         for input_param in input_beam:
             assert input_param in allowed_params, f'Incorrect param given to {self.__class__.__name__}.__init__(**kwargs): {input_param}\nAllowed params: {allowed_params}'
 
@@ -87,6 +173,9 @@ class Beam():
 #    @profile
     def update_status(self):
         #self.particleGroup = bmadx_particles_to_openpmd(self.particle)
+        # One pass over the particles, all the statistics below are read from the cached moments
+        moments = self.moments
+        self._moment_shift = moments.mean
         self._sigma_x = self.sigma_x
         self._sigma_z = self.sigma_z
         self._slope = self.slope
@@ -98,62 +187,168 @@ class Beam():
         #self._mean_energy = self.mean_energy
 
  #   @profile
-    def track(self, element, step_size, update_step=True):
-        self.particle = track_element(self.particle, element)
+    def track(self, element, step_size, update_step=True, n_steps=1):
+        """
+        :param element: bmadx element, or a 7*7 affine transfer map (see CSR2D.build_linear_map)
+        :param n_steps: number of steps covered by this track
+        """
+        if isinstance(element, np.ndarray):
+            self.apply_linear_map(element)
+            self._s += step_size
+        else:
+            # the beam adopts the coordinate arrays of the tracked Particle
+            self.particle = track_element(self.particle, element)
         self.position += step_size
         if update_step:
-            self.step += 1
+            self.step += n_steps
         self.update_status()
+    def apply_linear_map(self, M):
+        """
+        Track the particles with a linear map, as one matrix product over the coordinate buffer
+        :param M: 7*7 affine transfer map, the 6*6 transfer matrix and the constant term in the last column
+        """
+        coords = self.coords
+        if self._coords_swap is None or self._coords_swap.shape != coords.shape:
+            self._coords_swap = np.empty_like(coords)
+        out = self._coords_swap
+        np.dot(M[:6, :6], coords, out=out)
+        if M[:6, 6].any():
+            out += M[:6, 6:]
+        self._coords_swap = coords
+        self._set_coords(out)
+        self._moments = None
+
   #  @profile
     def apply_wakes(self, dE_dct, x_kick, xrange, zrange, step_size, transverse_on):
+        """
+        Apply the CSR kicks to the particles in place
+        :param dE_dct, x_kick: wakes on the (xrange, zrange) mesh, where xrange is in x_transform
+        :param xrange, zrange: evenly spaced 1D grids
+        """
         # Todo: add options for transverse or longitudinal kick only
         dE_E1 = step_size * dE_dct * 1e6 / self.init_energy  # self.energy in eV
-        interp = RegularGridInterpolator((xrange, zrange), dE_E1, fill_value=0.0, bounds_error=False)
-        dE_Es = interp(np.array([self.x_transform, self.z]).T)
-        #self.particle.pz += dE_Es
-        pz_new = self.particle.pz + dE_Es
-
-        if transverse_on:
-            dxp = step_size * x_kick * 1e6 / self.init_energy
-            interp = RegularGridInterpolator((xrange, zrange), dxp, fill_value=0.0, bounds_error=False)
-            dxps = interp(np.array([self.x_transform, self.z]).T)
-            #self.particle.px += dxps
-            px_new = self.particle.px + dxps
-        
-        else:
-            px_new = self.particle.px
+        dxp = step_size * x_kick * 1e6 / self.init_energy
+        slope = self.slope
+
+        apply_wake_kicks(self._rows[0], self._rows[4], self._rows[1], self._rows[5],
+                         slope[0], slope[1], dE_E1, dxp,
+                         xrange[0], zrange[0], (xrange[-1] - xrange[0]) / (len(xrange) - 1),
+                         (zrange[-1] - zrange[0]) / (len(zrange) - 1),
+                         bool(transverse_on))
 
-        self.particle = Particle(self.particle.x, px_new,
-                                 self.particle.y, self.particle.py,
-                                 self.particle.z, pz_new,
-                                 self.particle.s, self.particle.p0c, self.particle.mc2)
+        self._moments = None   # particles are kicked in place
+        self.update_status()
 
+    def distribute(self, comm):
+        """
+        Keep only the share of particles owned by this rank. Afterward, tracking and kicks act on the local
+        particles only, while all the beam statistics are reduced over comm.
+        :param comm: MPI communicator
+        """
+        count, displ = block_partition(self._n_particle, comm.Get_size())
+        rank = comm.Get_rank()
+        start, end = displ[rank], displ[rank] + count[rank]
+        self._set_coords(np.ascontiguousarray(self.coords[:, start:end]))
+        self._moments = None
+        self.comm = comm
         self.update_status()
 
-    def frog_leap(self):
-        # Todo: track half step, apply kicks, track another half step
-        pass
+    def gather_particle_group(self, root = 0):
+        """
+        Gather the distributed particles on root. Must be called by all ranks.
+        :return: ParticleGroup with all the particles on root, None on the other ranks
+        """
+        count = self.comm.gather(len(self.particle.x), root=root)
+        p = self.particle
+        coords = []
+        for c in (p.x, p.px, p.y, p.py, p.z, p.pz):
+            if self.comm.Get_rank() == root:
+                buf = np.empty(sum(count))
+                self.comm.Gatherv(np.ascontiguousarray(c), [buf, count], root=root)
+                coords.append(buf)
+            else:
+                self.comm.Gatherv(np.ascontiguousarray(c), None, root=root)
+        if self.comm.Get_rank() != root:
+            return None
+        particle = Particle(*coords, p.s, p.p0c, p.mc2)
+        return bmadx_particles_to_openpmd(particle, self.charge)
+
+    def frog_leap(self, first_half, second_half, step_size, kick):
+        """
+        second order drift-kick-drift step: track half step, apply kicks, track another half step
+        :param first_half, second_half: elements (or 7*7 affine transfer maps) of the two half steps.
+                                        Only the first one may include the entrance edge of an element
+        :param step_size: full step size
+        :param kick: callable evaluating and applying the kicks at the middle of the step
+        :return: the return value of kick
+        """
+        self.track(first_half, step_size/2, update_step=False)
+        out = kick()
+        self.track(second_half, step_size/2)
+        return out
+
+    @property
+    def coords(self):
+        """
+        (6, N) buffer of the bmadx coords (x, px, y, py, z, pz) of the local particles
+        """
+        if self._coords is None:
+            # pack the arrays adopted from the last tracking into one buffer
+            self._set_coords(np.array(self._rows))
+        return self._coords
+
+    @property
+    def particle(self):
+        """
+        BmadX Particle whose coordinates are the beam's own arrays (no copy). They alias the beam: the kicks
+        applied afterward modify them in place, copy them to keep a snapshot
+        """
+        return Particle(*self._rows, self._s, self._init_energy, MC2)
+
+    @particle.setter
+    def particle(self, particle):
+        # adopt the coordinate arrays of particle, no copy. They are packed into a (6, N) buffer only when needed
+        self._rows = (particle.x, particle.px, particle.y, particle.py, particle.z, particle.pz)
+        self._coords = None
+        self._s = particle.s
+        self._moments = None   # the particles changed, invalidate the cached moments
+
+    def copy_particle(self):
+        """
+        BmadX Particle with a copy of the coordinates, not changed by the tracking
+        """
+        return Particle(*np.array(self._rows), self._s, self._init_energy, MC2)
+
+    @property
+    def moments(self):
+        """
+        first and second moments of the beam, cached until the particles change
+        :return: BeamMoments
+        """
+        if self._moments is None:
+            self._moments = compute_moments(self.particle, shift=self._moment_shift, comm=self.comm)
+        return self._moments
 
     @property
     def mean_x(self):
-        return np.mean(self.particle.x)
+        return self.moments.mean_x
 
     @property
     def mean_y(self):
-        return np.mean(self.particle.y)
+        return self.moments.mean_y
 
     @property
     def sigma_x(self):
-        return np.std(self.particle.x)
+        return self.moments.sigma_x
 
 
     @property
     def sigma_z(self):
-        return np.std(self.particle.z)
+        return self.moments.sigma_z
 
     @property
     def mean_z(self):
-        return np.mean(self.particle.z)
+        return self.moments.mean_z
 
 
     @property
@@ -167,10 +362,10 @@ class Beam():
 
     @property
     def energy(self):
-        return (self.particle.pz+1)*self.particle.p0c
+        return (self.pz+1)*self._init_energy
     @property
     def mean_energy(self):
-        return np.mean(self.energy)
+        return self.moments.mean_energy
 
     @property
     def gamma(self):
@@ -178,30 +373,29 @@ class Beam():
 
     @property
     def sigma_energy(self):
-        return np.std(self.energy)
+        return self.moments.sigma_energy
 
     @property
     def x(self):
-        return self.particle.x
+        return self._rows[0]
 
     @property
     def px(self):
-        return self.particle.px
+        return self._rows[1]
 
     @property
     def z(self):
-        return self.particle.z
+        return self._rows[4]
 
     @property
     def pz(self):
-        return self.particle.pz
+        return self._rows[5]
 
 
 
     @property
     def slope(self):
-        p = np.polyfit(self.z, self.x, deg=1)
-        return p
+        return self.moments.slope
 
     @property
     def x_transform(self):
@@ -212,8 +406,19 @@ class Beam():
 
     @property
     def sigma_x_transform(self):
-        return np.std(self.x_transform)
+        return self.moments.sigma_x_transform
+
+    @property
+    def mean_x_transform(self):
+        return self.moments.mean_x_transform
+
 
+    @property
+    def n_particle(self):
+        """
+        total number of particles over all ranks
+        """
+        return self._n_particle
 
     @property
     def charge(self):
@@ -221,7 +426,7 @@ class Beam():
 
     @property
     def twiss(self):
-        return twiss_from_bmadx_particles(self.particle)
+        return self.moments.twiss
 
     @property
     def particle_group(self):
@@ -6,6 +6,9 @@ from collections import deque
 
 from scipy.interpolate import RegularGridInterpolator
 from scipy.signal import savgol_filter
+from mpi4py import MPI
+from .distributed import global_std
+from .interp1D import make_bin_table
 
 @jit(nopython = True)
 def histogram_cic_1d(q1, w, nbins, bins_start, bins_end):
@@ -104,6 +107,8 @@ class DF_tracker:
         self.z_grids = None
         self.start_time = 0.0
         self.t = 0.0
+        self.comm = None   # MPI communicator if the particles are distributed over ranks
+        self.slope = (0.0, 0.0)
 
         #params for DF log
         self.slope_log = deque([])
@@ -111,12 +116,14 @@ class DF_tracker:
         self.sigma_x_log = deque([])
         self.sigma_z_log = deque([])
         self.time_log = deque([])
+        self.index_log = deque([])     # global index of each DF, in deposition order
+        self.slice_count = 0
 
 
         #params for interpolant
         self.sigma_x_interp = None
         self.sigma_z_interp = None
-        # Todo: Add chirp
+        self.slope_interp = (0.0, 0.0)     # shear of the interpolant frame, x' = x - (slope[0]*z + slope[1])
         self.time_interp = deque([])
         self.density_interp = deque([])
         self.density_x_interp = deque([])
@@ -128,44 +135,92 @@ class DF_tracker:
         self.x_grid_interp = None
         self.z_grid_interp = None
 
+        # history_mode 'time_sliced': (rank, size, chunk). The time intervals of the history are dealt to the ranks
+        # in blocks of chunk, a rank only interpolates the slices bounding its own intervals
+        self.time_slicing = None
+        self.index_interp = deque([])    # global index of each slice of the interpolant
+        self.interp_generation = 0       # incremented when all the slices are interpolated again on new grids
+        self.current_interp = None
+        self.time_rows = None
+        self.time_owned = None
+
+        # MPI shared memory window holding the interpolant, for history_mode 'node_shared'
+        self._shared_win = None
+        self._shared_nbytes = 0
+
 
     def configure_params(self, xbins=100, zbins=100, xlim=5, zlim=5,
                          filter_order=0, filter_window=0,
-                         velocity_threhold=5, upper_limit = None):
+                         velocity_threhold=5, upper_limit = None, chirp_aligned = False):
         self.xbins = xbins
         self.zbins = zbins
         self.xlim = xlim
         self.zlim = zlim
         self.velocity_threhold = velocity_threhold
+        # deposit in the sheared frame x' = x - (slope[0]*z + slope[1]) aligned with the x-z chirp
+        self.chirp_aligned = chirp_aligned
 
         self.filter_order = filter_order
         self.filter_window = filter_window
         self.upper_limit = upper_limit
 
-    def get_DF(self, x, z, px, t):
+    def get_DF(self, x, z, px, t, slope = None, moments = None):
+        """
+        deposit the particles on a 2D grid and compute the density, velocity and their derivatives
+        :param slope: linear x-z chirp (polyfit(z, x, 1)) of the beam. Used for the deposition frame
+                      if self.chirp_aligned is set
+        :param moments: cached BeamMoments of the beam. If given, the slope and the beam sizes are read
+                        from it instead of being recomputed from the particles
+        """
         # Todo: add filter, add different depositing type
-        sigma_x = np.std(x)
-        sigma_z = np.std(z)
+        if moments is not None:
+            slope = moments.slope
+
+        if self.chirp_aligned and slope is not None:
+            # deposit in the sheared frame aligned with the chirp, x' = x - (a*z + b)
+            shear_a, shear_b = slope[0], slope[1]
+            x = x - (shear_a * z + shear_b)
+        else:
+            shear_a, shear_b = 0.0, 0.0
+
+        if moments is None:
+            assert self.comm is None, 'the moments of a distributed beam must be given'
+            sigma_x = np.std(x)
+            sigma_z = np.std(z)
+            self.xmean = np.mean(x)
+            self.zmean = np.mean(z)
+        elif self.chirp_aligned:
+            sigma_x = moments.sigma_x_transform
+            sigma_z = moments.sigma_z
+            self.xmean = moments.mean_x_transform
+            self.zmean = moments.mean_z
+        else:
+            sigma_x = moments.sigma_x
+            sigma_z = moments.sigma_z
+            self.xmean = moments.mean_x
+            self.zmean = moments.mean_z
         self.sigma_x = sigma_x
         self.sigma_z = sigma_z
-        self.xmean = np.mean(x)
-        self.zmean = np.mean(z)
-        npart = len(x)
-
-        #########test#######################
-        #Todo: coordinates transform for highly chirped case
-        slice_ind = np.argwhere(np.abs(z) < 0.1*sigma_z)
-        slice_sigX = np.std(x[slice_ind])
-        frac = sigma_x/slice_sigX
-        if frac > 5:
+
+        if self.chirp_aligned:
+            # the sheared frame already resolves the slice width, no fallback needed
             xbins_t = self.xbins
             zbins_t = self.zbins
             filter_window = self.filter_window
         else:
-            xbins_t = 100
-            zbins_t = 100
-            filter_window = 5
-            #print('frac', frac)
+            #########test#######################
+            slice_ind = np.argwhere(np.abs(z) < 0.1*sigma_z)
+            slice_sigX = np.std(x[slice_ind]) if self.comm is None else global_std(self.comm, x[slice_ind])
+            frac = sigma_x/slice_sigX
+            if frac > 5:
+                xbins_t = self.xbins
+                zbins_t = self.zbins
+                filter_window = self.filter_window
+            else:
+                xbins_t = 100
+                zbins_t = 100
+                filter_window = 5
+                #print('frac', frac)
 
         x_grids = np.linspace(self.xmean - self.xlim * sigma_x, self.xmean + self.xlim * sigma_x, xbins_t)
         z_grids = np.linspace(self.zmean - self.zlim * sigma_z, self.zmean + self.zlim * sigma_z, zbins_t)
@@ -180,6 +235,11 @@ class DF_tracker:
                               bins_end_1=self.xmean + self.xlim * sigma_x,
                               nbins_2= zbins_t, bins_start_2=self.zmean - self.zlim * sigma_z,
                               bins_end_2=self.zmean + self.zlim * sigma_z)
+        if self.comm is not None:
+            # every rank deposits its own particles, sum up the histograms
+            self.comm.Allreduce(MPI.IN_PLACE, density, op=MPI.SUM)
+            self.comm.Allreduce(MPI.IN_PLACE, vx, op=MPI.SUM)
+
         threshold = np.max(density) / self.velocity_threhold
         vx[density > threshold] /= density[density > threshold]
 
@@ -207,8 +267,8 @@ class DF_tracker:
 
 
 
-        # Todo: how to do it if apply coordiante tranformation?
-
+        # In the sheared frame, d/dx' = d/dx and d/dz' = d/dz + a*d/dx. The derivatives are converted
+        # back to lab frame below so that the CSR integrand is unchanged.
         density_x, density_z = np.gradient(density, x_grids, z_grids)
         vx_x, vx_z = np.gradient(vx, x_grids, z_grids)
 
@@ -223,6 +283,8 @@ class DF_tracker:
             x=savgol_filter(x=vx_x, window_length=filter_window, polyorder=self.filter_order, axis=0),
             window_length=filter_window, polyorder=self.filter_order, axis=1)
 
+        if shear_a != 0.0:
+            density_z = density_z - shear_a * density_x
 
         #density_x, density_z = sgolay2d(density, self.filter_window, self.filter_order, derivative='both')
         #density_x /= np.mean(np.diff(x_grids))
@@ -243,6 +305,7 @@ class DF_tracker:
         self.density_z = density_z
         self.vx_x = vx_x
         self.t = t
+        self.slope = (shear_a, shear_b)
 
     def append_DF(self):
         """
@@ -251,6 +314,9 @@ class DF_tracker:
         """
         self.DF_log.append((self.x_grids, self.z_grids, self.density, self.vx, self.density_x, self.density_z, self.vx_x))
         self.time_log.append(self.t)
+        self.index_log.append(self.slice_count)
+        self.slice_count += 1
+        self.slope_log.append(self.slope)
         self.sigma_x_log.append(self.sigma_x)
         self.sigma_z_log.append(self.sigma_z)
         self.end_time = self.t
@@ -265,6 +331,8 @@ class DF_tracker:
         while self.start_time < new_start_time:
             self.DF_log.popleft()
             self.time_log.popleft()
+            self.index_log.popleft()
+            self.slope_log.popleft()
             self.sigma_x_log.popleft()
             self.sigma_z_log.popleft()
             self.start_time = self.time_log[0]
@@ -277,6 +345,7 @@ class DF_tracker:
             self.vx_interp.popleft()
             self.vx_x_interp.popleft()
             self.time_interp.popleft()
+            self.index_interp.popleft()
             self.interp_start = self.time_interp[0]
 
 
@@ -287,13 +356,53 @@ class DF_tracker:
         """
         self.DF_log.pop()
         self.time_log.pop()
+        self.index_log.pop()
+        self.slice_count -= 1
+        self.slope_log.pop()
         self.sigma_x_log.pop()
         self.sigma_z_log.pop()
         self.end_time = self.time_log[-1]
 
 
 
-    def DF_interp(self, DF, x_grid_interp = None, z_grid_interp = None, x_grids = None, z_grids = None, fill_value = 0.0):
+    def owns_interval(self, k):
+        """
+        True if the time interval starting at the DF with global index k belongs to this rank
+        """
+        if self.time_slicing is None:
+            return True
+        rank, size, chunk = self.time_slicing
+        return (k // chunk) % size == rank
+
+    def holds_slice(self, k):
+        """
+        True if the DF with global index k bounds one of the time intervals of this rank
+        """
+        return self.owns_interval(k) or (k > 0 and self.owns_interval(k - 1))
+
+    def append_slice(self, index, slice_interp):
+        """
+        append the interpolated fields (density, density_x, density_z, vx, vx_x) of the DF with global index
+        to the interpolant, or a placeholder if the slice is not held by this rank
+        """
+        self.index_interp.append(index)
+        if not self.holds_slice(index):
+            slice_interp = (None,) * 5
+        self.density_interp.append(slice_interp[0])
+        self.density_x_interp.append(slice_interp[1])
+        self.density_z_interp.append(slice_interp[2])
+        self.vx_interp.append(slice_interp[3])
+        self.vx_x_interp.append(slice_interp[4])
+
+    def DF_interp(self, DF, x_grid_interp = None, z_grid_interp = None, x_grids = None, z_grids = None, fill_value = 0.0,
+                  slope = None):
+        """
+        interpolate a DF onto the interpolant grids
+        :param slope: shear (a, b) of the frame DF is deposited in. The interpolant grids are in the frame
+                      of self.slope_interp
+        """
+        if slope is None:
+            slope = self.slope
         if x_grids is None:
             x_grids = self.x_grids
         if z_grids is None:
@@ -304,6 +413,9 @@ class DF_tracker:
             z_grid_interp = self.z_grid_interp
 
         X, Z = np.meshgrid(x_grid_interp, z_grid_interp, indexing = 'ij')
+        # map the interpolant frame to the frame of DF: x'_DF = x'_interp + (a_interp - a)*z + (b_interp - b)
+        if slope[0] != self.slope_interp[0] or slope[1] != self.slope_interp[1]:
+            X = X + (self.slope_interp[0] - slope[0]) * Z + (self.slope_interp[1] - slope[1])
         #Todo: check this 2D interpolation
         interp = RegularGridInterpolator((x_grids, z_grids), DF, method='linear', fill_value = fill_value, bounds_error=False)
         return interp((X,Z))
@@ -320,8 +432,9 @@ class DF_tracker:
 
         if self.sigma_x_interp and self.sigma_z_interp and \
                 2 > self.sigma_x/self.sigma_x_interp > 1/2 and \
-                    2 > self.sigma_z/self.sigma_z_interp > 1 / 2:
-            # Not too much change in beam size (and chirp in the future), just interp with current interp configuration
+                    2 > self.sigma_z/self.sigma_z_interp > 1 / 2 and \
+                        self.shear_drift() < 0.5 * self.sigma_x_interp:
+            # Not too much change in beam size and chirp, just interp with current interp configuration
             self.time_interp.append(self.t)
             #self.x_grid_interp = np.linspace(self.xmean-xlim_interp*self.sigma_x_interp, self.xmean + xlim_interp*self.sigma_x_interp, xbins)
             #self.z_grid_interp = np.linspace(self.zmean-zlim_interp*self.sigma_z_interp, self.zmean + zlim_interp*self.sigma_z_interp, zbins)
@@ -330,11 +443,10 @@ class DF_tracker:
             current_density_z_interp = self.DF_interp(DF = self.density_z)
             current_vx_interp = self.DF_interp(DF = self.vx)
             current_vx_x_interp = self.DF_interp(DF = self.vx_x, fill_value=np.mean(self.vx_x))
-            self.density_interp.append(current_density_interp)
-            self.density_x_interp.append(current_density_x_interp)
-            self.density_z_interp.append(current_density_z_interp)
-            self.vx_interp.append(current_vx_interp)
-            self.vx_x_interp.append(current_vx_x_interp)
+            # the newest slice is kept on all ranks, for the velocity at the observation points
+            self.current_interp = (current_density_interp, current_density_x_interp, current_density_z_interp,
+                                   current_vx_interp, current_vx_x_interp)
+            self.append_slice(self.index_log[-1], self.current_interp)
 
         else:
             #Todo: hard code from matlab. Consider change in the future
@@ -364,6 +476,7 @@ class DF_tracker:
 
             self.sigma_x_interp = max_sigma_x
             self.sigma_z_interp = max_sigma_z
+            self.slope_interp = self.slope
 
             self.x_grid_interp = np.linspace(self.xmean-5*self.sigma_x_interp, self.xmean + 5*self.sigma_x_interp, xbins)
             self.z_grid_interp = np.linspace(self.zmean -5* self.sigma_z_interp, self.zmean + 5* self.sigma_z_interp, zbins)
@@ -375,26 +488,42 @@ class DF_tracker:
             self.vx_interp = deque([])
             self.vx_x_interp = deque([])
             self.time_interp = self.time_log.copy()
-
-            for x_grids, z_grids, density, vx, density_x, density_z, vx_x in self.DF_log:
-                current_density_interp = self.DF_interp(DF=density, x_grids = x_grids, z_grids = z_grids)
-                current_density_x_interp = self.DF_interp(DF=density_x, x_grids = x_grids, z_grids = z_grids)
-                current_density_z_interp = self.DF_interp(DF=density_z, x_grids = x_grids, z_grids = z_grids)
-                current_vx_interp = self.DF_interp(DF=vx, x_grids = x_grids, z_grids = z_grids)
-                current_vx_x_interp = self.DF_interp(DF=vx_x, x_grids = x_grids, z_grids = z_grids, fill_value=np.mean(vx_x))
-
-                self.density_interp.append(current_density_interp)
-                self.density_x_interp.append(current_density_x_interp)
-                self.density_z_interp.append(current_density_z_interp)
-                self.vx_interp.append(current_vx_interp)
-                self.vx_x_interp.append(current_vx_x_interp)
+            self.index_interp = deque([])
+            self.interp_generation += 1
+
+            for (x_grids, z_grids, density, vx, density_x, density_z, vx_x), slope, index in zip(self.DF_log, self.slope_log,
+                                                                                                 self.index_log):
+                if not (self.holds_slice(index) or index == self.index_log[-1]):
+                    self.append_slice(index, None)
+                    continue
+                current_density_interp = self.DF_interp(DF=density, x_grids = x_grids, z_grids = z_grids, slope = slope)
+                current_density_x_interp = self.DF_interp(DF=density_x, x_grids = x_grids, z_grids = z_grids, slope = slope)
+                current_density_z_interp = self.DF_interp(DF=density_z, x_grids = x_grids, z_grids = z_grids, slope = slope)
+                current_vx_interp = self.DF_interp(DF=vx, x_grids = x_grids, z_grids = z_grids, slope = slope)
+                current_vx_x_interp = self.DF_interp(DF=vx_x, x_grids = x_grids, z_grids = z_grids, fill_value=np.mean(vx_x),
+                                                     slope = slope)
+
+                self.current_interp = (current_density_interp, current_density_x_interp, current_density_z_interp,
+                                       current_vx_interp, current_vx_x_interp)
+                self.append_slice(index, self.current_interp)
 
             #print('Re-interpolation finished!')
 
 
-    def build_interpolant(self):
+    def shear_drift(self):
+        """
+        maximum shift in x between the frame of the current DF and the interpolant frame over +/- 5 sigma_z
+        :return:
+        """
+        return np.abs(self.slope[0] - self.slope_interp[0]) * 5 * self.sigma_z_interp + \
+            np.abs(self.slope[1] - self.slope_interp[1])
+
+    def build_interpolant(self, node_comm = None):
         """
         build interpolant for CSR intergration with the 3D matrix self.*_interp
+        :param node_comm: (opt) communicator of the ranks of a node, for history_mode 'node_shared'. Rank 0 of
+                          node_comm, which keeps the history, builds the interpolant directly in an MPI shared
+                          memory window, the other ranks map the window without a copy. Collective on node_comm
         :return:
         """
         #Todo: check fill value
@@ -413,20 +542,96 @@ class DF_tracker:
         #                                           self.vx_interp, fill_value= 0.0,bounds_error=False)
         #self.F_vx_x= RegularGridInterpolator((self.time_interp, self.x_grid_interp, self.z_grid_interp),
         #                                           self.vx_x_interp, fill_value= 0.0,bounds_error=False)
-        self.min_x, self.max_x = self.time_interp[0], self.time_interp[-1]
-        self.min_y, self.max_y = self.x_grid_interp[0], self.x_grid_interp[-1]
-        self.min_z, self.max_z = self.z_grid_interp[0], self.z_grid_interp[-1]
-        self.delta_x = (self.max_x - self.min_x) / (len(self.time_interp) - 1)
-        self.delta_y = (self.max_y - self.min_y) / (self.x_grid_interp.shape[0] - 1)
-        self.delta_z =  (self.max_z - self.min_z) / (self.z_grid_interp.shape[0] - 1)
-        self.data_density_interp = np.array(self.density_interp)
-        self.data_density_z_interp = np.array(self.density_z_interp)
-        self.data_density_x_interp = np.array(self.density_x_interp)
-        self.data_vx_interp = np.array(self.vx_interp)
-        self.data_vx_x_interp = np.array(self.vx_x_interp)
-
-
-
-
+        leader = node_comm is None or node_comm.Get_rank() == 0
+        if leader:
+            self.min_x, self.max_x = self.time_interp[0], self.time_interp[-1]
+            self.min_y, self.max_y = self.x_grid_interp[0], self.x_grid_interp[-1]
+            self.min_z, self.max_z = self.z_grid_interp[0], self.z_grid_interp[-1]
+            self.delta_x = (self.max_x - self.min_x) / (len(self.time_interp) - 1)
+            self.delta_y = (self.max_y - self.min_y) / (self.x_grid_interp.shape[0] - 1)
+            self.delta_z =  (self.max_z - self.min_z) / (self.z_grid_interp.shape[0] - 1)
+            self.shear_a, self.shear_b = self.slope_interp
+            # The DFs are not equally spaced in time (split steps at the element boundaries, variable step sizes,
+            # split integrator). The time interval is looked up in a table
+            time_grid = np.array(self.time_interp, dtype = np.float64)
+            time_table, self.time_step = make_bin_table(time_grid)
+            # With a time-sliced history, only the slices held by this rank
+            nt = len(self.time_interp)
+            held = [i for i in range(nt) if self.density_interp[i] is not None]
+            fields = (self.density_interp, self.density_x_interp, self.density_z_interp, self.vx_interp, self.vx_x_interp)
+            shape = (len(held), len(self.x_grid_interp), len(self.z_grid_interp), len(fields))
+
+        if node_comm is None:
+            self.data_fields_interp = np.empty(shape)
+            self.time_grid, self.time_table = time_grid, time_table
+        else:
+            meta = None
+            if leader:
+                meta = {'shape': shape, 'ntable': len(time_table),
+                        'scalars': {name: getattr(self, name) for name in ('min_x', 'max_x', 'min_y', 'max_y', 'min_z',
+                                                                            'max_z', 'delta_x', 'delta_y', 'delta_z',
+                                                                            'shear_a', 'shear_b', 'time_step')}}
+            meta = node_comm.bcast(meta, root=0)
+            self.map_shared_interpolant(node_comm, meta['shape'], meta['ntable'])
+            if leader:
+                self.time_grid[...] = time_grid
+                self.time_table[...] = time_table
+            else:
+                for name, value in meta['scalars'].items():
+                    setattr(self, name, value)
+
+        # the 5 fields in one array (time, x, z, field) for interpolate_fields. data_*_interp are views of it
+        if leader:
+            for f, field in enumerate(fields):
+                for row, i in enumerate(held):
+                    self.data_fields_interp[row, :, :, f] = field[i]
+        if node_comm is not None:
+            node_comm.Barrier()
+        self.data_density_interp = self.data_fields_interp[..., 0]
+        self.data_density_x_interp = self.data_fields_interp[..., 1]
+        self.data_density_z_interp = self.data_fields_interp[..., 2]
+        self.data_vx_interp = self.data_fields_interp[..., 3]
+        self.data_vx_x_interp = self.data_fields_interp[..., 4]
+
+        if self.time_slicing is None:
+            self.time_rows = None
+            self.time_owned = None
+        else:
+            self.time_rows = np.full(nt, -1, dtype = np.int64)
+            self.time_rows[held] = np.arange(len(held))
+            self.time_owned = np.array([self.owns_interval(k) for k in self.index_interp], dtype = np.bool_)
 
+        # the newest slice alone, for the velocity at the observation points
+        if self.time_slicing is None or (held and held[-1] == nt - 1):
+            self.current_fields = self.data_fields_interp[-1:]
+        else:
+            self.current_fields = np.stack(self.current_interp, axis = -1)[np.newaxis]
+        self.current_time = self.time_grid[-1:]
+        self.current_table, self.current_step = make_bin_table(self.current_time)
 
+    def map_shared_interpolant(self, node_comm, shape, ntable):
+        """
+        Point data_fields_interp, time_grid and time_table to the MPI shared memory window of the node. The
+        window is reallocated, with some room to grow, when the history outgrows it. Collective on node_comm
+        :param node_comm: communicator of the ranks sharing memory, from comm.Split_type(MPI.COMM_TYPE_SHARED)
+        :param shape: shape of data_fields_interp
+        :param ntable: length of time_table
+        """
+        nfield = int(np.prod(shape))
+        nt = shape[0]
+        nbytes = 8 * (nfield + nt + ntable)
+
+        # the readers may still use the previous interpolant
+        node_comm.Barrier()
+        if nbytes > self._shared_nbytes:
+            # the history grows by one slice per step, reserve some room to avoid a reallocation each step
+            if self._shared_win is not None:
+                self._shared_win.Free()
+            self._shared_nbytes = int(1.5 * nbytes)
+            leader = node_comm.Get_rank() == 0
+            self._shared_win = MPI.Win.Allocate_shared(self._shared_nbytes if leader else 0, 1, comm=node_comm)
+        buf, _ = self._shared_win.Shared_query(0)
+        buf = np.ndarray(buffer=buf, dtype=np.uint8, shape=(self._shared_nbytes,))
+        self.data_fields_interp = buf[:8 * nfield].view(np.float64).reshape(shape)
+        self.time_grid = buf[8 * nfield:8 * (nfield + nt)].view(np.float64)
+        self.time_table = buf[8 * (nfield + nt):nbytes].view(np.int64)
@@ -0,0 +1,59 @@
+import numpy as np
+from mpi4py import MPI
+
+
+def block_partition(work_size, mpi_size):
+    """
+    Split work_size items into mpi_size contiguous blocks of (almost) equal size
+    :return: count, displ. count[p] items starting at displ[p] belong to rank p
+    """
+    ave, res = divmod(work_size, mpi_size)
+    count = [ave + 1 if p < res else ave for p in range(mpi_size)]
+    displ = [sum(count[:p]) for p in range(mpi_size)]
+    return count, np.array(displ)
+
+
+def weighted_partition(cost, mpi_size):
+    """
+    Split the items into mpi_size contiguous blocks of (almost) equal total cost. An item goes to the block
+    the middle of its cost falls in
+    :param cost: (work_size,) estimated cost of each item, e.g. measured in the previous step
+    :return: count, displ as block_partition
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    total = np.sum(cost)
+    if not total > 0:
+        return block_partition(len(cost), mpi_size)
+    centers = np.cumsum(cost) - cost / 2
+    bounds = np.searchsorted(centers, total * np.arange(1, mpi_size) / mpi_size)
+    edges = np.concatenate(([0], bounds, [len(cost)]))
+    count = [int(c) for c in np.diff(edges)]
+    return count, edges[:-1]
+
+
+def allreduce_sum(comm, value):
+    """
+    Sum a scalar or an array over all ranks of comm
+    :return: float64 array with the same shape as value
+    """
+    buf = np.array(value, dtype=np.float64)
+    comm.Allreduce(MPI.IN_PLACE, buf, op=MPI.SUM)
+    return buf
+
+
+def global_mean(comm, a):
+    """
+    mean of an array distributed over the ranks of comm
+    """
+    n, total = allreduce_sum(comm, [len(a), np.sum(a)])
+    return total / n
+
+
+def global_std(comm, a):
+    """
+    standard deviation (ddof = 0, as np.std) of an array distributed over the ranks of comm
+    """
+    mean = global_mean(comm, a)
+    n, total = allreduce_sum(comm, [len(a), np.sum((a - mean) ** 2)])
+    return np.sqrt(total / n)
+
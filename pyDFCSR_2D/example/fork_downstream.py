@@ -0,0 +1,49 @@
+"""
+Run the upstream part of a lattice once, then fork several runs with different settings of one downstream
+element from a snapshot of the state before that element.
+
+Run from the example directory:
+
+python fork_downstream.py input/chicane_config.yaml --element B4 --key angle --values 0.045 0.0483 0.05
+
+The modified lattices are written to the workdir. Only the element and the elements after it may change.
+"""
+import argparse
+import os
+
+from pyDFCSR_2D import CSR2D
+from pyDFCSR_2D.yaml_parser import parse_yaml, ordered_dump
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Fork downstream lattice variants from one upstream run")
+    parser.add_argument("input_file", help="input_file")
+    parser.add_argument("--element", required=True, help="first element that differs between the variants")
+    parser.add_argument("--key", required=True, help="parameter of the element, e.g. angle or L")
+    parser.add_argument("--values", type=float, nargs='+', required=True)
+    parser.add_argument("--workdir", default='./output/fork')
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    config = parse_yaml(args.input_file)
+    lattice = parse_yaml(config['input_lattice']['lattice_input_file'])
+
+    upstream = CSR2D(input_file=args.input_file)
+    upstream.run(stop_element=args.element)
+
+    for value in args.values:
+        name = f'{args.element}_{args.key}_{value:g}'
+        lattice[args.element][args.key] = value
+        lattice_file = os.path.join(args.workdir, f'{name}_lattice.yaml')
+        with open(lattice_file, 'w') as f:
+            ordered_dump(lattice, f)
+
+        fork = upstream.snapshot(write_name=name)
+        fork.CSR_params.workdir = os.path.abspath(args.workdir)
+        fork.replace_lattice({'lattice_input_file': lattice_file})
+        fork.run()
+        stats = fork.statistics
+        step = fork.beam.step
+        print(f"{name}: sigma_energy = {stats['sigma_energy'][step]:.6e}, "
+              f"norm_emit_x = {stats['twiss']['norm_emit_x'][step]:.6e}")
@@ -0,0 +1,76 @@
+"""
+Convergence of the final beam statistics with the lattice step size, for the 'kick' integrator
+(CSR kick after the full step) and the 'split' integrator (drift-kick-drift).
+
+Run from the example directory:
+
+python integrator_convergence.py input/dipole_config.yaml
+
+The error of each run is measured against a reference run with the split integrator and the smallest step size.
+Element lengths of the lattice should be multiples of the step sizes, and nsep = 1 in all elements.
+"""
+import argparse
+import os
+
+import numpy as np
+
+from pyDFCSR_2D import CSR2D
+from pyDFCSR_2D.yaml_parser import parse_yaml, ordered_dump
+
+
+def write_case(config, lattice, step_size, integrator, workdir):
+    """
+    write the config and lattice yaml of one case
+    :return: path of the config file
+    """
+    name = f'{integrator}_{step_size:g}'
+    lattice = lattice.copy()
+    lattice['step_size'] = step_size
+    lattice_file = os.path.join(workdir, f'{name}_lattice.yaml')
+    with open(lattice_file, 'w') as f:
+        ordered_dump(lattice, f)
+
+    config = config.copy()
+    config['input_lattice'] = {'lattice_input_file': lattice_file}
+    CSR_computation = dict(config['CSR_computation'])
+    CSR_computation.update({'integrator': integrator, 'write_beam': None, 'write_wakes': False,
+                            'write_name': name, 'workdir': workdir})
+    config['CSR_computation'] = CSR_computation
+    config_file = os.path.join(workdir, f'{name}_config.yaml')
+    with open(config_file, 'w') as f:
+        ordered_dump(config, f)
+    return config_file
+
+
+def final_statistics(config_file):
+    CSR = CSR2D(input_file=config_file)
+    CSR.run()
+    stats = CSR.statistics
+    step = CSR.beam.step
+    return np.array([stats['mean_energy'][step], stats['sigma_energy'][step], stats['mean_x'][step],
+                     stats['sigma_x'][step], stats['twiss']['norm_emit_x'][step]])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Step size convergence of the CSR integrators")
+    parser.add_argument("input_file", help="input_file")
+    parser.add_argument("--step_sizes", type=float, nargs='+', default=[0.1, 0.05, 0.025])
+    parser.add_argument("--reference_step_size", type=float, default=0.0125)
+    parser.add_argument("--workdir", default='./output/convergence')
+    args = parser.parse_args()
+
+    config = parse_yaml(args.input_file)
+    lattice = parse_yaml(config['input_lattice']['lattice_input_file'])
+    os.makedirs(args.workdir, exist_ok=True)
+
+    ref = final_statistics(write_case(config, lattice, args.reference_step_size, 'split', args.workdir))
+
+    labels = ['mean_energy', 'sigma_energy', 'mean_x', 'sigma_x', 'norm_emit_x']
+    print('relative error w.r.t. split integrator with step size', args.reference_step_size)
+    print('{:>10s} {:>8s} '.format('integrator', 'step') + ' '.join(f'{l:>13s}' for l in labels))
+    for integrator in ['kick', 'split']:
+        for step_size in args.step_sizes:
+            out = final_statistics(write_case(config, lattice, step_size, integrator, args.workdir))
+            err = np.abs(out - ref) / np.abs(ref)
+            print('{:>10s} {:>8g} '.format(integrator, step_size) + ' '.join(f'{e:13.3e}' for e in err))
@@ -10,6 +10,104 @@ import sys
 
 
 from pmd_beamphysics import ParticleGroup
+from pmd_beamphysics.readers import particle_array, particle_paths
+import h5py
+
+# number of particles read at once by the chunked readers below
+CHUNK_SIZE = 1000000
+
+
+def beamfile_format(filename):
+    """
+    guess the format of a beam file from its extension: 'npy', 'raw' (.bin, .raw), 'openpmd' (.h5, .hdf5)
+    or 'text' (np.loadtxt)
+    """
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if ext == 'npy':
+        return 'npy'
+    elif ext in ('bin', 'raw'):
+        return 'raw'
+    elif ext in ('h5', 'hdf5'):
+        return 'openpmd'
+    return 'text'
+
+
+def read_binary_coords(filename, format, dtype = np.float64, chunk_size = CHUNK_SIZE):
+    """
+    Read bmadx coords (x, px, y, py, z, pz) from a binary file without loading it whole in memory.
+    The file is memory mapped and copied chunk by chunk into a float64 buffer.
+        Parameters:
+            format (str): 'npy', array of shape (N, 6) or (6, N)
+                          'raw', 6*N values of dtype, one row per coordinate (C order)
+            dtype: dtype of the raw file, float64 or float32
+        Returns:
+            coords (6, N) contiguous float64 array
+    """
+    if format == 'npy':
+        data = np.load(filename, mmap_mode='r')
+        assert data.ndim == 2 and 6 in data.shape, f'Error: input beam must have 6 dimension, but get shape {data.shape} instead'
+        # (N, 6) as written by np.savetxt/np.save of the particles, or (6, N) as the Beam buffer
+        data = data.T if data.shape[1] == 6 else data
+    elif format == 'raw':
+        data = np.memmap(filename, dtype=np.dtype(dtype), mode='r')
+        assert data.size % 6 == 0, f'Error: raw beam file size {data.size} is not a multiple of 6'
+        data = data.reshape(6, -1)
+    else:
+        raise ValueError(f'Unknown binary beam file format {format}')
+
+    n = data.shape[1]
+    coords = np.empty((6, n), dtype=np.float64)
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        coords[:, start:end] = data[:, start:end]
+    return coords
+
+
+def read_openpmd_bmadx_coords(filename, p0c = None, chunk_size = CHUNK_SIZE, mc2 = M_ELECTRON):
+    """
+    Read bmadx coords from an openPMD-beamphysics HDF5 file, column by column in chunks, without
+    building a ParticleGroup. The first iteration of the file is read, it must have a single species.
+
+        Parameters:
+            p0c (float): reference momentum in eV. If None, the mean energy of the particles
+                         (as np.mean(ParticleGroup['energy']))
+
+        Returns:
+            coords (6, N) contiguous float64 array, p0c, total charge (C)
+    """
+    with h5py.File(filename, 'r') as h5:
+        g = h5[particle_paths(h5)[0]]
+        if 'position' not in g:
+            species = list(g)
+            assert len(species) == 1, f'Error: {filename} must have a single species, but has {species}'
+            g = g[species[0]]
+        n = int(np.ravel(g.attrs['numParticles'])[0])
+        charge = float(g.attrs['totalCharge'] * g.attrs['chargeUnitSI'])
+
+        # px, py in eV/c and the total momentum p in the pz row first, normalized to p0c below
+        coords = np.empty((6, n), dtype=np.float64)
+        for start in range(0, n, chunk_size):
+            sl = slice(start, min(start + chunk_size, n))
+            coords[0, sl] = particle_array(g, 'x', slice=sl)
+            coords[1, sl] = particle_array(g, 'px', slice=sl)
+            coords[2, sl] = particle_array(g, 'y', slice=sl)
+            coords[3, sl] = particle_array(g, 'py', slice=sl)
+            coords[4, sl] = particle_array(g, 'z', slice=sl)
+            coords[5, sl] = np.sqrt(coords[1, sl] ** 2 + coords[3, sl] ** 2 + particle_array(g, 'pz', slice=sl) ** 2)
+
+    if p0c is None:
+        energy = 0.0
+        for start in range(0, n, chunk_size):
+            energy += np.sum(np.sqrt(coords[5, start:start + chunk_size] ** 2 + mc2 ** 2))
+        p0c = energy / n
+
+    coords[1] /= p0c
+    coords[3] /= p0c
+    coords[5] /= p0c
+    coords[5] -= 1.0
+    return coords, p0c, charge
+
+
 def openpmd_to_bmadx_coords(
         pmd_particle: ParticleGroup,
         p0c
@@ -120,3 +218,10 @@ def bmadx_particles_to_openpmd(particle: Particle, charge):
 
     return ParticleGroup(data=dat)
 
+
+def write_particles(particle: Particle, charge, filename):
+    """
+    Write a bmadx Particle to an openPMD file, e.g. in the background writer
+    """
+    bmadx_particles_to_openpmd(particle, charge).write(filename)
+
@@ -36,6 +36,82 @@ def interpolate1D(xval, data, min_x, delta_x):
     return result
 
 
+@jit(nopython = True,  cache = True)
+def build_bin_table(grid, table_size):
+    """
+    Lookup table of the intervals of a non-uniform, increasing grid: table[k] is the index i of the
+    interval grid[i] <= grid[0] + k*table_step < grid[i + 1], with table_step = (grid[-1] - grid[0])/(table_size - 1)
+    """
+    table = np.zeros(table_size, dtype = np.int64)
+    n = len(grid)
+    if table_size == 1:
+        return table
+    table_step = (grid[n - 1] - grid[0]) / (table_size - 1)
+    i = 0
+    for k in range(table_size):
+        x = grid[0] + k * table_step
+        while i < n - 2 and grid[i + 1] <= x:
+            i += 1
+        table[k] = i
+    return table
+
+
+def make_bin_table(grid, max_per_interval = 8):
+    """
+    lookup table for find_bin, as fine as the smallest interval of grid but with at most
+    max_per_interval entries per interval on average
+    :return: table, table_step
+    """
+    n = len(grid)
+    if n < 2:
+        return np.zeros(1, dtype = np.int64), 1.0
+    span = grid[-1] - grid[0]
+    min_interval = np.min(np.diff(grid))
+    if min_interval * max_per_interval * n < span:
+        table_size = max_per_interval * n
+    else:
+        table_size = int(np.ceil(span / min_interval)) + 1
+    return build_bin_table(grid, table_size), span / (table_size - 1)
+
+
+@jit(nopython = True,  cache = True)
+def find_bin(x, grid, table, table_step):
+    """
+    index i of the interval grid[i] <= x < grid[i + 1] of a non-uniform grid, x in [grid[0], grid[-1]].
+    Table lookup, then move to the right interval if the table is coarser than the grid
+    """
+    n = len(grid)
+    i = table[min(int((x - grid[0]) / table_step), len(table) - 1)]
+    while i < n - 2 and grid[i + 1] <= x:
+        i += 1
+    return i
+
+
+@jit(nopython = True,  cache = True)
+def interpolate1D_fields(xval, data, grid, table, table_step):
+    """
+    Linear interpolation of all the columns of data (len(grid), nfield) on a non-uniform grid in one pass.
+    The intervals are looked up with table (see make_bin_table). Points outside the grid are zero
+    :return: (len(xval), nfield)
+    """
+    n, n_field = data.shape[0], data.shape[1]
+    result = np.zeros((len(xval), n_field))
+    for i in range(len(xval)):
+        x = xval[i]
+        if not (grid[0] <= x <= grid[n - 1]):
+            continue
+        if n == 1:
+            for f in range(n_field):
+                result[i, f] = data[0, f]
+            continue
+        x0 = find_bin(x, grid, table, table_step)
+        dx = grid[x0 + 1] - grid[x0]
+        xd = (x - grid[x0]) / dx if dx > 0 else 0.0
+        for f in range(n_field):
+            result[i, f] = data[x0, f] * (1 - xd) + data[x0 + 1, f] * xd
+    return result
+
+
 @jitclass(spec)
 class LinearInterpolator:
     def __init__(self, data, x):
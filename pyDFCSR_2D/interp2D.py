@@ -0,0 +1,34 @@
+from numba import jit
+
+
+@jit(nopython = True, cache = True)
+def apply_wake_kicks(x, z, px, pz, slope_a, slope_b, dE_E, dxp, min_x, min_z, delta_x, delta_z, transverse_on):
+    """
+    Gather the wakes at the particle positions and apply the kicks in place, in one pass over the particles.
+    The wakes are given on a regular (x_transform, z) grid, where x_transform = x - (slope_a * z + slope_b).
+    Bilinear interpolation, particles outside the grid are not kicked
+    (same as RegularGridInterpolator with fill_value = 0).
+    :param dE_E: (nx, nz) relative energy kick
+    :param dxp: (nx, nz) transverse kick, ignored if transverse_on is False
+    """
+    x_size, z_size = dE_E.shape[0], dE_E.shape[1]
+    for i in range(len(x)):
+        xi = (x[i] - slope_a * z[i] - slope_b - min_x) / delta_x
+        zi = (z[i] - min_z) / delta_z
+
+        if xi < 0 or zi < 0 or xi > x_size - 1 or zi > z_size - 1:
+            continue
+
+        x0 = min(int(xi), x_size - 2)
+        z0 = min(int(zi), z_size - 2)
+        xd = xi - x0
+        zd = zi - z0
+
+        w00 = (1 - xd) * (1 - zd)
+        w01 = (1 - xd) * zd
+        w10 = xd * (1 - zd)
+        w11 = xd * zd
+
+        pz[i] += w00 * dE_E[x0, z0] + w01 * dE_E[x0, z0 + 1] + w10 * dE_E[x0 + 1, z0] + w11 * dE_E[x0 + 1, z0 + 1]
+        if transverse_on:
+            px[i] += w00 * dxp[x0, z0] + w01 * dxp[x0, z0 + 1] + w10 * dxp[x0 + 1, z0] + w11 * dxp[x0 + 1, z0 + 1]
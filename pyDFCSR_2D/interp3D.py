@@ -2,6 +2,7 @@ import numpy as np
 from numba import jit
 from numba.experimental import jitclass
 from numba import double
+from .interp1D import find_bin
 spec = [
     ('min_x', double),
     ('min_y', double), # a simple scalar field
@@ -16,16 +17,17 @@ spec = [
 ]
 
 @jit(nopython = True,  cache = True)
-def interpolate3D(xval, yval, zval, data, min_x, min_y, min_z,  delta_x, delta_y, delta_z):
+def interpolate3D(xval, yval, zval, data, min_x, min_y, min_z,  delta_x, delta_y, delta_z, shear_a = 0.0, shear_b = 0.0):
+    """
+    Trilinear interpolation on a regular grid. If the data is stored in a sheared frame
+    y' = y - (shear_a * z + shear_b), the lab coordinates (yval, zval) are mapped into that frame.
+    """
     result = np.zeros(len(xval))
     x_size, y_size, z_size = data.shape[0], data.shape[1], data.shape[2]
-    xval = (xval - min_x) / delta_x
-    yval = (yval - min_y) / delta_y
-    zval = (zval - min_z) / delta_z
     for i in range(len(xval)):
-        x = xval[i]
-        y = yval[i]
-        z = zval[i]
+        x = (xval[i] - min_x) / delta_x
+        y = (yval[i] - shear_a * zval[i] - shear_b - min_y) / delta_y
+        z = (zval[i] - min_z) / delta_z
 
         x0 = int(x)
         if x0 == x_size - 1:
@@ -65,6 +67,75 @@ def interpolate3D(xval, yval, zval, data, min_x, min_y, min_z,  delta_x, delta_y
 
     return result
 
+@jit(nopython = True,  cache = True)
+def interpolate_fields(tval, yval, zval, data, times, time_table, time_step, min_y, min_z, delta_y, delta_z,
+                       shear_a = 0.0, shear_b = 0.0, rows = None, owned = None):
+    """
+    Trilinear interpolation of all the fields of data (nt, ny, nz, nfield) in one pass. The first axis is the
+    non-uniform time axis times, the interval is looked up in time_table (see make_bin_table). The (y, z) grids
+    are regular, in the sheared frame y' = y - (shear_a * z + shear_b) as in interpolate3D.
+    Points outside the grids are zero.
+    :param rows: for a time-sliced history, (len(times),) row of each time slice in data, -1 if not held
+    :param owned: for a time-sliced history, (len(times),) only the time intervals [times[k], times[k+1]] with
+                  owned[k] are interpolated, the points in the other intervals are zero
+    :return: (len(tval), nfield)
+    """
+    nt = len(times)
+    y_size, z_size, n_field = data.shape[1], data.shape[2], data.shape[3]
+    result = np.zeros((len(tval), n_field))
+    for i in range(len(tval)):
+        t = tval[i]
+        if not (times[0] <= t <= times[nt - 1]):
+            continue
+
+        if nt == 1:
+            x0 = 0
+            x1 = 0
+            xd = 0.0
+        else:
+            x0 = find_bin(t, times, time_table, time_step)
+            x1 = x0 + 1
+            dt = times[x1] - times[x0]
+            xd = (t - times[x0]) / dt if dt > 0 else 0.0
+
+        if owned is not None:
+            if not owned[x0]:
+                continue
+            x0 = rows[x0]
+            x1 = rows[x1]
+
+        y = (yval[i] - shear_a * zval[i] - shear_b - min_y) / delta_y
+        z = (zval[i] - min_z) / delta_z
+
+        y0 = int(y)
+        if y0 == y_size - 1:
+            y1 = y0
+        else:
+            y1 = y0 + 1
+
+        z0 = int(z)
+        if z0 == z_size - 1:
+            z1 = z0
+        else:
+            z1 = z0 + 1
+
+        yd = y - y0
+        zd = z - z0
+
+        if y0 >= 0 and z0 >= 0 and y1 < y_size and z1 < z_size:
+            for f in range(n_field):
+                c00 = data[x0, y0, z0, f] * (1 - xd) + data[x1, y0, z0, f] * xd
+                c01 = data[x0, y0, z1, f] * (1 - xd) + data[x1, y0, z1, f] * xd
+                c10 = data[x0, y1, z0, f] * (1 - xd) + data[x1, y1, z0, f] * xd
+                c11 = data[x0, y1, z1, f] * (1 - xd) + data[x1, y1, z1, f] * xd
+
+                c0 = c00 * (1 - yd) + c10 * yd
+                c1 = c01 * (1 - yd) + c11 * yd
+
+                result[i, f] = c0 * (1 - zd) + c1 * zd
+
+    return result
+
 @jit(nopython = True,  cache = True)
 def interpolate_3d_vectorized(data, x, y, z, min_x, min_y, min_z,  delta_x, delta_y, delta_z):
     """
@@ -1,113 +1,85 @@
 import numpy as np
+from collections import namedtuple
 from .yaml_parser import parse_yaml
-
-def get_referece_traj(lattice_config, Nsample = 5000, Ndim = 2):
+from .interp1D import make_bin_table
+from .tools import yaml_hash, load_cache, save_cache
+
+# One entry of the tracking schedule, see Lattice.get_step_plan
+#   kind: 'exit'    remaining part of a step in the previous element (tracking only)
+#         'whole'   one track over a whole element without any step inside (tracking only)
+#         'element' the beam enters a new element (bookkeeping only)
+#         'step'    a full step, or the part of a step in the new element. CSR may be computed after it
+#   ele_index: index of the element, element: name of the element
+#   step: index of the step inside the element, step_count: global step index (for 'step' only)
+#   kick_length: length the CSR kick computed after this step accounts for, the nominal size of the
+#                nsep steps starting from it (for 'step' only)
+PlanStep = namedtuple('PlanStep', ['kind', 'ele_index', 'element', 'DL', 'entrance', 'exit', 'step', 'step_count',
+                                   'kick_length'])
+
+# bump when the computed geometry changes, to invalidate the cached geometries
+GEOMETRY_CACHE_VERSION = '1'
+
+
+def get_referece_traj(lattice_config, resolution = 1.0e-3, Ndim = 2):
     """
-    A function to get the reference trajectory of partices with given lattice configuration
+    A function to get the reference trajectory of partices with given lattice configuration.
+    Each element is sampled uniformly with closed-form lines and arcs, with samples at the element boundaries
     :param lattice_config: dictionary
-           Nsample: the number of points in each element to calculate the traj
+           resolution: the maximum distance between the samples of the trajectory (m)
            Ndim:  the dimension of the trajectory
     :return:
-      s : longitudindal coordinates (Nsamle,)
+      s : longitudindal coordinates of the samples (Nsample,), not uniform
       coords:  interpolant of coordinate of the trajectory, array (Nsample, Ndim). coord[:,0] = x, coord[:,1] = y
       tau_vec, n_vec: interpolant of tangential and normal vectors along the trajectory, array (Nsamp, Ndim).
                         tau_vec[:, 0] x component. tau_vec[:, 1] y component
-      rho: bending radius (1/R) of the trajectory, array (Nsample,)
+      rho: bending radius (1/R) of each element, array (Nelement,)
       distance: (Nelement,): distance[i] is the distance from the lattice entrance to the end of ith element
     """
-    Nelement = len(lattice_config) - 1
+    keys = list(lattice_config.keys())[1:]
+    Nelement = len(keys)
     distance = np.zeros(Nelement)        # distance[i] is the distance between the entrance and the end of ith element
     rho = np.zeros(Nelement)
     nsep = np.zeros(Nelement)
-    #s = np.zeros(Nelement*Nsample + 1)
-    count = 0
-    for key in list(lattice_config.keys())[1:]:
+
+    s_list = [np.zeros(1)]
+    theta_list = [np.zeros(1)]       # the angle between the traj tangential and x axis
+    x_list = [np.zeros(1)]
+    y_list = [np.zeros(1)]
+    s0, theta_0, x0, y0 = 0.0, 0.0, 0.0, 0.0   # at the entrance of the current element
+    for count, key in enumerate(keys):
         current_element = lattice_config[key]
         L = current_element['L']
         nsep[count] = current_element['nsep']
+        # Todo: check other elements (quad, sextupole), straight lines for now
         if current_element['type'] == 'dipole':
-            angle = current_element['angle']
-            rho[count] = angle/L
-
-        if count == 0:
-            distance[count] = L
-            #s[count*Nsample: (count + 1)*Nsample + 1] = np.linspace(0, L, Nsample + 1)
+            rho[count] = current_element['angle']/L
+        distance[count] = s0 + L
+
+        n = max(int(np.ceil(L / resolution)), 1)
+        u = np.linspace(0, L, n + 1)[1:]         # distance from the entrance, the entrance is already sampled
+        k = rho[count]
+        theta = theta_0 + k * u
+        if k != 0:
+            x = x0 + (np.sin(theta) - np.sin(theta_0)) / k
+            y = y0 - (np.cos(theta) - np.cos(theta_0)) / k
         else:
-            distance[count] = L + distance[count - 1]
-            # this is to make sure that the edge of each elements is sampled in s
-            #s[count*Nsample + 1: (count + 1)*Nsample + 1] = np.linspace(distance[count - 1], distance[count], Nsample + 1)[1:]
-        count += 1
-    #s[-1] = distance[-1]
-
-    #Todo: I change the definition of s to be equidistant. However, it cannot garanteed that the edge of each element is included.
-    L_lattice = distance[-1]     # total length of the lattice
-    s = np.linspace(0, L_lattice, Nsample)                     # coordinates along s to calculate the reference traj
-    interval = np.mean(np.diff(s))
-    coords = np.zeros((Nsample, Ndim))
-    tau_vec = np.zeros((Nsample, Ndim))
-    n_vec = np.zeros((Nsample, Ndim))
-
-    #rho = np.zeros(Nelement*Nsample + 1)
-
-    element_infer = 0      # pointer to which element we are in
-    count = 1
-    theta_0 = 0  # te angle between the traj tangential and x axis
-    tau_vec[0, 0] = np.cos(theta_0)
-    tau_vec[0, 1] = np.sin(theta_0)
-
+            x = x0 + u * np.cos(theta_0)
+            y = y0 + u * np.sin(theta_0)
+
+        s_list.append(s0 + u)
+        theta_list.append(theta)
+        x_list.append(x)
+        y_list.append(y)
+        s0, theta_0, x0, y0 = distance[count], theta[-1], x[-1], y[-1]
+
+    s = np.concatenate(s_list)
+    theta = np.concatenate(theta_list)
+    coords = np.column_stack((np.concatenate(x_list), np.concatenate(y_list)))
+    tau_vec = np.column_stack((np.cos(theta), np.sin(theta)))
     # Todo: High Priority! check the sign of n_vec
-    n_vec[0, 0] = np.sin(theta_0)
-    n_vec[0, 1] = -1 * np.cos(theta_0)
-    keys = list(lattice_config.keys())[1:]
-    for st in s[1:]:
-        if st > distance[element_infer]:
-            element_infer += 1
-
-
-        delta_s = s[count] - s[count - 1]
-        ele_name = keys[element_infer]
-
-
-        # for dipole
-        if lattice_config[ele_name]['type'] == 'dipole':
-            L = lattice_config[ele_name]['L']
-            angle = lattice_config[ele_name]['angle']
-            phi = delta_s/L*angle
-            r = L/angle
-
-            # seems to be stupid. Todo
-            x0 = coords[count - 1, 0] - r*np.sin(theta_0)
-            y0 = coords[count - 1, 1] + r*np.cos(theta_0)
-
-            coords[count, 0] = x0 + r*np.sin(phi + theta_0)
-            coords[count, 1] = y0 - r*np.cos(phi + theta_0)
-            #rho[count]  = angle/L
-
-        # for drift, quad, sext
-        else:
-            phi = 0
-            coords[count, 0] = coords[count - 1, 0] + delta_s *np.cos(theta_0)
-            coords[count, 1] = coords[count - 1, 1] + delta_s *np.sin(theta_0)
-            #rho[count] = 0
-
-        # Todo: check other elements (quad, sextupole)
+    n_vec = np.column_stack((np.sin(theta), -1 * np.cos(theta)))
 
-        theta_0 += phi
-
-
-        tau_vec[count, 0] = np.cos(theta_0)
-        tau_vec[count, 1] = np.sin(theta_0)
-
-        # Todo: High Priority! check the sign of n_vec
-        n_vec[count, 0] = np.sin(theta_0)
-        n_vec[count, 1] = -1*np.cos(theta_0)
-
-        count += 1
-
-
-
-
-    return s, rho, distance, nsep, coords, n_vec, tau_vec
+    return s, rho, distance, nsep, coords[:, :Ndim], n_vec[:, :Ndim], tau_vec[:, :Ndim]
 
 class Lattice():
     """
@@ -115,32 +87,81 @@ class Lattice():
     maybe install a pointer for the position of the current beam
     """
 
+    # geometry stored in the cache, see load_geometry
+    geometry_arrays = ['s', 'rho', 'distance', 'nsep', 'coords', 'n_vec', 'tau_vec', 'traj_data', 'traj_table',
+                       '_positions_record', '_step_sizes', '_CSR_steps_index', 'steps_per_element']
+    geometry_scalars = ['_lattice_length', 'min_x', 'max_x', 'traj_table_step', 'step_size', '_total_steps',
+                        '_CSR_steps_count']
+
     def __init__(self, input_lattice):
+        """
+        :param input_lattice: dictionary with lattice_input_file, and optionally geometry_cache. If geometry_cache is
+                              set, the trajectory tables and the step plan are stored in the local cache
+                              (tools.cache_dir()), keyed by the hash of the lattice file content, and loaded memory
+                              mapped from it in the next runs
+        """
 
         assert 'lattice_input_file' in input_lattice, 'Error in parsing lattice: must include the keyword <lattice_input_file>'
         self.lattice_input_file = input_lattice['lattice_input_file']
+        cache = input_lattice.get('geometry_cache', False)
 
         lattice_config = parse_yaml(self.lattice_input_file)
         self.check_input(lattice_config)
+        # optional adaptive stepping and sampling of the reference trajectory, not elements
+        self.adaptive_step = lattice_config.pop('adaptive_step', None)
+        self.trajectory_resolution = lattice_config.pop('trajectory_resolution', 1.0e-3)
         self.lattice_config = lattice_config
         self._Nelement = len(lattice_config) - 1
-        self.get_ref_traj()
-        self.get_steps()
 
-        self.build_interpolant()
+        key = 'lattice-' + yaml_hash(self.lattice_input_file, extra = GEOMETRY_CACHE_VERSION) if cache else None
+        if not (cache and self.load_geometry(key)):
+            self.get_ref_traj()
+            self.get_steps()
+            self.get_step_plan()
+
+            self.build_interpolant()
+            if cache:
+                self.save_geometry(key)
         self.current_element = None           # pointer of the element where the beam is now in.
 
+    def save_geometry(self, key):
+        arrays = {name: getattr(self, name) for name in self.geometry_arrays}
+        metadata = {name: float(getattr(self, name)) for name in self.geometry_scalars}
+        metadata['step_plan'] = [[v.item() if isinstance(v, np.generic) else v for v in plan_step]
+                                 for plan_step in self.step_plan]
+        metadata['lattice_input_file'] = self.lattice_input_file
+        save_cache(key, arrays, metadata)
+
+    def load_geometry(self, key):
+        """
+        :return: True if the geometry is found in the cache and loaded
+        """
+        cached = load_cache(key)
+        if cached is None:
+            return False
+        arrays, metadata = cached
+        for name in self.geometry_arrays:
+            setattr(self, name, arrays[name])
+        for name in self.geometry_scalars:
+            setattr(self, name, metadata[name])
+        self._total_steps = int(self._total_steps)
+        self._CSR_steps_count = int(self._CSR_steps_count)
+        self.step_plan = [PlanStep(*plan_step) for plan_step in metadata['step_plan']]
+        return True
+
     def check_input(self, input):
         # Todo: check input for lattice
         assert 'step_size' in input, f'Required input parameter step_size to {self.__class__.__name__}.__init__(**kwargs) was not found.'
-    def get_ref_traj(self, Nsample = 2000):
-        self.s, self.rho, self.distance, self.nsep, self.coords, self.n_vec, self.tau_vec = get_referece_traj(lattice_config = self.lattice_config, Nsample = Nsample)
+    def get_ref_traj(self):
+        self.s, self.rho, self.distance, self.nsep, self.coords, self.n_vec, self.tau_vec = get_referece_traj(lattice_config = self.lattice_config, resolution = self.trajectory_resolution)
 
         self._lattice_length = self.distance[-1]
 
     def build_interpolant(self):
         self.min_x, self.max_x = self.s[0], self.s[-1]
-        self.delta_x = (self.max_x - self.min_x) / (self.s.shape[0] - 1)
+        # trajectory columns (x, y, n_x, n_y, tau_x, tau_y) on the non-uniform samples s, for interpolate1D_fields
+        self.traj_data = np.ascontiguousarray(np.column_stack((self.coords, self.n_vec, self.tau_vec)))
+        self.traj_table, self.traj_table_step = make_bin_table(self.s)
         #self.F_x_ref = RegularGridInterpolator(points=(self.s,), values=self.coords[:, 0], method='linear',bounds_error = False)
         #self.F_y_ref = RegularGridInterpolator(points=(self.s,), values=self.coords[:, 1], method='linear',bounds_error = False)
         #self.F_n_vec_x = RegularGridInterpolator(points=(self.s,), values=self.n_vec[:, 0], method='linear',bounds_error = False)
@@ -149,10 +170,23 @@ class Lattice():
         #self.F_tau_vec_y = RegularGridInterpolator(points=(self.s,), values=self.tau_vec[:, 1], method='linear',bounds_error = False)
         #self.F_rho = RegularGridInterpolator(points = (self.s,), values = self.rho, method = 'nearest',bounds_error = False)
 
+    def get_rho(self, s):
+        """
+        curvature (1/R) of the reference trajectory at the positions s, 0 beyond the end of the lattice
+        """
+        ind = np.searchsorted(self.distance, s, side = 'right')
+        return np.append(self.rho, 0.0)[ind]
+
     def get_steps(self):
         self.step_size = self.lattice_config['step_size']
-        #Todo: Deal with the endpoint
-        self._positions_record = np.arange(0, self.lattice_length + self.step_size/2, self.step_size)
+        keys = list(self.lattice_config.keys())[1:]
+        if self.adaptive_step is None and all('step_size' not in self.lattice_config[ele] for ele in keys):
+            #Todo: Deal with the endpoint
+            self._positions_record = np.arange(0, self.lattice_length + self.step_size/2, self.step_size)
+            self._step_sizes = np.full(len(self._positions_record), self.step_size)
+        else:
+            self._positions_record = self.get_variable_positions()
+            self._step_sizes = np.diff(self._positions_record, prepend = 0.0)
         self._total_steps = len(self._positions_record)
         self._CSR_steps_index = np.array([])                   # the index of total_steps where the CSR will be computed
         self.steps_per_element = np.zeros((self.Nelement,), dtype = int)
@@ -173,6 +207,104 @@ class Lattice():
         self._CSR_steps_count = len(self._CSR_steps_index)
 
 
+    def get_variable_positions(self):
+        """
+        positions of the steps with the step size of each element (element key step_size, the global step_size
+        if not given). The steps are aligned with the element boundaries.
+        With adaptive_step, the steps in the elements other than dipoles grow linearly with the distance to
+        the nearest dipole edge beyond transient_length, up to max_step_size:
+            adaptive_step:
+              max_step_size: 0.5      # (m)
+              transient_length: 0.5   # distance from the dipoles with the step size of the element (m)
+              ramp: 0.5               # increase of the step size per meter beyond transient_length
+        :return: positions, the first one is 0
+        """
+        keys = list(self.lattice_config.keys())[1:]
+        adaptive = self.adaptive_step
+        if adaptive is not None:
+            max_step_size = adaptive['max_step_size']
+            transient_length = adaptive.get('transient_length', 0.0)
+            ramp = adaptive.get('ramp', 0.5)
+            bend_entrance = np.array([self.distance[i] - self.lattice_config[ele]['L'] for i, ele in enumerate(keys)
+                                      if self.lattice_config[ele]['type'] == 'dipole'])
+            bend_exit = np.array([self.distance[i] for i, ele in enumerate(keys)
+                                  if self.lattice_config[ele]['type'] == 'dipole'])
+
+        positions = [0.0]
+        for ele_count, ele in enumerate(keys):
+            d0 = self.distance[ele_count - 1] if ele_count > 0 else 0.0
+            d1 = self.distance[ele_count]
+            h0 = self.lattice_config[ele].get('step_size', self.step_size)
+            adapt = adaptive is not None and self.lattice_config[ele]['type'] != 'dipole'
+
+            s = d0
+            while d1 - s > 1.0e-9:
+                h = h0
+                if adapt:
+                    h = max(max_step_size, h0)
+                    prev_exit = bend_exit[bend_exit <= s + 1.0e-9]
+                    if len(prev_exit):
+                        h = min(h, h0 + ramp * max(0.0, s - prev_exit[-1] - transient_length))
+                    next_entrance = bend_entrance[bend_entrance >= s - 1.0e-9]
+                    if len(next_entrance):
+                        # the end of the step must also satisfy the ramp towards the next dipole
+                        h = min(h, max(h0, (h0 + ramp * (next_entrance[0] - s - transient_length)) / (1 + ramp)))
+                # merge the last step of the element if it would be shorter than half a step
+                s = d1 if s + 1.5 * h >= d1 else s + h
+                positions.append(s)
+
+        return np.array(positions)
+
+    def get_step_plan(self):
+        """
+        Precompute the whole tracking schedule, including the steps split over element boundaries.
+        self.step_plan is a list of PlanStep, in the order they are executed by CSR2D.run
+        """
+        plan = []
+        keys = list(self.lattice_config.keys())[1:]
+        position = 0       # accumulated in the same way as Beam.position
+        step_count = 1
+        skip_ele = False
+        for ele_count, ele in enumerate(keys):
+            steps = self.steps_per_element[ele_count]
+
+            # A step over the boundary of the elements, deal with the part of the step in the previous element
+            if (not skip_ele) and ele_count > 0:
+                DL_1 = self.distance[ele_count - 1] - position     # The remaining distance in last element
+                #Todo: Bmadx seems to have some problems when DL is very
+                if DL_1 > 1.0e-6:
+                    plan.append(PlanStep('exit', ele_count - 1, keys[ele_count - 1], DL_1, False, True, None, None, None))
+                    position += DL_1
+
+            # If no steps inside an element, one step over the whole element
+            if steps == 0:
+                skip_ele = True
+                L = self.lattice_config[ele]['L']
+                plan.append(PlanStep('whole', ele_count, ele, L, True, True, None, None, None))
+                position += L
+
+            plan.append(PlanStep('element', ele_count, ele, 0.0, False, False, None, None, None))
+
+            for step in range(steps):
+                if (step == 0) and (ele_count > 0):
+                    # If enter a new element, split the step
+                    DL = self._positions_record[step_count] - self.distance[ele_count - 1]
+                    entrance = True
+                    skip_ele = False    # Reset the flag
+                else:
+                    DL = self._step_sizes[step_count]
+                    entrance = False
+                # a step ending at the end of the element also tracks its exit edge
+                exit = abs(self.distance[ele_count] - self._positions_record[step_count]) < 1.0e-6
+                nsep = int(self.nsep[ele_count])
+                sizes = self._step_sizes[step_count: step_count + nsep]
+                kick_length = np.sum(sizes) + (nsep - len(sizes)) * self._step_sizes[-1]
+                plan.append(PlanStep('step', ele_count, ele, DL, entrance, exit, step, step_count, kick_length))
+                position += DL
+                step_count += 1
+
+        self.step_plan = plan
+
     @property
     def lattice_length(self):
         return self._lattice_length
@@ -0,0 +1,148 @@
+import numpy as np
+from numba import jit
+from mpi4py import MPI
+from .twiss import twiss_dispersion_calc
+
+
+@jit(nopython = True, cache = True)
+def sum_moments(x, px, y, py, z, pz, shift):
+    """
+    Single pass over the particles to accumulate the first and second order sums of the 6D coordinates.
+    The coordinates are shifted by `shift` (e.g. the previous mean) to avoid cancellation.
+    :return: buf (28,) = [n, sum of c (6,), sum of c_i*c_j for i <= j (21,)], c = coords - shift
+    """
+    buf = np.zeros(28)
+    c = np.zeros(6)
+    n_ptcl = len(x)
+    for i in range(n_ptcl):
+        c[0] = x[i] - shift[0]
+        c[1] = px[i] - shift[1]
+        c[2] = y[i] - shift[2]
+        c[3] = py[i] - shift[3]
+        c[4] = z[i] - shift[4]
+        c[5] = pz[i] - shift[5]
+        k = 7
+        for a in range(6):
+            buf[1 + a] += c[a]
+            for b in range(a, 6):
+                buf[k] += c[a] * c[b]
+                k += 1
+    buf[0] = n_ptcl
+    return buf
+
+
+def compute_moments(particle, shift = None, comm = None):
+    """
+    First and second moments of the bmadx particle coordinates in one compiled pass.
+    :param shift: (6,) reference point subtracted before summation, zero if None. Must be the same on all ranks
+    :param comm: MPI communicator if the particles are distributed over ranks
+    :return: BeamMoments
+    """
+    if shift is None:
+        shift = np.zeros(6)
+    p = particle
+    buf = sum_moments(p.x, p.px, p.y, p.py, p.z, p.pz, shift)
+    if comm is not None:
+        comm.Allreduce(MPI.IN_PLACE, buf, op=MPI.SUM)
+
+    n = buf[0]
+    mean_shifted = buf[1:7] / n
+    second = np.zeros((6, 6))
+    k = 7
+    for a in range(6):
+        for b in range(a, 6):
+            second[a, b] = second[b, a] = buf[k] / n
+            k += 1
+    cov = second - np.outer(mean_shifted, mean_shifted)
+
+    return BeamMoments(n=int(n), mean=mean_shifted + shift, cov=cov, p0c=p.p0c, mc2=p.mc2)
+
+
+class BeamMoments:
+    """
+    Cached first and second moments of the 6D coordinates (x, px, y, py, z, pz) of a beam,
+    and all the beam statistics derived from them
+    """
+    def __init__(self, n, mean, cov, p0c, mc2):
+        """
+        :param n: number of particles
+        :param mean: (6,) mean of the coordinates
+        :param cov: (6, 6) covariance matrix of the coordinates (normalized by n, as np.std)
+        """
+        self.n = n
+        self.mean = mean
+        self.cov = cov
+        self.p0c = p0c
+        self.mc2 = mc2
+
+    def transport(self, M):
+        """
+        moments after a linear transport
+        :param M: 7*7 affine transfer map, the 6*6 transfer matrix and the constant term in the last column
+        :return: BeamMoments
+        """
+        R = M[:6, :6]
+        return BeamMoments(n=self.n, mean=np.matmul(R, self.mean) + M[:6, 6],
+                           cov=np.matmul(R, np.matmul(self.cov, R.T)), p0c=self.p0c, mc2=self.mc2)
+
+    @property
+    def mean_x(self):
+        return self.mean[0]
+
+    @property
+    def mean_y(self):
+        return self.mean[2]
+
+    @property
+    def mean_z(self):
+        return self.mean[4]
+
+    @property
+    def sigma_x(self):
+        return np.sqrt(self.cov[0, 0])
+
+    @property
+    def sigma_z(self):
+        return np.sqrt(self.cov[4, 4])
+
+    @property
+    def slope(self):
+        """
+        linear x-z chirp, same as np.polyfit(z, x, deg = 1)
+        """
+        a = self.cov[0, 4] / self.cov[4, 4]
+        return np.array([a, self.mean[0] - a * self.mean[4]])
+
+    @property
+    def mean_x_transform(self):
+        a, b = self.slope
+        return self.mean[0] - a * self.mean[4] - b
+
+    @property
+    def sigma_x_transform(self):
+        """
+        rms x after removing the linear x-z chirp
+        """
+        return np.sqrt(np.maximum(self.cov[0, 0] - self.cov[0, 4] ** 2 / self.cov[4, 4], 0.0))
+
+    @property
+    def mean_energy(self):
+        return (self.mean[5] + 1) * self.p0c
+
+    @property
+    def sigma_energy(self):
+        return np.sqrt(self.cov[5, 5]) * self.p0c
+
+    @property
+    def twiss(self):
+        """
+        same as twiss_from_bmadx_particles, with the unbiased covariance like np.cov
+        """
+        cov = self.cov * self.n / (self.n - 1)
+        out = {}
+        for plane, ind in (('x', [0, 1, 5]), ('y', [2, 3, 5])):
+            twiss = twiss_dispersion_calc(cov[np.ix_(ind, ind)])
+            twiss['norm_emit'] = twiss['emit'] * self.p0c / self.mc2
+            for k in twiss:
+                out[k + f'_{plane}'] = twiss[k]
+        return out
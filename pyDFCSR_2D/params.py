@@ -29,7 +29,11 @@ class CSR_params:
         self.configure_params(**input_dic)
 
     def configure_params(self, workdir = '.', apply_CSR = 1, compute_CSR = 1,
-                         transverse_on = 1, xbins = 20, zbins = 30, xlim = 5, zlim = 5, write_beam = None, write_wakes = True, write_name = ''):
+                         transverse_on = 1, xbins = 20, zbins = 30, xlim = 5, zlim = 5, write_beam = None, write_wakes = True, write_name = '',
+                         distribute_beam = 0, tracking = 'bmadx', fuse_steps = 0,
+                         integrator = 'kick', load_balance = 0, history_mode = 'replicated',
+                         time_slice_chunk = 8, workers = 0, wake_compression = None,
+                         output_queue = 4, checkpoint_interval = 0):
         self.compute_CSR = compute_CSR
         self.apply_CSR = apply_CSR
         self.transverse_on = transverse_on
@@ -41,5 +45,36 @@ class CSR_params:
         self.write_wakes = write_wakes
         self.workdir = full_path(workdir)
         self.write_name = write_name
+        self.distribute_beam = distribute_beam   # with MPI, partition the particles over the ranks
+        # 'bmadx', 'linear' (r_gen6 transfer maps), or a dictionary of backend per element type, e.g. {'drift': 'linear'}
+        self.tracking = tracking
+        # if compute_CSR is 0, track the steps of each element as one element. The statistics at the intermediate
+        # steps are then obtained by linear transport of the beam moments
+        self.fuse_steps = fuse_steps
+        # 'kick': apply the CSR kick after tracking the whole step. 'split': second order drift-kick-drift step,
+        # the wakes are computed and applied at the middle of the step. 'split' requires nsep = 1 in all elements
+        assert integrator in ('kick', 'split'), f'Unknown integrator {integrator}, use kick or split'
+        self.integrator = integrator
+        # with MPI, partition the CSR mesh points over the ranks with the timings of the previous CSR evaluation,
+        # instead of equal blocks
+        self.load_balance = load_balance
+        # with MPI, 'replicated': every rank keeps its own copy of the DF history. 'node_shared': one rank per node
+        # keeps the history and builds the interpolant in a shared memory window, read by the other ranks of the node.
+        # node_shared requires distribute_beam.
+        # 'time_sliced': the time intervals of the history are dealt to the ranks in blocks of time_slice_chunk,
+        # each rank integrates the wakes of all the mesh points over its own intervals and the partial wakes are summed
+        assert history_mode in ('replicated', 'node_shared', 'time_sliced'), \
+            f'Unknown history_mode {history_mode}, use replicated, node_shared or time_sliced'
+        self.history_mode = history_mode
+        self.time_slice_chunk = time_slice_chunk
+        # without MPI, number of worker processes computing the wakes on the CSR mesh. 0: in the main process
+        self.workers = workers
+        # compression filter of the wake file, e.g. 'gzip' or 'lzf'. None for no compression
+        self.wake_compression = wake_compression
+        # maximum number of particle dumps and wake writes waiting for the background writer thread.
+        # 0: write in the main thread
+        self.output_queue = output_queue
+        # number of steps between checkpoints of the run (see CSR2D.restart). 0: no checkpoint
+        self.checkpoint_interval = checkpoint_interval
 
 
@@ -0,0 +1,228 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from types import SimpleNamespace
+
+# attached shared memory blocks of a worker, by name
+_worker_blocks = {}
+
+
+class SharedArrays:
+    """
+    numpy arrays packed in one shared memory block. The block is re-used as long as the arrays fit
+    """
+    def __init__(self):
+        self.shm = None
+
+    def publish(self, arrays):
+        """
+        copy the arrays into the block
+        :param arrays: dictionary of numpy arrays
+        :return: (block name, layout) for attach
+        """
+        nbytes = sum(_aligned(a.nbytes) for a in arrays.values())
+        if self.shm is None or self.shm.size < nbytes:
+            # the history grows by one slice per step, reserve some room to avoid a new block each step
+            self.close()
+            self.shm = shared_memory.SharedMemory(create=True, size=max(int(1.5 * nbytes), 8))
+
+        layout = {}
+        offset = 0
+        for name, a in arrays.items():
+            a = np.asarray(a)
+            np.ndarray(a.shape, dtype=a.dtype, buffer=self.shm.buf, offset=offset)[...] = a
+            layout[name] = (offset, a.shape, a.dtype.str)
+            offset += _aligned(a.nbytes)
+        return self.shm.name, layout
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class SharedHistory:
+    """
+    Slices of the DF history (DF_tracker.data_fields_interp) in one shared memory block kept between the CSR
+    evaluations. A new slice is copied in once, into a free row. The rows of the slices dropped from the history
+    are re-used. The whole history is copied only when the block is reallocated, or when the slices are
+    interpolated again on new grids
+    """
+    def __init__(self):
+        self.shm = None
+        self.shape = None        # (rows, nx, nz, nfield) of the block
+        self.generation = None   # DF_tracker.interp_generation of the slices in the block
+        self.rows = {}           # global index of a slice: row in the block
+
+    def publish(self, DF):
+        """
+        copy the slices of DF (DF_tracker) not yet in the block
+        :return: (block name, layout) for attach, and the row in the block of each slice of DF.data_fields_interp
+        """
+        fields = DF.data_fields_interp
+        nt = fields.shape[0]
+        if (self.shm is None or DF.interp_generation != self.generation or self.shape[1:] != fields.shape[1:]
+                or nt > self.shape[0]):
+            # the history grows by one slice per step, reserve some room to avoid a new block each step
+            shape = (max(int(1.5 * nt), 1),) + fields.shape[1:]
+            nbytes = 8 * int(np.prod(shape))
+            if self.shm is None or self.shm.size < nbytes:
+                self.close()
+                self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.shape = shape
+            self.generation = DF.interp_generation
+            self.rows = {}
+
+        block = np.ndarray(self.shape, dtype=np.float64, buffer=self.shm.buf)
+        index = list(DF.index_interp)
+        current = set(index)
+        self.rows = {k: row for k, row in self.rows.items() if k in current}
+        free = sorted(set(range(self.shape[0])) - set(self.rows.values()), reverse=True)
+        for j, k in enumerate(index):
+            if k not in self.rows:
+                self.rows[k] = free.pop()
+                block[self.rows[k]] = fields[j]
+        rows = np.array([self.rows[k] for k in index], dtype=np.int64)
+        return (self.shm.name, {'data_fields_interp': (0, self.shape, np.dtype(np.float64).str)}), rows
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+        self.shape = None
+        self.generation = None
+        self.rows = {}
+
+
+def _aligned(nbytes):
+    return (nbytes + 7) // 8 * 8
+
+
+def attach(name, layout):
+    """
+    map the arrays published by SharedArrays.publish, without a copy
+    :return: dictionary of numpy arrays
+    """
+    if name not in _worker_blocks:
+        _worker_blocks[name] = shared_memory.SharedMemory(name=name)
+    buf = _worker_blocks[name].buf
+    return {key: np.ndarray(shape, dtype=np.dtype(dtype), buffer=buf, offset=offset)
+            for key, (offset, shape, dtype) in layout.items()}
+
+
+def _wake_chunk(blocks, scalars, integration_params, indices):
+    """
+    worker: wakes (dE_dct, x_kick) of the CSR mesh points indices
+    :return: (len(indices), 2)
+    """
+    from .CSR import CSR2D
+    from .lattice import Lattice
+
+    names = [name for name, layout in blocks]
+    for name in list(_worker_blocks):
+        if name not in names:
+            # replaced by a larger block
+            _worker_blocks.pop(name).close()
+    arrays = {}
+    for name, layout in blocks:
+        arrays.update(attach(name, layout))
+
+    # a CSR2D with only what get_CSR_wake needs
+    csr = CSR2D.__new__(CSR2D)
+    csr.integration_params = integration_params
+    csr.formation_length = scalars['formation_length']
+    csr.CSR_scaling = scalars['CSR_scaling']
+    csr.beam = SimpleNamespace(position=scalars['position'], _sigma_z=scalars['sigma_z'],
+                               _sigma_x=scalars['sigma_x'], _slope=arrays['slope'], _mean_x=scalars['mean_x'])
+    csr.DF_tracker = SimpleNamespace(data_fields_interp=arrays['data_fields_interp'], time_grid=arrays['time_grid'],
+                                     time_table=arrays['time_table'], time_step=scalars['time_step'],
+                                     current_fields=arrays['current_fields'], current_time=arrays['current_time'],
+                                     current_table=arrays['current_table'], current_step=scalars['current_step'],
+                                     min_y=scalars['min_y'], min_z=scalars['min_z'], delta_y=scalars['delta_y'],
+                                     delta_z=scalars['delta_z'], shear_a=scalars['shear_a'],
+                                     shear_b=scalars['shear_b'], time_rows=arrays['time_rows'],
+                                     time_owned=arrays['time_owned'])
+    lattice = Lattice.__new__(Lattice)
+    for name in ('traj_data', 's', 'traj_table', 'distance', 'rho'):
+        setattr(lattice, name, arrays[name])
+    lattice.traj_table_step = scalars['traj_table_step']
+    csr.lattice = lattice
+
+    out = np.zeros((len(indices), 2))
+    for j, k in enumerate(indices):
+        out[j] = csr.get_CSR_wake(scalars['position'] + arrays['zmesh'][k], arrays['xmesh'][k])
+    return out
+
+
+class WakePool:
+    """
+    concurrent.futures process pool computing the CSR wakes on the mesh, for single node runs without MPI.
+    The interpolant and the trajectory tables are published in shared memory, the workers map them without
+    a copy and compute the wakes of chunks of the CSR mesh points. The history is kept in shared memory between
+    the evaluations, each evaluation only copies the new slices
+    """
+    def __init__(self, workers, chunks_per_worker = 4):
+        """
+        :param workers: number of worker processes
+        :param chunks_per_worker: the mesh is split in workers*chunks_per_worker chunks for load balancing
+        """
+        self.workers = workers
+        self.chunks_per_worker = chunks_per_worker
+        self.executor = None
+        self.trajectory = SharedArrays()   # published once
+        self.history = SharedHistory()     # new slices copied in at each CSR evaluation
+        self.step_arrays = SharedArrays()  # published at each CSR evaluation
+        self._trajectory_block = None
+
+    def calculate(self, csr):
+        """
+        wakes on the CSR mesh of csr (CSR2D), after get_CSR_mesh
+        :return: dE_dct, x_kick, flattened as CSR_xmesh
+        """
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        lattice = csr.lattice
+        if self._trajectory_block is None:
+            self._trajectory_block = self.trajectory.publish({'traj_data': lattice.traj_data, 's': lattice.s,
+                                                              'traj_table': lattice.traj_table,
+                                                              'distance': np.asarray(lattice.distance, dtype=np.float64),
+                                                              'rho': np.asarray(lattice.rho, dtype=np.float64)})
+
+        DF = csr.DF_tracker
+        beam = csr.beam
+        history_block, rows = self.history.publish(DF)
+        # the slices are looked up through their rows in the history block, as for a time-sliced history
+        step_block = self.step_arrays.publish({'time_rows': rows, 'time_owned': np.ones(len(rows), dtype=np.bool_),
+                                               'time_grid': DF.time_grid, 'time_table': DF.time_table,
+                                               'current_fields': DF.current_fields, 'current_time': DF.current_time,
+                                               'current_table': DF.current_table, 'xmesh': csr.CSR_xmesh,
+                                               'zmesh': csr.CSR_zmesh,
+                                               'slope': np.asarray(beam._slope, dtype=np.float64)})
+        scalars = {'formation_length': csr.formation_length, 'CSR_scaling': csr.CSR_scaling,
+                   'position': beam.position, 'sigma_z': beam._sigma_z, 'sigma_x': beam._sigma_x,
+                   'mean_x': beam._mean_x, 'time_step': DF.time_step, 'current_step': DF.current_step,
+                   'min_y': DF.min_y, 'min_z': DF.min_z, 'delta_y': DF.delta_y, 'delta_z': DF.delta_z,
+                   'shear_a': DF.shear_a, 'shear_b': DF.shear_b, 'traj_table_step': lattice.traj_table_step}
+
+        blocks = (self._trajectory_block, history_block, step_block)
+        chunks = np.array_split(np.arange(len(csr.CSR_xmesh)), self.workers * self.chunks_per_worker)
+        chunks = [c for c in chunks if len(c)]
+        results = self.executor.map(_wake_chunk, [blocks] * len(chunks), [scalars] * len(chunks),
+                                    [csr.integration_params] * len(chunks), chunks)
+        wakes = np.concatenate(list(results))
+        return wakes[:, 0], wakes[:, 1]
+
+    def close(self):
+        """
+        shut the workers down and free the shared memory
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.trajectory.close()
+        self.history.close()
+        self.step_arrays.close()
+        self._trajectory_block = None
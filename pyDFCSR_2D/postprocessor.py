@@ -1,6 +1,7 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from .tools import full_path, find_nearest_ind, plot_2D_contour
+from .wake_writer import read_wakes
 import h5py
 from matplotlib import cm
 from pmd_beamphysics import ParticleGroup
@@ -57,57 +58,38 @@ class DFCSR_postprocessor():
 
         return x, y
 
-    def parse_all_wakes(self):
-        
-        with h5py.File(self.wake_filename, "r") as f:
-            self.charge_list = []
-            self.energy_list = []
-            self.gamma_list = []
-            self.step_list = []
-            self.element_list = []
-            self.position_list = []
-
-            for step in f.keys():
-                self.energy_list.append(f[step].attrs['beam_energy'])
-                self.charge_list.append(f[step].attrs['charge'])
-                self.gamma_list.append(f[step].attrs['mean_gamma'])
-                self.step_list.append(f[step].attrs['step'])
-                self.position_list.append(f[step].attrs['position'])
-                self.element_list.append(f[step].attrs['element'])
-        
-
-        with h5py.File(self.wake_filename, "r") as f:
-            self.long_wake_list = []
-            self.trans_wake_list = []
-            self.long_unit_list = []
-            self.trans_unit_list = []
-            self.x_grids_list = []
-            self.z_grids_list = []
-            self.position_list = []
-
-            for step in f.keys():
-                print("Parsing wakes at step ", step)
-
-                position = f[step].attrs['position']
-
-                dE_dct = np.array(f[step]['longitudinal']['dE_dct'])
-                self.long_unit_list.append(f[step]['longitudinal'].attrs['unit'])
-
-                x_grids = np.array(f[step]['longitudinal']['x_grids']).reshape(dE_dct.shape)
-                z_grids = np.array(f[step]['longitudinal']['z_grids']).reshape(dE_dct.shape)
-
-                xkicks = np.array(f[step]['transverse']['xkicks'])
-                self.trans_unit_list.append(f[step]['transverse'].attrs['unit'])
-
-                self.long_wake_list.append(dE_dct)
-                self.trans_wake_list.append(xkicks)
-                self.x_grids_list.append(x_grids)
-                self.z_grids_list.append(z_grids)
-                self.positions_list.append(position)
-
-
+    def parse_wake_info(self):
+        """
+        per step scalars of the wake file
+        """
+        info = read_wakes(self.wake_filename)
+        self.charge_list = list(info['charge'])
+        self.energy_list = list(info['beam_energy'])
+        self.gamma_list = list(info['mean_gamma'])
+        self.step_list = list(info['step'])
+        self.element_list = list(info['element'])
+        self.position_list = list(info['position'])
 
+    def parse_all_wakes(self):
 
+        self.parse_wake_info()
+
+        self.long_wake_list = []
+        self.trans_wake_list = []
+        self.long_unit_list = []
+        self.trans_unit_list = []
+        self.x_grids_list = []
+        self.z_grids_list = []
+
+        for ind, step in enumerate(self.step_list):
+            print("Parsing wakes at step ", step)
+            wakes = read_wakes(self.wake_filename, ind)
+            self.long_wake_list.append(wakes['dE_dct'])
+            self.trans_wake_list.append(wakes['xkicks'])
+            self.long_unit_list.append(wakes['unit'])
+            self.trans_unit_list.append(wakes['unit'])
+            self.x_grids_list.append(wakes['x_grids'])
+            self.z_grids_list.append(wakes['z_grids'])
 
     # 'Cx', 'Cxp', 'R51', 'R52', 'R56', 'alphaX', 'alphaX_beam',
     # 'alphaX_minus_dispersion', 'betaX', 'betaX_beam',
@@ -118,39 +100,21 @@ class DFCSR_postprocessor():
 
 
     def get_wakes(self, s, show_plot = True):
-        
-        with h5py.File(self.wake_filename, "r") as f:
-            self.charge_list = []
-            self.energy_list = []
-            self.gamma_list = []
-            self.step_list = []
-            self.element_list = []
-            self.position_list = []
-
-            for step in f.keys():
-                self.energy_list.append(f[step].attrs['beam_energy'])
-                self.charge_list.append(f[step].attrs['charge'])
-                self.gamma_list.append(f[step].attrs['mean_gamma'])
-                self.step_list.append(f[step].attrs['step'])
-                self.position_list.append(f[step].attrs['position'])
-                self.element_list.append(f[step].attrs['element'])
-        
+
+        self.parse_wake_info()
+
         ind = find_nearest_ind(self.position_list, s)
 
         print("plot longitudinal wakes at nearest point s  = {} m, step count {}".format(self.position_list[ind],
                                                                                          self.step_list[ind]))
 
-        step = "step_" + str(self.step_list[ind])
-
-        with h5py.File(self.wake_filename, "r") as f:
-            print("ebeam energy {}".format(f[step].attrs['beam_energy']))
-            dE_dct = np.array(f[step]['longitudinal']['dE_dct'])
-            unit = f[step]['longitudinal'].attrs['unit']
-
-            x_grids = np.array(f[step]['longitudinal']['x_grids']).reshape(dE_dct.shape)
-            z_grids = np.array(f[step]['longitudinal']['z_grids']).reshape(dE_dct.shape)
-
-            xkicks = np.array(f[step]['transverse']['xkicks'])
+        wakes = read_wakes(self.wake_filename, ind)
+        print("ebeam energy {}".format(wakes['beam_energy'][ind]))
+        dE_dct = wakes['dE_dct']
+        unit = wakes['unit']
+        x_grids = wakes['x_grids']
+        z_grids = wakes['z_grids']
+        xkicks = wakes['xkicks']
 
         if show_plot:
 
@@ -180,17 +144,12 @@ class DFCSR_postprocessor():
         print("plot longitudinal wakes at nearest point s  = {} m, step count {}".format(self.position_list[ind],
                                                                                          self.step_list[ind]))
 
-        step = "step_" + str(self.step_list[ind])
-
-        with h5py.File(self.wake_filename, "r") as f:
-            print("ebeam energy {}".format(f[step].attrs['beam_energy']))
-            dE_dct = np.array(f[step]['longitudinal']['dE_dct'])
-            # unit = f[step]['longitudinal'].attrs['unit']
-
-            x_grids = np.array(f[step]['longitudinal']['x_grids']).reshape(dE_dct.shape)
-            z_grids = np.array(f[step]['longitudinal']['z_grids']).reshape(dE_dct.shape)
-
-            xkicks = np.array(f[step]['transverse']['xkicks'])
+        wakes = read_wakes(self.wake_filename, ind)
+        print("ebeam energy {}".format(wakes['beam_energy'][ind]))
+        dE_dct = wakes['dE_dct']
+        x_grids = wakes['x_grids']
+        z_grids = wakes['z_grids']
+        xkicks = wakes['xkicks']
 
         plot_2D_contour(x_grids,z_grids,dE_dct)
         plot_2D_contour(x_grids,z_grids,xkicks)
@@ -21,6 +21,10 @@ Basic usage:
 
 mpirun -n 4 python -m mpi4py.futures -m pyDFCSR_mpi_run ./input/dipole_config.yaml
 
+With checkpoint_interval in CSR_computation, continue a stopped run from its last checkpoint on the same number of ranks:
+
+mpirun -n 4 python -m pyDFCSR_mpi_run --restart ./output/dipole-checkpoint.pkl
+
 
 """
 
@@ -28,13 +32,17 @@ mpirun -n 4 python -m mpi4py.futures -m pyDFCSR_mpi_run ./input/dipole_config.ya
 if __name__ == "__main__":
     
     parser = argparse.ArgumentParser(description="Configure pyDFCSR")
-    parser.add_argument("input_file", help="input_file")
+    parser.add_argument("input_file", nargs="?", help="input_file")
+    parser.add_argument("--restart", default=None,
+                        help="checkpoint of a previous run to continue, as printed by the run (one file per rank)")
 
     args = parser.parse_args()
     #print(args)
 
-    infile = args.input_file
-    assert os.path.exists(infile), f"Input file does not exist: {infile}"
-
-    CSR = CSR2D(input_file= infile, parallel= True)
+    if args.restart:
+        CSR = CSR2D.restart(args.restart, parallel= True)
+    else:
+        infile = args.input_file
+        assert infile and os.path.exists(infile), f"Input file does not exist: {infile}"
+        CSR = CSR2D(input_file= infile, parallel= True)
     CSR.run()
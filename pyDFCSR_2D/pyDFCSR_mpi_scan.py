@@ -0,0 +1,253 @@
+import argparse
+import copy
+import itertools
+import os
+
+import h5py
+import numpy as np
+from mpi4py import MPI
+
+from pyDFCSR_2D import CSR2D
+from pyDFCSR_2D.tools import full_path
+from pyDFCSR_2D.yaml_parser import parse_yaml, ordered_dump
+
+
+comm = MPI.COMM_WORLD
+mpi_rank = comm.Get_rank()
+mpi_size = comm.Get_size()
+
+"""
+Parameter scan driver
+
+The ranks are split in groups of group_size ranks. Each group runs one CSR2D case at a time on its own
+communicator, and takes the next case from a shared counter as soon as it is free.
+
+Basic usage:
+
+mpirun -n 16 python pyDFCSR_mpi_scan.py ./input/chicane_scan.yaml --group_size 4
+
+The scan file gives the base config and the parameters. All the combinations of the parameter values are run,
+or the list of cases if given instead. A parameter is a dotted path in the config, or in the beam (distgen)
+and lattice files with the prefixes beam. and lattice. :
+
+base_config: input/chicane_config.yaml
+workdir: ./output/scan
+parameters:
+  beam.total_charge.value: [0.5, 1.0]
+  lattice.B1.angle: [0.04, 0.05]
+  CSR_computation.xbins: [10, 20]
+#cases:
+#  - {lattice.B1.angle: 0.04, lattice.B2.angle: -0.04}
+#  - {lattice.B1.angle: 0.05, lattice.B2.angle: -0.05}
+#fork_at: B2
+
+With fork_at, only lattice parameters of fork_at and the elements downstream of it can be scanned. Each group runs
+the common upstream part once, stops before entering fork_at, and runs every case from a snapshot of that state.
+
+The final statistics of all the cases are written to workdir/scan_summary.h5
+"""
+
+SUMMARY_KEYS = ['mean_energy', 'sigma_energy', 'mean_x', 'sigma_x', 'sigma_z', 'mean_z']
+SUMMARY_TWISS_KEYS = ['norm_emit_x', 'norm_emit_y', 'beta_x', 'alpha_x', 'eta_x', 'etap_x']
+
+
+def scan_cases(scan):
+    """
+    :return: list of cases, each a dictionary {parameter path: value}
+    """
+    if 'cases' in scan:
+        return [dict(case) for case in scan['cases']]
+    names = list(scan['parameters'].keys())
+    values = [scan['parameters'][name] for name in names]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def set_value(dic, path, value):
+    """
+    set dic[a][b][c] = value for the path a.b.c
+    """
+    keys = path.split('.')
+    for key in keys[:-1]:
+        assert key in dic, f'{key} of the scan parameter {path} not found'
+        dic = dic[key]
+    dic[keys[-1]] = value
+
+
+def write_case(base_config, case, index, workdir):
+    """
+    write the config of one case, with the beam and lattice files if they are scanned, in workdir/case_{index}
+    :return: path of the config file
+    """
+    case_dir = os.path.join(workdir, f'case_{index}')
+    os.makedirs(case_dir, exist_ok=True)
+    config = copy.deepcopy(base_config)
+    files = {'beam': None, 'lattice': None}
+
+    for path, value in case.items():
+        prefix, _, rest = path.partition('.')
+        if prefix in files:
+            if files[prefix] is None:
+                if prefix == 'beam':
+                    assert config['input_beam']['style'] == 'distgen', 'beam. parameters need a distgen beam'
+                    files[prefix] = parse_yaml(config['input_beam']['distgen_input_file'])
+                else:
+                    files[prefix] = parse_yaml(config['input_lattice']['lattice_input_file'])
+            set_value(files[prefix], rest, value)
+        else:
+            set_value(config, path, value)
+
+    if files['beam'] is not None:
+        filename = os.path.join(case_dir, 'beam.yaml')
+        with open(filename, 'w') as f:
+            ordered_dump(files['beam'], f)
+        config['input_beam']['distgen_input_file'] = filename
+    if files['lattice'] is not None:
+        filename = os.path.join(case_dir, 'lattice.yaml')
+        with open(filename, 'w') as f:
+            ordered_dump(files['lattice'], f)
+        config['input_lattice']['lattice_input_file'] = filename
+
+    CSR_computation = config.setdefault('CSR_computation', {})
+    CSR_computation['workdir'] = case_dir
+    CSR_computation['write_name'] = f'case_{index}'
+    filename = os.path.join(case_dir, 'config.yaml')
+    with open(filename, 'w') as f:
+        ordered_dump(config, f)
+    return filename
+
+
+def check_fork(base_config, cases, fork_at):
+    """
+    with fork_at, only the lattice parameters of fork_at and the elements downstream of it can be scanned
+    :return: error message, None if the scan is valid
+    """
+    lattice = parse_yaml(base_config['input_lattice']['lattice_input_file'])
+    elements = list(lattice.keys())[1:]   # the first entry is step_size
+    if fork_at not in elements:
+        return f'fork_at element {fork_at} is not in the lattice {elements}'
+    downstream = elements[elements.index(fork_at):]
+    for name in {name for case in cases for name in case}:
+        prefix, _, rest = name.partition('.')
+        element = rest.split('.')[0]
+        if prefix != 'lattice':
+            return f'Scan parameter {name}: with fork_at, only lattice parameters can be scanned'
+        if element not in downstream:
+            return f'Scan parameter {name}: element {element} is not {fork_at} or downstream of it {downstream}'
+    return None
+
+
+def summary(CSR):
+    """
+    statistics of the beam at the end of the run
+    """
+    stats = CSR.statistics
+    step = CSR.beam.step
+    out = {key: stats[key][step] for key in SUMMARY_KEYS}
+    out.update({key: stats['twiss'][key][step] for key in SUMMARY_TWISS_KEYS})
+    return out
+
+
+def next_case(win):
+    """
+    atomically increment the case counter on rank 0 of the window
+    :return: the previous value, index of the case to run
+    """
+    one = np.ones(1, dtype=np.int64)
+    index = np.zeros(1, dtype=np.int64)
+    win.Lock(0)
+    win.Fetch_and_op(one, index, 0, 0, MPI.SUM)
+    win.Unlock(0)
+    return int(index[0])
+
+
+def write_summary(filename, cases, files, results):
+    """
+    one dataset per parameter and per summary statistic, indexed by case
+    """
+    with h5py.File(filename, 'w') as hf:
+        hf.create_dataset('config_files', data=np.array(files, dtype='S'))
+        for name in cases[0]:
+            values = np.array([case[name] for case in cases])
+            if values.dtype.kind == 'U':
+                values = values.astype('S')
+            hf.create_dataset(f'parameters/{name}', data=values)
+        for key in SUMMARY_KEYS + SUMMARY_TWISS_KEYS:
+            hf.create_dataset(f'summary/{key}', data=np.array([results[i][key] for i in range(len(cases))]))
+    print('Scan summary written to ', filename)
+
+
+def run_scan(scan, group_size):
+    workdir = full_path(scan.get('workdir', '.'))
+    cases = scan_cases(scan)
+
+    fork_at = scan.get('fork_at')
+
+    files = None
+    error = None
+    if mpi_rank == 0:
+        base_config = parse_yaml(scan['base_config'])
+        if fork_at is not None:
+            error = check_fork(base_config, cases, fork_at)
+        if error is None:
+            os.makedirs(workdir, exist_ok=True)
+            files = [write_case(base_config, case, i, workdir) for i, case in enumerate(cases)]
+            print(f'{len(cases)} cases on {(mpi_size + group_size - 1) // group_size} groups of {group_size} ranks')
+    error, files = comm.bcast((error, files), root=0)
+    if error is not None:
+        raise ValueError(error)
+
+    group = comm.Split(mpi_rank // group_size, mpi_rank)
+    leader = group.Get_rank() == 0
+
+    # counter of the next case to run, on rank 0
+    counter = np.zeros(1, dtype=np.int64)
+    win = MPI.Win.Create(counter if mpi_rank == 0 else None, comm=comm)
+
+    upstream = None
+
+    results = {}
+    while True:
+        index = group.bcast(next_case(win) if leader else None, root=0)
+        if index >= len(cases):
+            break
+        if fork_at is None:
+            CSR = CSR2D(input_file=files[index], parallel=True, comm=group)
+        else:
+            if upstream is None:
+                # the part of the lattice common to all the cases, once per group
+                upstream = CSR2D(input_file=files[index], parallel=True, comm=group)
+                upstream.CSR_params.workdir = workdir
+                upstream.CSR_params.write_name = f'upstream_{mpi_rank // group_size}'
+                upstream.prefix = f'{upstream.CSR_params.write_name}-{upstream.timestamp}'
+                upstream.run(stop_element=fork_at)
+            CSR = upstream.snapshot(write_name=f'case_{index}')
+            CSR.CSR_params.workdir = os.path.dirname(files[index])
+            CSR.replace_lattice(parse_yaml(files[index])['input_lattice'])
+        CSR.run()
+        if leader:
+            results[index] = summary(CSR)
+            print(f'Finished case {index}: {cases[index]}')
+
+    comm.Barrier()
+    win.Free()
+    group.Free()
+
+    gathered = comm.gather(results, root=0)
+    if mpi_rank == 0:
+        results = {}
+        for r in gathered:
+            results.update(r)
+        write_summary(os.path.join(workdir, 'scan_summary.h5'), cases, files, results)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Parameter scan with pyDFCSR")
+    parser.add_argument("scan_file", help="scan file")
+    parser.add_argument("--group_size", type=int, default=1, help="number of ranks running each case")
+
+    args = parser.parse_args()
+
+    assert os.path.exists(args.scan_file), f"Scan file does not exist: {args.scan_file}"
+
+    run_scan(parse_yaml(args.scan_file), args.group_size)
@@ -46,14 +46,8 @@ def r_gen6(L, angle = 0, k1=0, roll=0, E1=0, E2=0, hgap=0):
     ky2 = -k1
 
     if angle:
-        psi1 = 0.50*2*h*hgap*(1 + (np.sin(E1))**2)/np.cos(E1)
-        psi2 = 0.50*2*h*hgap*(1 + (np.sin(E2))**2)/np.cos(E2)
-        Rpr1 = np.eye(6, 6)
-        Rpr2 = np.eye(6, 6)
-        Rpr1[1, 0] = np.tan(E1)*h
-        Rpr2[1, 0] = np.tan(E2)*h
-        Rpr1[3, 2] = -np.tan(E1 - psi1)*h
-        Rpr2[3, 2] = -np.tan(E2 - psi2)*h   # seems to be a typo on Paul's codes?
+        Rpr1 = r_edge(h, E1, hgap = hgap)
+        Rpr2 = r_edge(h, E2, hgap = hgap)   # Rpr2[3, 2] seems to be a typo on Paul's codes?
 
     # Horizontal plane
     kx = np.sqrt(np.abs(kx2))
@@ -122,8 +116,17 @@ def r_gen6(L, angle = 0, k1=0, roll=0, E1=0, E2=0, hgap=0):
     return R
 
 
-
-
-
-
-
+def r_edge(h, E, hgap = 0, fint = 0.5):
+    """
+    Return the 6*6 R matrix of a dipole pole face, with the fringe field vertical focusing. Used by r_gen6.
+    :param h: curvature of the dipole [1/meter]
+    :param E: pole-face rotation [rads]
+    :param hgap: (opt, DEF = 0) vertical half-gap of the magnet [m]
+    :param fint: (opt, DEF = 0.5) fringe field integral (K1 of the MAD manual)
+    :return: 6*6 R matrix (x, x', y, y', z, dp/p)
+    """
+    psi = fint*2*h*hgap*(1 + (np.sin(E))**2)/np.cos(E)
+    R = np.eye(6, 6)
+    R[1, 0] = np.tan(E)*h
+    R[3, 2] = -np.tan(E - psi)*h
+    return R
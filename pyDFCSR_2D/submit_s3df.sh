@@ -19,3 +19,5 @@ module load mpi/openmpi-x86_64
 #export PYTHONPATH=$PYTHONPATH:/sdf/home/j/jytang/sdf_beamphysics/jytang/pyDFCSR/pyDFCSR_2D
 
 mpirun -n 150 python  -m pyDFCSR_mpi_run /sdf/group/ad/beamphysics/jytang/pyDFCSR/pyDFCSR_2D/example/input/chicane_config.yaml
+# continue a stopped job from its last checkpoint (checkpoint_interval in CSR_computation), on the same number of ranks
+#mpirun -n 150 python  -m pyDFCSR_mpi_run --restart /sdf/group/ad/beamphysics/jytang/pyDFCSR/pyDFCSR_2D/example/output/chicane-checkpoint.pkl
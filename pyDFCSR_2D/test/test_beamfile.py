@@ -0,0 +1,80 @@
+import h5py
+import numpy as np
+import pytest
+from pmd_beamphysics import ParticleGroup
+
+from pyDFCSR_2D.interfaces import beamfile_format, openpmd_to_bmadx_coords, read_binary_coords, read_openpmd_bmadx_coords
+
+
+def test_npy_layouts(tmp_path):
+    coords = np.random.default_rng(0).normal(size=(2500, 6))
+    np.save(tmp_path / 'beam.npy', coords)
+    np.save(tmp_path / 'beam_T.npy', coords.T.copy())
+
+    assert beamfile_format(str(tmp_path / 'beam.npy')) == 'npy'
+    for name in ['beam.npy', 'beam_T.npy']:
+        out = read_binary_coords(str(tmp_path / name), 'npy', chunk_size=1000)
+        assert out.flags['C_CONTIGUOUS']
+        assert np.array_equal(out, coords.T)
+
+
+def test_raw_float32(tmp_path):
+    coords = np.random.default_rng(1).normal(size=(6, 2500)).astype(np.float32)
+    coords.tofile(tmp_path / 'beam.bin')
+
+    assert beamfile_format(str(tmp_path / 'beam.bin')) == 'raw'
+    out = read_binary_coords(str(tmp_path / 'beam.bin'), 'raw', dtype='float32', chunk_size=700)
+    assert out.dtype == np.float64
+    assert np.array_equal(out, coords)
+
+
+def make_particle_group(n=2500, seed=2):
+    rng = np.random.default_rng(seed)
+    data = {'x': rng.normal(size=n) * 1e-4, 'y': rng.normal(size=n) * 1e-4, 'z': rng.normal(size=n) * 1e-4,
+            'px': rng.normal(size=n) * 1e3, 'py': rng.normal(size=n) * 1e3,
+            'pz': 1e8 * (1 + rng.normal(size=n) * 1e-3), 't': np.zeros(n), 'status': np.ones(n, dtype=int),
+            'weight': np.full(n, 1e-9 / n), 'species': 'electron'}
+    return ParticleGroup(data=data)
+
+
+def test_openpmd_reader(tmp_path):
+    pg = make_particle_group()
+    filename = str(tmp_path / 'beam.h5')
+    pg.write(filename)
+
+    assert beamfile_format(filename) == 'openpmd'
+    # default reference momentum: the mean energy, as Beam does for the distgen and ParticleGroup beams
+    coords, p0c, charge = read_openpmd_bmadx_coords(filename, chunk_size=700)
+    assert np.isclose(p0c, np.mean(pg['energy']), rtol=1e-12)
+    assert np.isclose(charge, pg['charge'], rtol=1e-12)
+    assert coords.flags['C_CONTIGUOUS']
+    assert np.allclose(coords, np.array(openpmd_to_bmadx_coords(pg, p0c)), rtol=1e-12, atol=1e-15)
+
+    coords, p0c, _ = read_openpmd_bmadx_coords(filename, p0c=1.2e8, chunk_size=700)
+    assert p0c == 1.2e8
+    assert np.allclose(coords, np.array(openpmd_to_bmadx_coords(pg, 1.2e8)), rtol=1e-12, atol=1e-15)
+
+
+def test_openpmd_reader_species_layout(tmp_path):
+    pg = make_particle_group()
+    filename = str(tmp_path / 'beam.h5')
+    pg.write(filename)
+    with h5py.File(filename, 'r+') as h5:
+        assert list(h5['particles']) == ['electron']
+        # older files: the records directly under the particles path, without a species group
+        h5.move('particles/electron', 'electron')
+        del h5['particles']
+        h5.move('electron', 'particles')
+
+    coords, p0c, charge = read_openpmd_bmadx_coords(filename, chunk_size=700)
+    assert np.isclose(charge, pg['charge'], rtol=1e-12)
+    assert np.allclose(coords, np.array(openpmd_to_bmadx_coords(pg, p0c)), rtol=1e-12, atol=1e-15)
+
+    # two species are ambiguous
+    with h5py.File(filename, 'r+') as h5:
+        h5.move('particles', 'electron')
+        h5.create_group('particles')
+        h5.move('electron', 'particles/electron')
+        h5.copy('particles/electron', 'particles/positron')
+    with pytest.raises(AssertionError):
+        read_openpmd_bmadx_coords(filename)
@@ -0,0 +1,20 @@
+import numpy as np
+
+from pyDFCSR_2D.distributed import block_partition, weighted_partition
+
+
+def test_weighted_partition_balances_cost():
+    cost = np.concatenate((np.full(50, 10.0), np.ones(250)))
+    count, displ = weighted_partition(cost, 4)
+
+    assert sum(count) == len(cost)
+    assert np.array_equal(displ, np.cumsum([0] + count[:-1]))
+    block_cost = [np.sum(cost[d:d + c]) for c, d in zip(count, displ)]
+    assert np.all(np.abs(np.array(block_cost) - np.sum(cost) / 4) <= np.max(cost))
+
+
+def test_weighted_partition_without_timings():
+    count, displ = weighted_partition(np.zeros(10), 3)
+    ref_count, ref_displ = block_partition(10, 3)
+    assert count == ref_count
+    assert np.array_equal(displ, ref_displ)
@@ -0,0 +1,58 @@
+import numpy as np
+
+from pyDFCSR_2D.beams import Beam
+
+
+def drift(L):
+    M = np.eye(7)
+    M[0, 1] = L
+    M[2, 3] = L
+    return M
+
+
+def focusing_kick(k, L):
+    """
+    thin kick px -= k*L*x, a linear stand-in for the CSR kick of a step of length L
+    """
+    M = np.eye(7)
+    M[1, 0] = -k * L
+    return M
+
+
+def track_error(tmp_path, integrator, n_steps, k=4.0, length=1.0):
+    """
+    track a beam through a uniform focusing channel of length length with n_steps steps, and return the error of
+    the final x w.r.t. the exact harmonic motion
+    """
+    rng = np.random.default_rng(0)
+    coords = rng.normal(size=(1000, 6)) * 1e-4
+    beamfile = tmp_path / 'beam.txt'
+    np.savetxt(beamfile, coords)
+    beam = Beam({'style': 'from_file', 'beamfile': str(beamfile), 'charge': 1e-10, 'energy': 1e8})
+    x0, px0 = beam.x.copy(), beam.px.copy()
+
+    DL = length / n_steps
+    kick = focusing_kick(k, DL)
+    for _ in range(n_steps):
+        if integrator == 'split':
+            beam.frog_leap(drift(DL / 2), drift(DL / 2), DL, kick=lambda: beam.apply_linear_map(kick))
+        else:
+            beam.track(drift(DL), DL)
+            beam.apply_linear_map(kick)
+
+    w = np.sqrt(k)
+    x = x0 * np.cos(w * length) + px0 / w * np.sin(w * length)
+    return np.max(np.abs(beam.x - x))
+
+
+def test_split_integrator_second_order(tmp_path):
+    n_steps = [8, 16, 32]
+    split = [track_error(tmp_path, 'split', n) for n in n_steps]
+    kick = [track_error(tmp_path, 'kick', n) for n in n_steps]
+
+    # halving the step divides the error by 4 for the drift-kick-drift step, by 2 for the kick after the step
+    order_split = np.log2(np.array(split[:-1]) / np.array(split[1:]))
+    order_kick = np.log2(np.array(kick[:-1]) / np.array(kick[1:]))
+    assert np.all(np.abs(order_split - 2) < 0.1)
+    assert np.all(np.abs(order_kick - 1) < 0.2)
+    assert split[-1] < kick[-1]
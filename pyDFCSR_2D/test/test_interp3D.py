@@ -0,0 +1,66 @@
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+
+from pyDFCSR_2D.interp1D import build_bin_table
+from pyDFCSR_2D.interp3D import interpolate3D, interpolate_fields
+
+
+def make_data(nt=7, ny=20, nz=30, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.random((nt, ny, nz, 5)), np.linspace(-1, 1, ny), np.linspace(-2, 2, nz)
+
+
+def test_uniform_time_matches_interpolate3D():
+    data, y, z = make_data()
+    times = np.linspace(0.0, 0.6, data.shape[0])
+    rng = np.random.default_rng(1)
+    n = 5000
+    tv, yv, zv = rng.uniform(0, 0.6, n), rng.uniform(-1.1, 1.1, n), rng.uniform(-2.1, 2.1, n)
+
+    table = build_bin_table(times, 4 * len(times))
+    out = interpolate_fields(tv, yv, zv, data, times, table, 0.6 / (4 * len(times) - 1),
+                             y[0], z[0], y[1] - y[0], z[1] - z[0], 0.1, 0.02)
+    for f in range(data.shape[3]):
+        ref = interpolate3D(tv, yv, zv, np.ascontiguousarray(data[..., f]), times[0], y[0], z[0],
+                            times[1] - times[0], y[1] - y[0], z[1] - z[0], 0.1, 0.02)
+        assert np.allclose(out[:, f], ref, atol=1e-12)
+
+
+def test_non_uniform_time():
+    data, y, z = make_data()
+    times = np.array([0.0, 0.05, 0.06, 0.2, 0.45, 0.5, 0.9])
+    rng = np.random.default_rng(2)
+    n = 5000
+    tv, yv, zv = rng.uniform(0, 0.9, n), rng.uniform(-0.99, 0.99, n), rng.uniform(-1.99, 1.99, n)
+
+    # table coarser than the smallest interval
+    table = build_bin_table(times, 10)
+    out = interpolate_fields(tv, yv, zv, data, times, table, 0.9 / 9, y[0], z[0], y[1] - y[0], z[1] - z[0])
+    ref = RegularGridInterpolator((times, y, z), data)(np.array([tv, yv, zv]).T)
+    assert np.allclose(out, ref, atol=1e-12)
+
+    # outside of the time axis
+    out = interpolate_fields(np.array([-0.01, 0.91]), np.zeros(2), np.zeros(2), data, times, table, 0.9 / 9,
+                             y[0], z[0], y[1] - y[0], z[1] - z[0])
+    assert np.all(out == 0.0)
+
+
+def test_time_sliced_sum():
+    # the time intervals dealt to 3 ranks in blocks of 2, each rank holding only the slices of its intervals
+    data, y, z = make_data()
+    times = np.array([0.0, 0.05, 0.06, 0.2, 0.45, 0.5, 0.9])
+    table = build_bin_table(times, 10)
+    rng = np.random.default_rng(3)
+    n = 5000
+    tv, yv, zv = rng.uniform(0, 0.9, n), rng.uniform(-0.99, 0.99, n), rng.uniform(-1.99, 1.99, n)
+    args = (y[0], z[0], y[1] - y[0], z[1] - z[0], 0.1, 0.02)
+
+    ref = interpolate_fields(tv, yv, zv, data, times, table, 0.9 / 9, *args)
+    total = np.zeros_like(ref)
+    for rank in range(3):
+        owned = np.array([(k // 2) % 3 == rank for k in range(len(times))])
+        held = owned | np.concatenate(([False], owned[:-1]))
+        rows = np.full(len(times), -1)
+        rows[held] = np.arange(np.sum(held))
+        total += interpolate_fields(tv, yv, zv, data[held], times, table, 0.9 / 9, *args, rows, owned)
+    assert np.allclose(total, ref, atol=1e-14)
@@ -0,0 +1,27 @@
+import os
+
+import numpy as np
+
+from pyDFCSR_2D.interp1D import interpolate1D_fields
+from pyDFCSR_2D.lattice import Lattice
+
+lattice_file = os.path.join(os.path.dirname(__file__), '..', 'example', 'input', 'dipole_lattice.yaml')
+
+
+def test_reference_trajectory_closed_form():
+    lattice = Lattice({'lattice_input_file': lattice_file})
+
+    # drift 0.1 m, dipole 1 m with 1 rad, drift 0.5 m
+    assert np.all(np.isin(lattice.distance, lattice.s))
+    x = 0.1 + np.sin(1.0) + 0.5 * np.cos(1.0)
+    y = 1 - np.cos(1.0) + 0.5 * np.sin(1.0)
+    assert np.allclose(lattice.coords[-1], [x, y], rtol=1e-12)
+    assert np.allclose(lattice.tau_vec[-1], [np.cos(1.0), np.sin(1.0)], rtol=1e-12)
+
+    # interpolation inside the dipole
+    s = np.array([0.1, 0.6, 1.1])
+    traj = interpolate1D_fields(s, lattice.traj_data, lattice.s, lattice.traj_table, lattice.traj_table_step)
+    assert np.allclose(traj[1, :2], [0.1 + np.sin(0.5), 1 - np.cos(0.5)], atol=1e-7)
+    assert np.allclose(traj[:, 4], np.cos([0.0, 0.5, 1.0]), atol=1e-7)
+
+    assert np.array_equal(lattice.get_rho(np.array([0.05, 0.5, 1.2, 2.0])), [0.0, 1.0, 0.0, 0.0])
@@ -0,0 +1,41 @@
+from collections import namedtuple
+
+import numpy as np
+
+from pyDFCSR_2D.moments import compute_moments
+from pyDFCSR_2D.twiss import twiss_from_bmadx_particles
+
+Particle = namedtuple('Particle', 'x px y py z pz s p0c mc2')
+
+
+def make_particle(n=100000, seed=0):
+    rng = np.random.default_rng(seed)
+    coords = rng.normal(size=(6, n)) * np.array([[1e-4], [1e-6], [1e-4], [1e-6], [2e-4], [1e-3]])
+    coords[0] += 0.5 * coords[4]   # x-z chirp
+    coords[0] += 1e-3              # offset
+    return Particle(*coords, 0.0, 5.0e9, 0.511e6)
+
+
+def test_moments_match_numpy():
+    p = make_particle()
+    m = compute_moments(p)
+
+    assert np.isclose(m.mean_x, np.mean(p.x), rtol=1e-12)
+    assert np.isclose(m.sigma_x, np.std(p.x), rtol=1e-12)
+    assert np.isclose(m.sigma_z, np.std(p.z), rtol=1e-12)
+    assert np.allclose(m.slope, np.polyfit(p.z, p.x, deg=1), rtol=1e-10)
+
+    x_transform = p.x - np.polyval(np.polyfit(p.z, p.x, deg=1), p.z)
+    assert np.isclose(m.sigma_x_transform, np.std(x_transform), rtol=1e-8)
+    assert np.isclose(m.sigma_energy, np.std((p.pz + 1) * p.p0c), rtol=1e-12)
+
+
+def test_moments_shift_and_twiss():
+    p = make_particle()
+    m0 = compute_moments(p)
+    m = compute_moments(p, shift=m0.mean)
+    assert np.allclose(m.cov, m0.cov, rtol=1e-10, atol=0)
+
+    twiss = twiss_from_bmadx_particles(p)
+    for key, value in m.twiss.items():
+        assert np.isclose(value, twiss[key], rtol=1e-10)
@@ -0,0 +1,52 @@
+from collections import deque
+from types import SimpleNamespace
+
+import numpy as np
+
+from pyDFCSR_2D.pool import SharedArrays, SharedHistory, attach
+
+
+def test_shared_arrays_roundtrip():
+    shared = SharedArrays()
+    try:
+        arrays = {'fields': np.random.default_rng(0).random((3, 4, 5, 5)), 'table': np.arange(7, dtype=np.int64),
+                  'odd': np.arange(3, dtype=np.float32)}
+        name, layout = shared.publish(arrays)
+        mapped = attach(name, layout)
+        for key in arrays:
+            assert mapped[key].dtype == arrays[key].dtype
+            assert np.array_equal(mapped[key], arrays[key])
+
+        # smaller arrays re-use the block, larger ones get a new block
+        name2, layout2 = shared.publish({'table': np.arange(5, dtype=np.int64)})
+        assert name2 == name
+        name3, layout3 = shared.publish({'fields': np.ones((10, 4, 5, 5))})
+        assert name3 != name
+        assert np.all(attach(name3, layout3)['fields'] == 1.0)
+    finally:
+        shared.close()
+
+
+def test_shared_history_copies_new_slices():
+    rng = np.random.default_rng(1)
+    slices = {k: rng.random((3, 4, 5)) for k in range(12)}
+    history = SharedHistory()
+
+    def check(index, generation=0):
+        DF = SimpleNamespace(index_interp=deque(index), interp_generation=generation,
+                             data_fields_interp=np.stack([slices[k] for k in index]))
+        (name, layout), rows = history.publish(DF)
+        block = attach(name, layout)['data_fields_interp']
+        for k, row in zip(index, rows):
+            assert np.array_equal(block[row], slices[k])
+        return name
+
+    try:
+        name = check([0, 1, 2])
+        check([0, 1, 2, 3])                     # appended
+        assert check([2, 3, 4]) == name          # dropped from the front, rows re-used
+        check(list(range(2, 12)))                # grown, new block
+        slices.update({k: rng.random((3, 4, 5)) for k in range(12)})
+        check(list(range(2, 12)), generation=1)  # interpolated again, copied in full
+    finally:
+        history.close()
@@ -0,0 +1,17 @@
+from collections import OrderedDict
+
+from pyDFCSR_2D.pyDFCSR_mpi_scan import check_fork
+from pyDFCSR_2D.yaml_parser import ordered_dump
+
+
+def test_check_fork(tmp_path):
+    lattice = OrderedDict([('step_size', 0.05), ('D0', {'type': 'drift', 'L': 0.1}),
+                           ('B1', {'type': 'dipole', 'L': 0.5, 'angle': 0.05}), ('D1', {'type': 'drift', 'L': 0.3})])
+    with open(tmp_path / 'lattice.yaml', 'w') as f:
+        ordered_dump(lattice, f)
+    base_config = {'input_lattice': {'lattice_input_file': str(tmp_path / 'lattice.yaml')}}
+
+    assert check_fork(base_config, [{'lattice.B1.angle': 0.04}, {'lattice.D1.L': 0.2}], 'B1') is None
+    assert 'D0' in check_fork(base_config, [{'lattice.D0.L': 0.2}], 'B1')
+    assert 'only lattice' in check_fork(base_config, [{'CSR_computation.xbins': 10}], 'B1')
+    assert 'not in the lattice' in check_fork(base_config, [{'lattice.D1.L': 0.2}], 'B2')
@@ -0,0 +1,78 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from pyDFCSR_2D import CSR2D
+from pyDFCSR_2D.yaml_parser import ordered_dump
+
+LATTICE = {'step_size': 0.05,
+           'D0': {'type': 'drift', 'L': 0.1, 'nsep': 1},
+           'B1': {'type': 'dipole', 'L': 0.5, 'angle': 0.05, 'E1': 0.0, 'E2': 0.0, 'nsep': 1},
+           'D1': {'type': 'drift', 'L': 0.3, 'nsep': 1},
+           'B2': {'type': 'dipole', 'L': 0.3, 'angle': -0.05, 'E1': 0.0, 'E2': 0.0, 'nsep': 1},
+           'D2': {'type': 'drift', 'L': 0.2, 'nsep': 1}}
+
+
+def write_config(tmp_path, name, B2_angle):
+    lattice = OrderedDict((k, dict(v) if isinstance(v, dict) else v) for k, v in LATTICE.items())
+    lattice['B2']['angle'] = B2_angle
+    with open(tmp_path / f'{name}_lattice.yaml', 'w') as f:
+        ordered_dump(lattice, f)
+
+    rng = np.random.default_rng(0)
+    coords = rng.normal(0, 1, (6, 20000)) * np.array([[20e-6], [2e-6], [20e-6], [2e-6], [20e-6], [1e-4]])
+    np.save(tmp_path / 'beam.npy', coords)
+
+    config = OrderedDict({'input_beam': {'style': 'from_file', 'beamfile': str(tmp_path / 'beam.npy'),
+                             'charge': 1.0e-9, 'energy': 5.0e9},
+              'input_lattice': {'lattice_input_file': str(tmp_path / f'{name}_lattice.yaml')},
+              'particle_deposition': {'xbins': 50, 'zbins': 50, 'velocity_threhold': 1000, 'upper_limit': 100},
+              'CSR_integration': {'n_formation_length': 1, 'zbins': 30, 'xbins': 30},
+              'CSR_computation': {'xbins': 4, 'zbins': 6, 'write_beam': None, 'write_wakes': False,
+                                  'write_name': name, 'workdir': str(tmp_path), 'tracking': 'linear'}})
+    with open(tmp_path / f'{name}_config.yaml', 'w') as f:
+        ordered_dump(config, f)
+    return str(tmp_path / f'{name}_config.yaml')
+
+
+def same_run(a, b):
+    for key in ['sigma_x', 'sigma_z', 'mean_energy', 'sigma_energy', 'slope']:
+        assert np.array_equal(a.statistics[key], b.statistics[key])
+    assert np.array_equal(a.statistics['twiss']['norm_emit_x'], b.statistics['twiss']['norm_emit_x'])
+    assert np.array_equal(a.beam.coords, b.beam.coords)
+
+
+def test_resume_and_fork(tmp_path):
+    config = write_config(tmp_path, 'base', -0.05)
+    config2 = write_config(tmp_path, 'variant', -0.08)
+
+    full = CSR2D(input_file=config)
+    full.run()
+    full2 = CSR2D(input_file=config2)
+    full2.run()
+
+    upstream = CSR2D(input_file=config)
+    upstream.run(stop_element='B2')
+    fork = upstream.snapshot(write_name='fork')
+    fork.replace_lattice({'lattice_input_file': str(tmp_path / 'variant_lattice.yaml')})
+    fork.run()
+    upstream.run()
+
+    same_run(full, upstream)
+    same_run(full2, fork)
+
+
+def test_checkpoint_restart(tmp_path):
+    config = write_config(tmp_path, 'base', -0.05)
+
+    full = CSR2D(input_file=config)
+    full.run()
+
+    stopped = CSR2D(input_file=config)
+    stopped.CSR_params.checkpoint_interval = 10
+    stopped.run(stop_time=0.8)    # the job stops some steps after the checkpoint at step 10
+    restarted = CSR2D.restart(str(tmp_path / 'base-checkpoint.pkl'))
+    assert restarted.beam.step == 10
+    restarted.run()
+
+    same_run(full, restarted)
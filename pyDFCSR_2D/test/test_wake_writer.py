@@ -0,0 +1,65 @@
+import h5py
+import numpy as np
+
+from pyDFCSR_2D.wake_writer import WakeWriter, read_wakes
+
+
+def fake_wakes(step, shape=(4, 6)):
+    rng = np.random.default_rng(step)
+    return {'step': step, 'position': 0.1 * step, 'mean_gamma': 1000.0, 'beam_energy': 5e8,
+            'element': 'B1' if step < 3 else None, 'charge': 1e-9,
+            'x_grids': rng.random(shape), 'z_grids': rng.random(shape),
+            'dE_dct': rng.random(shape), 'xkicks': rng.random(shape)}
+
+
+def test_write_append_read(tmp_path):
+    filename = str(tmp_path / 'run-wakes.h5')
+    writer = WakeWriter(filename, compression='gzip')
+    for step in (1, 2):
+        writer.write(fake_wakes(step))
+    writer.close()
+
+    # resumed run appends to the same datasets
+    writer = WakeWriter(filename, new=False, compression='gzip')
+    writer.write(fake_wakes(3))
+    writer.close()
+
+    with h5py.File(filename, 'r') as f:
+        assert f['dE_dct'].shape == (3, 4, 6)
+        assert f['dE_dct'].compression == 'gzip'
+
+    info = read_wakes(filename)
+    assert np.array_equal(info['step'], [1, 2, 3])
+    assert list(info['element']) == ['B1', 'B1', '']
+    wakes = read_wakes(filename, 1)
+    for name in ('x_grids', 'z_grids', 'dE_dct', 'xkicks'):
+        assert np.array_equal(wakes[name], fake_wakes(2)[name])
+    assert wakes['unit'] == 'MeV/m'
+
+    # a new run replaces the file
+    writer = WakeWriter(filename)
+    writer.write(fake_wakes(1))
+    writer.close()
+    assert np.array_equal(read_wakes(filename)['step'], [1])
+
+
+def test_read_legacy_layout(tmp_path):
+    filename = str(tmp_path / 'old-wakes.h5')
+    with h5py.File(filename, 'w') as hf:
+        for step in (2, 1):
+            wakes = fake_wakes(step)
+            g = hf.create_group(f'step_{step}')
+            for name in ('step', 'position', 'mean_gamma', 'beam_energy', 'element', 'charge'):
+                g.attrs[name] = wakes[name]
+            g1 = g.create_group('longitudinal')
+            g1.attrs['unit'] = 'MeV/m'
+            g1.create_dataset('x_grids', data=wakes['x_grids'].flatten())
+            g1.create_dataset('z_grids', data=wakes['z_grids'].flatten())
+            g1.create_dataset('dE_dct', data=wakes['dE_dct'])
+            g2 = g.create_group('transverse')
+            g2.create_dataset('xkicks', data=wakes['xkicks'])
+
+    assert np.array_equal(read_wakes(filename)['step'], [1, 2])
+    wakes = read_wakes(filename, 1)
+    assert np.array_equal(wakes['x_grids'], fake_wakes(2)['x_grids'])
+    assert np.array_equal(wakes['xkicks'], fake_wakes(2)['xkicks'])
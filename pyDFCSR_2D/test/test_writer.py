@@ -0,0 +1,39 @@
+import threading
+
+import numpy as np
+import pytest
+
+from pyDFCSR_2D.writer import BackgroundWriter
+
+
+def test_jobs_in_order():
+    out = []
+    main = threading.get_ident()
+    writer = BackgroundWriter(max_pending=2)
+    for i in range(20):
+        writer.submit(lambda i: out.append((i, threading.get_ident() != main)), i)
+    writer.wait()
+    assert [i for i, _ in out] == list(range(20))
+    assert all(in_thread for _, in_thread in out)
+    writer.close()
+
+    # restarted after close
+    writer.submit(out.append, None)
+    writer.close()
+    assert out[-1] is None
+
+
+def test_synchronous():
+    out = []
+    writer = BackgroundWriter(max_pending=0)
+    writer.submit(out.append, np.ones(3))
+    assert len(out) == 1
+    writer.close()
+
+
+def test_error_raised_in_main_thread():
+    writer = BackgroundWriter()
+    writer.submit(lambda: 1 / 0)
+    with pytest.raises(RuntimeError):
+        writer.wait()
+    writer.close()
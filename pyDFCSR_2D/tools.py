@@ -3,6 +3,10 @@ import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib import cm
 import datetime
+import hashlib
+import json
+import shutil
+import yaml
 
 
 def full_path(path):
@@ -66,6 +70,58 @@ def find_nearest_ind(array, value):
     return idx
 
 
+def cache_dir():
+    """
+    local directory of the cached initial beams and lattice geometries, $PYDFCSR_CACHE or ~/.cache/pydfcsr
+    """
+    path = os.environ.get('PYDFCSR_CACHE', os.path.join('~', '.cache', 'pydfcsr'))
+    return full_path(os.path.expanduser(path))
+
+def yaml_hash(filename, extra = ''):
+    """
+    sha256 of the content of a yaml file, independent of its formatting and comments
+    :param extra: string added to the hashed content, e.g. a package version
+    """
+    with open(full_path(filename)) as f:
+        content = yaml.safe_load(f)
+    text = json.dumps(content, sort_keys = True, default = str) + extra
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def save_cache(key, arrays, metadata):
+    """
+    store arrays (one .npy each) and metadata (metadata.json) in the directory key of cache_dir().
+    The directory is written under a temporary name and renamed, so concurrent readers never see a partial entry
+    :param arrays: dictionary of numpy arrays
+    :param metadata: json serializable dictionary
+    """
+    path = os.path.join(cache_dir(), key)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(tmp, exist_ok = True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, name + '.npy'), array)
+    with open(os.path.join(tmp, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # another process stored the same entry first
+        shutil.rmtree(tmp, ignore_errors = True)
+
+def load_cache(key):
+    """
+    :return: (dictionary of memory mapped arrays, metadata) of an entry stored by save_cache, None if not in the cache
+    """
+    path = os.path.join(cache_dir(), key)
+    if not os.path.isfile(os.path.join(path, 'metadata.json')):
+        return None
+    with open(os.path.join(path, 'metadata.json')) as f:
+        metadata = json.load(f)
+    arrays = {}
+    for filename in os.listdir(path):
+        if filename.endswith('.npy'):
+            arrays[filename[:-4]] = np.load(os.path.join(path, filename), mmap_mode = 'r')
+    return arrays, metadata
+
 def dict2hdf5(hf, dic, group=None):
     for key, item in dic.items():
         if not isinstance(item, dict):
@@ -0,0 +1,109 @@
+import os
+
+import h5py
+import numpy as np
+
+# per step scalars of the wake file
+WAKE_ATTRS = ['step', 'position', 'mean_gamma', 'beam_energy', 'element', 'charge']
+# per step (xbins, zbins) arrays
+WAKE_ARRAYS = ['x_grids', 'z_grids', 'dE_dct', 'xkicks']
+
+
+class WakeWriter:
+    """
+    Wake file kept open during the run. Each quantity is one dataset with the step as first axis, extended by one
+    row per write. The arrays are chunked one step per chunk, optionally compressed
+    """
+    def __init__(self, filename, new = True, compression = None, first_step = None):
+        """
+        :param filename: path of the wake file
+        :param new: if True, replace an existing file, otherwise append to it (e.g. a resumed run)
+        :param compression: h5py compression filter of the wake arrays, e.g. 'gzip' or 'lzf'. None for no compression
+        :param first_step: when appending, the steps from first_step on are removed from the file. They were
+                           written after the checkpoint a run is restarted from
+        """
+        if new and os.path.isfile(filename):
+            os.remove(filename)
+            print("Existing file " + filename + " deleted.")
+        self.filename = filename
+        self.compression = compression
+        self.hf = h5py.File(filename, 'a')
+        if first_step is not None and 'step' in self.hf:
+            n = int(np.searchsorted(self.hf['step'][:], first_step))
+            for name in WAKE_ATTRS + WAKE_ARRAYS:
+                self.hf[name].resize(n, axis = 0)
+
+    def create_datasets(self, shape):
+        """
+        :param shape: (xbins, zbins) of the CSR mesh
+        """
+        hf = self.hf
+        for name in WAKE_ATTRS:
+            dtype = {'step': np.int64, 'element': h5py.string_dtype()}.get(name, np.float64)
+            hf.create_dataset(name, shape = (0,), maxshape = (None,), dtype = dtype, chunks = (1024,))
+        for name in WAKE_ARRAYS:
+            hf.create_dataset(name, shape = (0,) + tuple(shape), maxshape = (None,) + tuple(shape),
+                              dtype = np.float64, chunks = (1,) + tuple(shape), compression = self.compression)
+        hf['dE_dct'].attrs['unit'] = 'MeV/m'
+        hf['xkicks'].attrs['unit'] = 'MeV/m'
+        hf['x_grids'].attrs['unit'] = 'm'
+        hf['z_grids'].attrs['unit'] = 'm'
+
+    def write(self, wakes):
+        """
+        append the wakes of one step
+        :param wakes: dictionary with the WAKE_ATTRS scalars and the WAKE_ARRAYS arrays
+        """
+        if 'dE_dct' not in self.hf:
+            self.create_datasets(np.shape(wakes['dE_dct']))
+        n = self.hf['step'].shape[0]
+        for name in WAKE_ATTRS + WAKE_ARRAYS:
+            dset = self.hf[name]
+            dset.resize(n + 1, axis = 0)
+            dset[n] = wakes[name] if wakes[name] is not None else ''
+
+    def write_all(self, wakes_list):
+        """
+        append the wakes of several steps and flush the file
+        """
+        for wakes in wakes_list:
+            self.write(wakes)
+        self.flush()
+
+    def flush(self):
+        self.hf.flush()
+
+    def close(self):
+        if self.hf is not None:
+            self.hf.close()
+            self.hf = None
+
+
+def read_wakes(filename, index = None):
+    """
+    read a wake file written by WakeWriter, or by the older versions with one group step_{n} per step
+    :param index: index of the step to read the arrays of. None to read only the per step scalars
+    :return: dictionary of the WAKE_ATTRS arrays, and of the WAKE_ARRAYS of step index
+    """
+    out = {}
+    with h5py.File(filename, 'r') as f:
+        if 'dE_dct' in f:
+            for name in WAKE_ATTRS:
+                out[name] = np.array(f[name])
+            out['element'] = np.array(f['element'].asstr()[:])
+            if index is not None:
+                for name in WAKE_ARRAYS:
+                    out[name] = np.array(f[name][index])
+                out['unit'] = f['dE_dct'].attrs['unit']
+        else:
+            groups = sorted(f.keys(), key = lambda key: f[key].attrs['step'])
+            for name in WAKE_ATTRS:
+                out[name] = np.array([f[key].attrs[name] for key in groups])
+            if index is not None:
+                g = f[groups[index]]
+                out['dE_dct'] = np.array(g['longitudinal']['dE_dct'])
+                out['xkicks'] = np.array(g['transverse']['xkicks'])
+                out['x_grids'] = np.array(g['longitudinal']['x_grids']).reshape(out['dE_dct'].shape)
+                out['z_grids'] = np.array(g['longitudinal']['z_grids']).reshape(out['dE_dct'].shape)
+                out['unit'] = g['longitudinal'].attrs['unit']
+    return out
@@ -0,0 +1,74 @@
+import queue
+import threading
+
+
+class BackgroundWriter:
+    """
+    Thread running the output jobs (particle dumps, wakes) in the order they are submitted, while the run continues.
+    The jobs must own their data, e.g. copies of the particle coordinates. When max_pending jobs are waiting,
+    submit blocks until the thread catches up, so the memory held by the queued jobs is bounded
+    """
+    def __init__(self, max_pending = 4):
+        """
+        :param max_pending: maximum number of jobs in the queue. 0 to run the jobs in submit, without a thread
+        """
+        self.max_pending = max_pending
+        self.queue = None
+        self.thread = None
+        self.error = None
+
+    def submit(self, func, *args):
+        """
+        run func(*args) in the writer thread
+        """
+        self.check()
+        if self.max_pending == 0:
+            func(*args)
+            return
+        if self.thread is None:
+            self.queue = queue.Queue(maxsize = self.max_pending)
+            self.thread = threading.Thread(target = self._work, daemon = True)
+            self.thread.start()
+        self.queue.put((func, args))
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            func, args = job
+            try:
+                if self.error is None:
+                    func(*args)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        """
+        raise the error of a failed job in the main thread
+        """
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Background output job failed') from error
+
+    def wait(self):
+        """
+        block until all the submitted jobs are done
+        """
+        if self.queue is not None:
+            self.queue.join()
+        self.check()
+
+    def close(self):
+        """
+        finish the submitted jobs and stop the thread
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.queue = None
+        self.check()